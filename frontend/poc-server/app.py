@@ -1,13 +1,21 @@
+import os
+import sys
 from pathlib import Path
 from fastapi import FastAPI
-from fastapi import Response
-from fastapi import Header
+from fastapi import Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import HTTPException
 
+# Run from frontend/poc-server, make the `src` package importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from src.server.responses import FileRangeResponse  # noqa: E402
+from src.server.responses import get_file_validators, is_range_fresh  # noqa: E402
+from src.server.responses import parse_byte_ranges  # noqa: E402
+from src.server.responses import resolve_served_path  # noqa: E402
 
 app = FastAPI()
-CHUNK_SIZE = 1024 * 1024
+# Videos are served from the directory the server is run from
+VIDEO_ROOT = Path(".")
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,27 +26,29 @@ app.add_middleware(
 )
 
 
+# Same responder as /video of src/server/server.py
 @app.get("/video")
-async def video_endpoint(filename: str, range: str = Header(None)):
-    video_path = Path(filename)
-    if not video_path.exists():
+def video_endpoint(filename: str, request: Request):
+    video_path = resolve_served_path(VIDEO_ROOT, filename)
+    if video_path is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_size = video_path.stat().st_size
-    start_s, end_s = range.replace("bytes=", "").split("-")
-    start = int(start_s)
-    end = int(end_s) if end_s else start + CHUNK_SIZE - 1
-    if end >= file_size:
-        end = file_size - 1
-    length = end - start + 1
-
-    with open(video_path, "rb") as video:
-        video.seek(start)
-        data = video.read(length)
-    headers = {
-        "Content-Range": f"bytes {start}-{end}/{file_size}",
-        "Accept-Ranges": "bytes",
-        "Content-Length": str(length),
-        "X-Filename": video_path.name,
-    }
-    return Response(data, status_code=206, headers=headers, media_type="video/mp4")
+    video = open(video_path, "rb")
+    stat = os.fstat(video.fileno())
+    file_size = stat.st_size
+    headers = get_file_validators(stat)
+    headers["X-Filename"] = video_path.name
+    ranges = None
+    try:
+        if "range" in request.headers and is_range_fresh(
+            request.headers.get("if-range"), headers
+        ):
+            ranges = parse_byte_ranges(request.headers["range"], file_size)
+    except ValueError:
+        video.close()
+        raise HTTPException(
+            status_code=416,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"},
+        )
+    return FileRangeResponse(video, ranges, file_size, headers, "video/mp4")
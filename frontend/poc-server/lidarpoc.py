@@ -2,10 +2,14 @@ import open3d as o3d
 import numpy as np
 from mcap.reader import SeekingReader
 from rclpy.serialization import deserialize_message
-import sensor_msgs_py.point_cloud2 as pc2
 from sensor_msgs.msg import PointCloud2
+from pathlib import Path
+import sys
 import time
 
+# Run from frontend/poc-server, make the `src` package importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from src.repository.pointcloud import read_points_xyz  # noqa: E402
 
 vis = o3d.visualization.Visualizer()
 render_opt = vis.get_render_option()
@@ -24,14 +28,13 @@ with open(file_name, "rb") as f:
         topics=["/sensing/lidar/front/pointcloud_raw_ex"], log_time_order=True
     ):
         cloud: PointCloud2 = deserialize_message(message.data, PointCloud2)
-        point_xyz = pc2.read_points(cloud, field_names=["x", "y", "z"], skip_nans=True)
-        points = [list(t) for t in point_xyz]
+        points = read_points_xyz(cloud)
 
         if len(points) == 0:
             print("Skipping empty frame.")
             continue
 
-        pcd.points = o3d.utility.Vector3dVector(points)
+        pcd.points = o3d.utility.Vector3dVector(points.astype(np.float64))
         pcd.paint_uniform_color([0.2, 0.8, 0.2])
 
         if is_first_frame:
@@ -1,9 +1,58 @@
+import sys
 from argparse import ArgumentParser
+from pathlib import Path
 
 from ingest import ingest
 
 SERVE = "serve"
 INGEST = "ingest"
+CLIP = "clip"
+
+# main is run from src, make the `src` package importable too
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+
+def clip(
+    bag_path: str,
+    topic: str,
+    start: float,
+    end: float,
+    output: str,
+    cache_dir: str | None = None,
+    rendition: str | None = None,
+):
+    """Export the frames of a camera from `start` to `end` seconds as a MP4.
+    The camera is encoded like the server does, so that segments it already
+    cached in `cache_dir` are reused.
+    """
+    from src.server.clip import export_clip
+    from src.server.executors import DEFAULT_RENDITIONS
+    from src.server.processor import OnDemandProcessor
+    from src.server.segment_cache import SegmentCache
+
+    processor = OnDemandProcessor(
+        bag_path,
+        include_topics=[topic],
+        prefetch_cnt=0,
+        renditions=DEFAULT_RENDITIONS,
+        segment_cache=SegmentCache(cache_dir) if cache_dir else None,
+        undistort=True,
+    )
+    try:
+        with open(output, "wb") as output_file:
+            frame_cnt = export_clip(
+                processor,
+                topic,
+                int(start * 1e9),
+                int(end * 1e9),
+                output_file,
+                rendition,
+            )
+    finally:
+        processor.shutdown()
+    print(f"Exported {frame_cnt} frames to {output}")
 
 
 def mosaic():
@@ -26,6 +75,24 @@ def mosaic():
         "--dest", type=str, help="Where to put the new rosbags", required=True
     )
 
+    # Clip command args
+    clip_parser = subparsers.add_parser(CLIP, help="Export a camera clip as a MP4")
+    clip_parser.add_argument("--bag", type=str, help="Path to a ROS bag", required=True)
+    clip_parser.add_argument("--topic", type=str, help="Camera topic", required=True)
+    clip_parser.add_argument(
+        "--start", type=float, help="Start of the clip, in seconds", required=True
+    )
+    clip_parser.add_argument(
+        "--end", type=float, help="End of the clip, in seconds", required=True
+    )
+    clip_parser.add_argument(
+        "--output", type=str, help="Where to write the MP4", required=True
+    )
+    clip_parser.add_argument(
+        "--cache-dir", type=str, help="Segment cache shared with the server"
+    )
+    clip_parser.add_argument("--rendition", type=str, help="Rendition to export")
+
     args = parser.parse_args()
 
     if args.command == SERVE:
@@ -33,6 +100,16 @@ def mosaic():
     elif args.command == INGEST:
         print("Ingesting")
         ingest(bag_path=args.src, img_path=args.dest)
+    elif args.command == CLIP:
+        clip(
+            bag_path=args.bag,
+            topic=args.topic,
+            start=args.start,
+            end=args.end,
+            output=args.output,
+            cache_dir=args.cache_dir,
+            rendition=args.rendition,
+        )
     else:
         parser.print_help()
         exit(1)
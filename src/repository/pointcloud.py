@@ -0,0 +1,113 @@
+"""
+Vectorized PointCloud2 decoding
+src/repository/pointcloud.py
+
+The points of a PointCloud2 are read as a NumPy structured array whose dtype
+is built from the `fields` and `point_step` of the message, so the array is a
+view on the message data rather than one Python object per point:
+
+```python
+points = read_points(cloud, ["x", "y", "z"], skip_nans=True)
+xyz = read_points_xyz(cloud)  # (N, 3) float32
+```
+"""
+
+from typing import List, Optional
+
+import numpy as np
+from numpy.lib import recfunctions
+from sensor_msgs.msg import PointCloud2, PointField
+
+# PointField datatypes to NumPy formats, without byte order
+FIELD_FORMATS = {
+    PointField.INT8: "i1",
+    PointField.UINT8: "u1",
+    PointField.INT16: "i2",
+    PointField.UINT16: "u2",
+    PointField.INT32: "i4",
+    PointField.UINT32: "u4",
+    PointField.FLOAT32: "f4",
+    PointField.FLOAT64: "f8",
+}
+
+
+def get_point_dtype(
+    cloud: PointCloud2, field_names: Optional[List[str]] = None
+) -> np.dtype:
+    """Structured dtype of a point of a cloud, with its padding
+
+    Args:
+        cloud (PointCloud2): The cloud
+        field_names (Optional[List[str]]): Fields to keep, all by default. The
+            other fields are left out of the dtype but still skipped over.
+
+    Returns:
+        np.dtype: A dtype of `point_step` bytes, one named field per field
+    """
+    byte_order = ">" if cloud.is_bigendian else "<"
+    fields = {field.name: field for field in cloud.fields}
+    names = field_names if field_names is not None else list(fields.keys())
+    missing = [name for name in names if name not in fields]
+    if len(missing) > 0:
+        raise KeyError(f"PointCloud2 has no field {', '.join(missing)}")
+
+    formats = []
+    for name in names:
+        field = fields[name]
+        fmt = byte_order + FIELD_FORMATS[field.datatype]
+        formats.append((fmt, (field.count,)) if field.count > 1 else fmt)
+    return np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": [fields[name].offset for name in names],
+            "itemsize": cloud.point_step,
+        }
+    )
+
+
+def read_points(
+    cloud: PointCloud2,
+    field_names: Optional[List[str]] = None,
+    skip_nans: bool = False,
+) -> np.ndarray:
+    """Points of a cloud as a structured array, see get_point_dtype
+
+    The array is a view on the message data, nothing is copied, unless the
+    rows of the cloud are padded or `skip_nans` drops points.
+
+    Args:
+        cloud (PointCloud2): The cloud
+        field_names (Optional[List[str]]): Fields to read, all by default
+        skip_nans (bool): Drop the points with a NaN in a floating point field
+
+    Returns:
+        np.ndarray: One element per point, row after row
+    """
+    dtype = get_point_dtype(cloud, field_names)
+    point_cnt = cloud.width * cloud.height
+    if cloud.height <= 1 or cloud.row_step == cloud.width * cloud.point_step:
+        points = np.frombuffer(cloud.data, dtype, point_cnt)
+    else:
+        points = np.ndarray(
+            (cloud.height, cloud.width),
+            dtype,
+            cloud.data,
+            strides=(cloud.row_step, cloud.point_step),
+        ).reshape(-1)
+
+    if skip_nans:
+        is_valid = np.ones(point_cnt, bool)
+        for name in dtype.names:
+            if dtype[name].base.kind == "f":
+                values = points[name]
+                is_valid &= ~np.isnan(values.reshape(point_cnt, -1)).any(axis=1)
+        if not is_valid.all():
+            points = points[is_valid]
+    return points
+
+
+def read_points_xyz(cloud: PointCloud2, skip_nans: bool = True) -> np.ndarray:
+    """Coordinates of the points of a cloud as a (N, 3) float32 array"""
+    points = read_points(cloud, ["x", "y", "z"], skip_nans)
+    return recfunctions.structured_to_unstructured(points, np.float32)
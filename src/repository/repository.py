@@ -1,10 +1,15 @@
-from typing import Optional, Sequence, Self
+from typing import Any, Dict, List, Optional, Sequence, Self, Tuple
 from pathlib import Path
-from sqlmodel import Session, SQLModel, create_engine, select, Field
+from sqlalchemy import Index, inspect, text
+from sqlmodel import Session, SQLModel, create_engine, func, select, Field
 from termcolor import colored
 import json
+import time
+import yaml
 
 MOSAIC_DIR = ".mosaic"
+# Written by rosbag2 next to the files of a bag
+BAG_METADATA_FILE = "metadata.yaml"
 
 
 class MosaicRepoException(Exception):
@@ -33,6 +38,30 @@ class LogInfo(SQLModel, table=True):
     # TODO: Potentially track the slice id here instead
     uploaded: bool = False
 
+    # File name of the log, and the directory holding its bag relative to the
+    # repository root ("." for the root). The bag of a log is the directory of
+    # its rosbag2 metadata if it has one, else the log itself
+    name: Optional[str] = Field(default=None, index=True)
+    dir_path: Optional[str] = None
+    size_bytes: Optional[int] = None
+    mtime_ns: Optional[int] = None
+    # Cached from the rosbag2 metadata, the topics as a JSON list of
+    # {"name", "type"}, so they are known without opening the log
+    topics_json: Optional[str] = None
+    start_time_ns: Optional[int] = None
+    duration_ns: Optional[int] = None
+    # Last time the record changed, a directory listing changes with it
+    updated_ns: Optional[int] = None
+
+    # Directory listings are paginated by log_path
+    __table_args__ = (Index("ix_loginfo_dir_path_log_path", "dir_path", "log_path"),)
+
+    def get_topics(self) -> List[Dict[str, str]] | None:
+        """Topics of the log, None if they aren't known"""
+        if self.topics_json is None:
+            return None
+        return json.loads(self.topics_json)
+
 
 class Repository:
     """Manages a Mosaic Repository"""
@@ -41,6 +70,8 @@ class Repository:
     # This directory must contain a .mosaic dir, and there must not exist
     # any other .mosiac as a descendant
     root_path: Path
+    # Shared by the sessions of the repository, see _get_engine
+    _engine = None
 
     @staticmethod
     def find_repo_root(cwd: Path) -> Optional[Path]:
@@ -77,20 +108,105 @@ class Repository:
                 raise MosaicRepoException(f"{cwd} is not in a mosaic repository")
 
             self.root_path = root_path
+            self._upgrade_schema()
 
     def _get_engine(self):
-        """Create a new _engine.Engine instance."""
-        db_path = self.root_path / MOSAIC_DIR / "index.db"
-        return create_engine(f"sqlite:///{db_path.as_posix()}")
+        """The _engine.Engine of the index, created on first use. Its
+        connections may be used from any thread, ex. by the server
+        """
+        if self._engine is None:
+            db_path = self.root_path / MOSAIC_DIR / "index.db"
+            self._engine = create_engine(
+                f"sqlite:///{db_path.as_posix()}",
+                connect_args={"check_same_thread": False},
+            )
+        return self._engine
+
+    def _upgrade_schema(self):
+        """Add the columns and indexes of LogInfo missing from an index created
+        by an older version of Mosaic. Their values are filled by the next
+        update_state.
+        """
+        engine = self._get_engine()
+        table = LogInfo.__table__
+        if not inspect(engine).has_table(table.name):
+            SQLModel.metadata.create_all(engine)
+            return
+
+        existing = {
+            column["name"] for column in inspect(engine).get_columns(table.name)
+        }
+        with engine.begin() as connection:
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    def _update_log_info(self, log_record: LogInfo, file_path: Path) -> bool:
+        """Refresh the file metadata of a log, and the metadata of its bag if it
+        has a rosbag2 metadata file. Only logs that changed since the last scan
+        are read.
+
+        Returns:
+            bool: Whether the record changed
+        """
+        stat = file_path.stat()
+        if (
+            log_record.name is not None
+            and log_record.size_bytes == stat.st_size
+            and log_record.mtime_ns == stat.st_mtime_ns
+        ):
+            return False
+
+        metadata_path = file_path.parent / BAG_METADATA_FILE
+        bag_path = file_path.parent if metadata_path.exists() else file_path
+        log_record.name = file_path.name
+        log_record.dir_path = bag_path.parent.relative_to(self.root_path).as_posix()
+        log_record.size_bytes = stat.st_size
+        log_record.mtime_ns = stat.st_mtime_ns
+        if metadata_path.exists():
+            topics, start_time_ns, duration_ns = self._read_bag_metadata(metadata_path)
+            log_record.topics_json = json.dumps(topics)
+            log_record.start_time_ns = start_time_ns
+            log_record.duration_ns = duration_ns
+        log_record.updated_ns = time.time_ns()
+        return True
+
+    @staticmethod
+    def _read_bag_metadata(
+        metadata_path: Path,
+    ) -> Tuple[List[Dict[str, str]], int | None, int | None]:
+        """Topics, start time and duration of a bag from its rosbag2 metadata"""
+        with open(metadata_path, "r") as metadata_file:
+            metadata: Dict[str, Any] = yaml.safe_load(metadata_file) or {}
+        info = metadata.get("rosbag2_bagfile_information", {})
+        topics = [
+            {
+                "name": topic["topic_metadata"]["name"],
+                "type": topic["topic_metadata"]["type"],
+            }
+            for topic in info.get("topics_with_message_count", [])
+        ]
+        start_time_ns = info.get("starting_time", {}).get("nanoseconds_since_epoch")
+        duration_ns = info.get("duration", {}).get("nanoseconds")
+        return topics, start_time_ns, duration_ns
 
     def update_state(self):
         """Recursively scan the repo for changes. Update the saved state.
+        Logs whose file was removed are removed from the state.
 
         TODO: For now this is one function, but once more complexities are added
         This will be broken into pieces
         """
         engine = self._get_engine()
         with Session(engine) as session:
+            found_log_paths = set()
             for dir_path, _, file_names in self.root_path.walk():
                 # Skip the .mosaic dir in the walk
                 if dir_path.stem == MOSAIC_DIR:
@@ -102,12 +218,16 @@ class Repository:
                     match file_path.suffix:
                         case ".mcap":
                             # Handle rosbags
+                            found_log_paths.add(file_posix_path)
                             log_record = session.get(LogInfo, file_posix_path)
 
                             if log_record is None:
                                 # New file: create and add a new entry
                                 log_record = LogInfo(log_path=file_posix_path)
                                 session.add(log_record)
+
+                            if self._update_log_info(log_record, file_path):
+                                session.add(log_record)
                         case ".json":
                             # Handle 'potential' bounding-box descriptor files
                             statement = select(LogInfo).where(
@@ -130,6 +250,7 @@ class Repository:
                                         if log_record:
                                             # If we know the log, update its gt
                                             log_record.gt_path = file_posix_path
+                                            log_record.updated_ns = time.time_ns()
                                             session.add(log_record)
                                 case 1:
                                     # Nothing to do, we already know this one
@@ -143,6 +264,10 @@ class Repository:
                             # We're not interested in other extensions for now
                             continue
 
+            for log_record in session.exec(select(LogInfo)).all():
+                if log_record.log_path not in found_log_paths:
+                    session.delete(log_record)
+
             # Commit all changes to the database at once
             session.commit()
 
@@ -156,6 +281,50 @@ class Repository:
 
             return logs
 
+    def get_log(self, log_path: Path) -> Optional[LogInfo]:
+        engine = self._get_engine()
+        with Session(engine) as session:
+            return session.get(LogInfo, log_path.as_posix())
+
+    def find_log(self, name: str) -> Optional[LogInfo]:
+        """Get a log by file name, the first by path if several have it"""
+        engine = self._get_engine()
+        with Session(engine) as session:
+            statement = (
+                select(LogInfo)
+                .where(LogInfo.name == name)
+                .order_by(LogInfo.log_path)
+                .limit(1)
+            )
+            return session.exec(statement).first()
+
+    def get_directory_logs(
+        self, dir_path: str, after: Optional[str] = None, limit: int = 100
+    ) -> Sequence[LogInfo]:
+        """Get a page of the logs of a directory, in the order of their path.
+        The next page starts after the log_path of the last log of this one.
+        """
+        engine = self._get_engine()
+        with Session(engine) as session:
+            statement = select(LogInfo).where(LogInfo.dir_path == dir_path)
+            if after is not None:
+                statement = statement.where(LogInfo.log_path > after)
+            statement = statement.order_by(LogInfo.log_path).limit(limit)
+            return session.exec(statement).all()
+
+    def get_directory_state(self, dir_path: str) -> Tuple[int, Optional[int]]:
+        """Get the number of logs of a directory and the last time one of them
+        changed, None if it has no logs. A listing of the directory is the same
+        as long as they are.
+        """
+        engine = self._get_engine()
+        with Session(engine) as session:
+            statement = select(func.count(), func.max(LogInfo.updated_ns)).where(
+                LogInfo.dir_path == dir_path
+            )
+            count, updated_ns = session.exec(statement).one()
+            return count, updated_ns
+
     def add_images(self, log_path: Path, img_dir_path: Path) -> None:
         """Add the path to extracted images for a given log"""
         engine = self._get_engine()
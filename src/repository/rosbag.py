@@ -1,15 +1,21 @@
-from typing import Self
+from typing import Iterator, List, Optional, Self
 from datetime import datetime
 from pathlib import Path
 import logging
 
-from rosbag2_py import SequentialReader, StorageOptions, ConverterOptions
+from rosbag2_py import (
+    SequentialReader,
+    StorageOptions,
+    ConverterOptions,
+    StorageFilter,
+)
 from rclpy.serialization import deserialize_message
-from sensor_msgs.msg import CompressedImage, CameraInfo
+from sensor_msgs.msg import CompressedImage, CameraInfo, PointCloud2
 
 SUPPORTED_MSGS = {
     "sensor_msgs/msg/CompressedImage": CompressedImage,
     "sensor_msgs/msg/CameraInfo": CameraInfo,
+    "sensor_msgs/msg/PointCloud2": PointCloud2,
 }
 
 
@@ -24,12 +30,20 @@ class BagReader:
        for topic, data, timestamp in bag:
            print(topic)
     ```
+
+    Only messages of `msg_types` are deserialized, the others are skipped.
+    Defaults to camera images only.
     """
 
     # The only currently supported storage id
     STORAGE_ID = "mcap"
 
-    def __init__(self, uri: Path):
+    def __init__(
+        self,
+        uri: Path,
+        topics: Optional[List[str]] = None,
+        msg_types: Optional[List[type]] = None,
+    ):
         # module logger
         self._logger = logging.getLogger(__name__)
 
@@ -40,10 +54,15 @@ class BagReader:
             uri=self._uri, storage_id=self.STORAGE_ID
         )
         self._converter_options = ConverterOptions("", "")
+        # When set, only messages on these topics are read from storage
+        self._topics = topics
+        self._msg_types = msg_types if msg_types else [CompressedImage]
 
     def __enter__(self) -> Self:
         self._logger.debug("Opening bag at %s", self._uri)
         self._reader.open(self._storage_options, self._converter_options)
+        if self._topics:
+            self._reader.set_filter(StorageFilter(topics=self._topics))
 
         # This hack allows us to use the topic name to import the needed class
         # See: https://github.com/ros2/rosbag2/issues/1692
@@ -88,52 +107,83 @@ class BagReader:
         return self
 
     def __next__(self) -> tuple[str, object, datetime]:
-        if self._reader.has_next():
+        # Messages that can't be deserialized are skipped
+        while self._reader.has_next():
             msg = self._reader.read_next()
             assert len(msg) == 3  # There is a topic, data and timestamp
             topic, serial_data, timestamp = msg
-            # We should have a mapping for this topic
-            assert topic in self._topic_to_def
-
-            # Deserialize using the python class (automatically imported) associated
-            # with that topic
-            data = None
-            try:
-                typ = self._topic_to_def[topic]
-                if typ is None:
-                    self._logger.debug(
-                        "Skipping message on unsupported topic %s", topic
-                    )
-                    return self.__next__()
-
-                if typ != CompressedImage:
-                    # TODO: LiDAR data will eventually be supported
-                    self._logger.debug(
-                        "Skipping non-compressed image message on topic %s (type=%s)",
-                        topic,
-                        typ,
-                    )
-                    return self.__next__()
-
-                data = deserialize_message(serial_data, typ)
-            except Exception as exc:
-                # If we can't deserialize, log at debug and skip this message
-                # Deserialization failures may be common if message types don't match
+
+            data = self.deserialize(topic, serial_data)
+            if data is None:
+                continue
+
+            dt_object = datetime.fromtimestamp(timestamp / 1_000_000_000)
+            self._logger.debug(
+                "Yielding %s from %s at %s",
+                type(data).__name__,
+                topic,
+                dt_object.isoformat(),
+            )
+            return topic, data, dt_object
+        raise StopIteration
+
+    def can_deserialize(self, topic: str) -> bool:
+        """Whether messages on this topic are deserialized by `deserialize`,
+        cheap enough to filter raw messages before keeping them around.
+        """
+        return self._topic_to_def.get(topic) in self._msg_types
+
+    def deserialize(self, topic: str, serial_data: bytes) -> object | None:
+        """Deserialize a message read with `iter_raw`
+
+        Returns:
+            object | None: The message, None if its type is not supported or it
+                failed to deserialize
+        """
+        # We should have a mapping for this topic
+        assert topic in self._topic_to_def
+
+        # Deserialize using the python class (automatically imported) associated
+        # with that topic
+        try:
+            typ = self._topic_to_def[topic]
+            if typ is None:
+                self._logger.debug("Skipping message on unsupported topic %s", topic)
+                return None
+
+            if typ not in self._msg_types:
                 self._logger.debug(
-                    "Failed to deserialize message on topic %s: %s",
+                    "Skipping message of a type not read on topic %s (type=%s)",
                     topic,
-                    exc,
-                    exc_info=True,
+                    typ,
                 )
-                return self.__next__()
+                return None
 
-            dt_object = datetime.fromtimestamp(timestamp / 1_000_000_000)
+            return deserialize_message(serial_data, typ)
+        except Exception as exc:
+            # If we can't deserialize, log at debug and skip this message
+            # Deserialization failures may be common if message types don't match
             self._logger.debug(
-                "Yielding CompressedImage from %s at %s", topic, dt_object.isoformat()
+                "Failed to deserialize message on topic %s: %s",
+                topic,
+                exc,
+                exc_info=True,
             )
-            return topic, data, dt_object
-        else:
-            raise StopIteration
+            return None
+
+    def iter_raw(self) -> Iterator[tuple[str, bytes, int]]:
+        """Iterate over (topic, serialized data, timestamp in ns) of every
+        message, from the current position, without deserializing anything.
+        """
+        while self._reader.has_next():
+            yield self._reader.read_next()
+
+    def seek(self, timestamp_ns: int) -> None:
+        """Move the read head so that the next message returned is the first
+        one with a timestamp >= timestamp_ns. The bag must already be open.
+        """
+        self._logger.debug("Seeking bag %s to %d", self._uri, timestamp_ns)
+        self._reader.seek(int(timestamp_ns))
 
     def print_metadata(self) -> None:  # pragma: no cover
         """Print the metadata for this bag"""
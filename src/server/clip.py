@@ -0,0 +1,199 @@
+"""
+Clip export
+src/server/clip.py
+
+A clip of a camera is cut from its HLS segments instead of being transcoded
+from the bag. Each segment is encoded on its own, so it starts with a keyframe
+and none of its frames reference another segment. The segments that the clip
+fully covers are remuxed into the MP4 as they are (stream copy). Only the
+segments that the clip starts or ends in are decoded, trimmed to the clip and
+encoded again.
+
+Segments are taken from an OnDemandProcessor, so they come from the buffer
+pool or the segment cache when they were already produced, and otherwise the
+plan of the camera seeks to the clip. The rest of the bag is never read.
+
+```python
+with open("clip.mp4", "wb") as output:
+    export_clip(processor, "/front/image_raw/compressed", 40e9, 60e9, output)
+```
+"""
+
+import io
+from fractions import Fraction
+from typing import IO, List
+
+import av
+from av import VideoFrame
+
+from src.server.processor import OnDemandProcessor
+
+MP4_MEDIA_TYPE = "video/mp4"
+
+
+class ClipPart:
+    """Frames [first_frame, end_frame) of a segment, the whole segment when
+    `is_complete`
+    """
+
+    def __init__(
+        self, segment_idx: int, first_frame: int, end_frame: int, frame_cnt: int
+    ) -> None:
+        self.segment_idx = segment_idx
+        self.first_frame = first_frame
+        self.end_frame = end_frame
+        self.is_complete = first_frame == 0 and end_frame == frame_cnt
+
+    def get_frame_count(self) -> int:
+        return self.end_frame - self.first_frame
+
+
+def get_clip_parts(
+    processor: OnDemandProcessor, topic_name: str, start_ns: int, end_ns: int
+) -> List[ClipPart]:
+    """Segments of a video topic holding the frames from `start_ns` to `end_ns`
+
+    Args:
+        processor (OnDemandProcessor): Processor serving the topic
+        topic_name (str): Video topic
+        start_ns (int): Start of the clip, from the start of the recording
+        end_ns (int): End of the clip, excluded
+
+    Returns:
+        List[ClipPart]: Parts of the clip in order, empty if it has no frame
+    """
+    stage = processor.get_video_stage(topic_name)
+    if stage is None:
+        raise KeyError(f"Topic {topic_name} is not a video")
+    layout = stage.layout
+
+    parts = []
+    for segment_idx in range(layout.get_segment_count()):
+        offset_ns = layout.get_segment_offset_ns(segment_idx)
+        frame_cnt = layout.get_frame_count(segment_idx)
+        # Frames are kept when they start within the clip
+        first_frame = -(-(start_ns - offset_ns) // layout.per_frame_duration)
+        end_frame = -(-(end_ns - offset_ns) // layout.per_frame_duration)
+        first_frame = min(max(first_frame, 0), frame_cnt)
+        end_frame = min(max(end_frame, 0), frame_cnt)
+        if first_frame < end_frame:
+            parts.append(ClipPart(segment_idx, first_frame, end_frame, frame_cnt))
+    return parts
+
+
+def _trim_segment(data: bytes, part: ClipPart, fps: int, bitrate: int) -> bytes:
+    """Encode the frames of a part of a segment as a segment of their own"""
+    output_buffer = io.BytesIO()
+    with av.open(io.BytesIO(data), mode="r") as input_container:
+        with av.open(output_buffer, mode="w", format="mpegts") as output_container:
+            stream = output_container.add_stream("libx264", rate=fps)
+            stream.pix_fmt, stream.bit_rate = "yuv420p", bitrate
+            for idx, frame in enumerate(input_container.decode(video=0)):
+                if idx < part.first_frame:
+                    continue
+                if idx >= part.end_frame:
+                    break
+                if idx == part.first_frame:
+                    stream.width, stream.height = frame.width, frame.height
+                # Drop the timestamps of the source, frames are numbered again
+                frame = VideoFrame.from_ndarray(
+                    frame.to_ndarray(format="rgb24"), format="rgb24"
+                )
+                frame.pts = idx - part.first_frame
+                for packet in stream.encode(frame):
+                    output_container.mux(packet)
+            for packet in stream.encode(None):
+                output_container.mux(packet)
+    return output_buffer.getvalue()
+
+
+def _remux(
+    output_container: av.container.OutputContainer,
+    output_stream: av.video.stream.VideoStream | None,
+    data: bytes,
+    start: Fraction,
+) -> av.video.stream.VideoStream:
+    """Append the packets of a segment to the MP4, its first frame presented
+    `start` seconds into the clip
+
+    Returns:
+        VideoStream: The stream of the MP4, created from the first segment
+    """
+    with av.open(io.BytesIO(data), mode="r") as input_container:
+        input_stream = input_container.streams.video[0]
+        packets = [
+            packet
+            for packet in input_container.demux(input_stream)
+            if packet.dts is not None
+        ]
+        if output_stream is None:
+            output_stream = output_container.add_stream_from_template(input_stream)
+
+        if len(packets) == 0:
+            return output_stream
+        # Timestamps of the segments follow the recording, not the clip
+        shift = round(start / input_stream.time_base) - min(p.pts for p in packets)
+        for packet in packets:
+            packet.pts += shift
+            packet.dts += shift
+            packet.stream = output_stream
+            output_container.mux(packet)
+    return output_stream
+
+
+def export_clip(
+    processor: OnDemandProcessor,
+    topic_name: str,
+    start_ns: int,
+    end_ns: int,
+    output: IO[bytes],
+    rendition: str | None = None,
+) -> int:
+    """Write the frames of a video topic from `start_ns` to `end_ns`, from the
+    start of the recording, to `output` as a MP4, see the module docstring
+
+    Args:
+        processor (OnDemandProcessor): Processor serving the topic
+        topic_name (str): Video topic
+        start_ns (int): Start of the clip
+        end_ns (int): End of the clip, excluded
+        output (IO[bytes]): Seekable file the MP4 is written to
+        rendition (str | None): Rendition to export, the best one if unset
+
+    Returns:
+        int: Number of frames of the clip
+    """
+    stage = processor.get_video_stage(topic_name)
+    if stage is None:
+        raise KeyError(f"Topic {topic_name} is not a video")
+    bitrate = stage.bitrate
+    if rendition is not None:
+        matches = [
+            r for r in processor.get_renditions(topic_name) if r.name == rendition
+        ]
+        if len(matches) == 0:
+            raise KeyError(f"Topic {topic_name} has no rendition {rendition}")
+        bitrate = matches[0].bitrate
+
+    parts = get_clip_parts(processor, topic_name, start_ns, end_ns)
+    if len(parts) == 0:
+        raise ValueError(f"No frame of {topic_name} in [{start_ns}, {end_ns})")
+
+    frame_cnt = 0
+    with av.open(output, mode="w", format="mp4") as output_container:
+        output_stream = None
+        for part in parts:
+            # The playhead of the clients is left alone, and nothing is
+            # prefetched past the clip
+            segment = processor.get_segment(
+                topic_name, part.segment_idx, prefetch=False
+            )
+            assert segment is not None
+            data = segment.data if rendition is None else segment.renditions[rendition]
+            if not part.is_complete:
+                data = _trim_segment(data, part, stage.fps, bitrate)
+            output_stream = _remux(
+                output_container, output_stream, data, Fraction(frame_cnt, stage.fps)
+            )
+            frame_cnt += part.get_frame_count()
+    return frame_cnt
@@ -1 +1,5 @@
 from .stages import *  # noqa
+from .pointcloud import *  # noqa
+from .undistort import *  # noqa
+from .depth import *  # noqa
+from .compression import *  # noqa
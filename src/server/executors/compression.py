@@ -0,0 +1,132 @@
+"""
+Payload codecs
+src/server/executors/compression.py
+
+Codecs of CompressionStage. zstd and lz4 are optional dependencies (the
+`compression` extra), deflate (zlib) is always available and is the fallback
+when neither is installed.
+
+The name of a codec is also the token of its HTTP Content-Encoding, so that a
+client accepting it is served the compressed bytes as is. lz4 has no
+registered token, only clients asking for it explicitly get it.
+"""
+
+import hashlib
+import logging
+import zlib
+from typing import Dict, List
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+ZSTD = "zstd"
+LZ4 = "lz4"
+DEFLATE = "deflate"
+
+
+def get_available_codecs() -> List[str]:
+    """Codecs that can be used here, the preferred one first"""
+    codecs = []
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    if lz4 is not None:
+        codecs.append(LZ4)
+    codecs.append(DEFLATE)
+    return codecs
+
+
+# Best codec available, see get_available_codecs
+DEFAULT_CODEC = get_available_codecs()[0]
+if DEFAULT_CODEC == DEFLATE:
+    logging.getLogger(__name__).warning(
+        "zstandard and lz4 are not installed (extra 'compression'), payloads "
+        "are compressed with deflate"
+    )
+else:
+    logging.getLogger(__name__).info("Payloads are compressed with %s", DEFAULT_CODEC)
+
+
+class CompressionDictionary:
+    """A zstd dictionary, trained on payloads similar to the ones it compresses.
+    Small payloads compress much better with one, as they don't have to hold
+    the statistics of their content themselves.
+
+    Dictionaries are registered by id when created, payloads compressed with
+    one record its id and find it back on decompression, see `get_dictionary`.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.id = hashlib.sha256(data).hexdigest()[:16]
+        _dictionaries[self.id] = self
+
+    def get_zstd_dict(self) -> "zstandard.ZstdCompressionDict":
+        assert zstandard is not None, "zstd dictionaries require zstandard"
+        return zstandard.ZstdCompressionDict(self.data)
+
+
+_dictionaries: Dict[str, CompressionDictionary] = {}
+
+
+def get_dictionary(dictionary_id: str) -> CompressionDictionary:
+    if dictionary_id not in _dictionaries:
+        raise KeyError(f"Unknown compression dictionary {dictionary_id}")
+    return _dictionaries[dictionary_id]
+
+
+def train_dictionary(
+    samples: List[bytes], size: int = 16 * 1024
+) -> CompressionDictionary:
+    """Train a zstd dictionary of at most `size` bytes on sample payloads"""
+    assert zstandard is not None, "zstd dictionaries require zstandard"
+    return CompressionDictionary(zstandard.train_dictionary(size, samples).as_bytes())
+
+
+def compress(
+    data: bytes,
+    codec: str,
+    level: int | None = None,
+    dictionary: CompressionDictionary | None = None,
+) -> bytes:
+    """Compress a payload, at the default level of the codec if `level` is None"""
+    if codec == ZSTD:
+        assert zstandard is not None, "zstd requires zstandard"
+        compressor = zstandard.ZstdCompressor(
+            level=level if level is not None else 3,
+            dict_data=dictionary.get_zstd_dict() if dictionary else None,
+        )
+        return compressor.compress(data)
+
+    assert dictionary is None, f"{codec} doesn't support dictionaries"
+    if codec == LZ4:
+        assert lz4 is not None, "lz4 requires lz4"
+        return lz4.frame.compress(data, compression_level=level or 0)
+    if codec == DEFLATE:
+        return zlib.compress(data, level if level is not None else -1)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(data: bytes, codec: str, dictionary_id: str | None = None) -> bytes:
+    """Inverse of compress"""
+    if codec == ZSTD:
+        assert zstandard is not None, "zstd requires zstandard"
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=(
+                get_dictionary(dictionary_id).get_zstd_dict() if dictionary_id else None
+            )
+        )
+        # The content size is in the frame header, written by compress
+        return decompressor.decompress(data)
+    if codec == LZ4:
+        assert lz4 is not None, "lz4 requires lz4"
+        return lz4.frame.decompress(data)
+    if codec == DEFLATE:
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec {codec}")
@@ -0,0 +1,121 @@
+"""
+Depth cameras
+src/server/executors/depth.py
+
+compressedDepth topics (compressed_depth_image_transport) publish
+CompressedImage messages whose data is a 12 bytes header followed by a 16 bit
+PNG. The header holds the format of the depth and, for 32FC1 depth, the two
+parameters of its quantization: the PNG then stores the inverse depth,
+depth = a / (value - b), in meters. 16UC1 depth is stored as is, in mm.
+
+DepthStage renders depth as colour for the H.264 pipeline. Every one of the
+65536 values of the PNG is mapped to a colour once, by a lookup table built
+per colormap, depth range and quantization, so a frame costs a single
+vectorized index. Only the messages the video keeps are decoded.
+"""
+
+import struct
+from functools import lru_cache
+from typing import Any, Dict, Tuple
+import cv2
+import numpy as np
+from sensor_msgs import msg
+from .stages import FrameDecoderStage
+
+# Suffix of the topics of compressed_depth_image_transport
+COMPRESSED_DEPTH_SUFFIX = "compressedDepth"
+
+# enum compressionFormat, float depthQuantA, float depthQuantB
+DEPTH_HEADER = struct.Struct("<iff")
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def is_depth_topic(topic_name: str) -> bool:
+    return topic_name.endswith(COMPRESSED_DEPTH_SUFFIX)
+
+
+def decode_compressed_depth(
+    compressed_image: msg.CompressedImage,
+) -> Tuple[np.ndarray, Tuple[float, float] | None]:
+    """Decode the PNG of a compressedDepth message
+
+    Returns:
+        Tuple[np.ndarray, Tuple[float, float] | None]: The (H, W) uint16 PNG
+            values, and the (a, b) quantization of 32FC1 depth or None if the
+            values are depths in mm
+    """
+    data = bytes(compressed_image.data)
+    quantization = None
+    # Messages of old versions of the transport have no header
+    if not data.startswith(_PNG_SIGNATURE):
+        _, quant_a, quant_b = DEPTH_HEADER.unpack_from(data)
+        header_size = DEPTH_HEADER.size
+        data = data[header_size:]
+        if "32FC1" in compressed_image.format:
+            quantization = (quant_a, quant_b)
+
+    depth = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if depth is None or depth.dtype != np.uint16:
+        raise ValueError(f"Not a 16 bit depth PNG, format {compressed_image.format}")
+    return depth, quantization
+
+
+@lru_cache(maxsize=16)
+def get_depth_lut(
+    max_depth_m: float,
+    colormap: int = cv2.COLORMAP_TURBO,
+    quantization: Tuple[float, float] | None = None,
+) -> np.ndarray:
+    """Colour of every PNG value of a depth image, see decode_compressed_depth
+
+    Depths from 0 to `max_depth_m` span the colormap, further ones saturate it
+    and missing ones (value 0) are black.
+
+    Returns:
+        np.ndarray: (65536, 3) uint8 RGB table
+    """
+    values = np.arange(65536, dtype=np.float64)
+    if quantization is None:
+        depth_m = values / 1000
+    else:
+        quant_a, quant_b = quantization
+        with np.errstate(divide="ignore"):
+            depth_m = quant_a / (values - quant_b)
+
+    levels = np.clip(depth_m / max_depth_m * 255, 0, 255).astype(np.uint8)
+    palette = cv2.applyColorMap(np.arange(256, dtype=np.uint8), colormap)
+    lut = cv2.cvtColor(palette, cv2.COLOR_BGR2RGB).reshape(256, 3)[levels]
+    lut[(values == 0) | ~np.isfinite(depth_m) | (depth_m <= 0)] = 0
+    # The index of a frame must not write to the shared table
+    lut.flags.writeable = False
+    return lut
+
+
+class DepthStage(FrameDecoderStage):
+    """Decodes the depth images kept by the stage above, from a
+    McapReaderStage child reading a compressedDepth topic, and colours them,
+    see get_depth_lut and FrameDecoderStage.
+
+    Methods:
+        decode_frame(compressed_image) -> RGB image as np.ndarray
+    """
+
+    def __init__(
+        self, max_depth_m: float = 10.0, colormap: int = cv2.COLORMAP_TURBO
+    ) -> None:
+        super().__init__()
+        self.max_depth_m = max_depth_m
+        self.colormap = colormap
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "max_depth_m": self.max_depth_m,
+            "colormap": self.colormap,
+        }
+
+    def decode_frame(self, compressed_image: msg.CompressedImage) -> np.ndarray:
+        depth, quantization = decode_compressed_depth(compressed_image)
+        lut = get_depth_lut(self.max_depth_m, self.colormap, quantization)
+        return lut[depth]
@@ -0,0 +1,386 @@
+"""
+LiDAR point cloud segments
+src/server/executors/pointcloud.py
+
+A point cloud segment packs every cloud of a time window of a LiDAR topic.
+Coordinates are quantized to int16 relative to the center of the bounding box
+of the segment, with the finest step that keeps the whole segment in range,
+and intensities to uint8. A point takes 7 bytes instead of the 16 of float32
+xyz + intensity, and of the 32 or more of a raw PointCloud2 point.
+
+Intensities have no common range, drivers publish them as 0..1 floats, 0..255
+or 16-bit counts (ex. Ouster). They are normalized per segment instead: the
+256 steps span the intensities of the segment, from its lowest to its highest,
+and the header keeps the mapping back to the intensities of the driver.
+
+Layout, little endian:
+
+    header | frame offsets | frame point counts | xyz | intensity
+
+    header: magic, version, reserved, segment start (ns), frame count,
+        origin x, y, z (float32), scale (float32, meters per step),
+        lowest intensity (float32), intensity step (float32)
+    frame offsets: int64 per frame, ns from the segment start
+    frame point counts: uint32 per frame
+    xyz: int16 x, y, z per point, the frames one after the other
+    intensity: uint8 per point
+
+A point is at origin + xyz * scale, its intensity is lowest intensity +
+intensity * intensity step.
+
+With a VoxelLodStage between the reader and the PointCloudStage, a segment
+also holds one packed cloud per level of detail in its renditions, so that a
+client can fetch the coarse tier first and refine.
+"""
+
+import math
+import struct
+import numpy as np
+from typing import Any, Dict, List, Tuple
+from sensor_msgs import msg
+from src.server.models import Topic
+from src.repository.pointcloud import read_points
+from .stages import AbstractStage, SegmentedStage, SegmentNode
+
+POINT_CLOUD_MAGIC = b"MPCS"
+POINT_CLOUD_VERSION = 2
+POINT_CLOUD_MEDIA_TYPE = "application/octet-stream"
+# Finest quantization step, in meters
+MIN_RESOLUTION = 0.001
+
+_SEGMENT_HEADER = struct.Struct("<4sHHqIffffff")
+_INT16_MAX = np.iinfo(np.int16).max
+_UINT8_MAX = np.iinfo(np.uint8).max
+
+# Points of a decoded cloud, see decode_point_cloud
+POINT_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("intensity", "<f4")])
+
+
+class LodTier:
+    """A level of detail of the LiDAR segments, a point per occupied voxel"""
+
+    def __init__(self, name: str, voxel_size: float) -> None:
+        self.name = name
+        # Edge of a voxel, in meters
+        self.voxel_size = voxel_size
+
+
+DEFAULT_LOD_TIERS = [
+    LodTier("coarse", 0.5),
+    LodTier("medium", 0.2),
+    LodTier("fine", 0.05),
+]
+
+
+class PointCloudFrame:
+    """A cloud of an unpacked segment, `xyz` is a (N, 3) float32 array and
+    `intensity` a (N,) float32 array in the range of the driver
+    """
+
+    def __init__(self, timestamp_ns: int, xyz: np.ndarray, intensity: np.ndarray):
+        self.timestamp_ns = timestamp_ns
+        self.xyz = xyz
+        self.intensity = intensity
+
+
+def decode_point_cloud(cloud: msg.PointCloud2) -> np.ndarray:
+    """Points of a cloud without NaN, as a POINT_DTYPE array. The intensity is
+    0 when the cloud has no intensity field.
+    """
+    cloud_field_names = {field.name for field in cloud.fields}
+    names = [
+        name
+        for name in POINT_DTYPE.names
+        if name != "intensity" or name in cloud_field_names
+    ]
+    source = read_points(cloud, names, skip_nans=True)
+
+    points = np.zeros(len(source), POINT_DTYPE)
+    for name in names:
+        points[name] = source[name]
+    return points
+
+
+def voxel_downsample(points: np.ndarray, voxel_size: float) -> np.ndarray:
+    """Keep a point per voxel of a grid of `voxel_size` meters, the centroid of
+    the points in it, with their mean intensity
+
+    Args:
+        points (np.ndarray): POINT_DTYPE array, see decode_point_cloud
+        voxel_size (float): Edge of a voxel, in meters
+
+    Returns:
+        np.ndarray: POINT_DTYPE array, a point per occupied voxel
+    """
+    if len(points) == 0:
+        return points
+
+    # One row per axis, reductions along contiguous rows are the fastest
+    voxels = np.floor(
+        np.stack([points["x"], points["y"], points["z"]]) / voxel_size
+    ).astype(np.int64)
+    voxels -= voxels.min(axis=1, keepdims=True)
+    extent = voxels.max(axis=1) + 1
+    # A single integer key per voxel, np.unique on rows is much slower
+    keys = (voxels[0] * extent[1] + voxels[1]) * extent[2] + voxels[2]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+    downsampled = np.zeros(len(counts), POINT_DTYPE)
+    for name in POINT_DTYPE.names:
+        downsampled[name] = (
+            np.bincount(inverse, weights=points[name], minlength=len(counts)) / counts
+        )
+    return downsampled
+
+
+def pack_point_clouds(start_ns: int, frames: List[Tuple[int, np.ndarray]]) -> bytes:
+    """Pack the clouds of a segment, see the module docstring for the layout
+
+    Args:
+        start_ns (int): Start of the segment
+        frames (List[Tuple[int, np.ndarray]]): (timestamp in ns, POINT_DTYPE
+            array) of every cloud of the segment
+
+    Returns:
+        bytes: The packed segment
+    """
+    offsets = np.array([ts - start_ns for ts, _ in frames], np.int64)
+    counts = np.array([len(points) for _, points in frames], np.uint32)
+    points = (
+        np.concatenate([points for _, points in frames])
+        if len(frames) > 0
+        else np.zeros(0, POINT_DTYPE)
+    )
+    xyz = np.stack([points["x"], points["y"], points["z"]], axis=1).astype(np.float64)
+
+    origin = np.zeros(3, np.float32)
+    scale = np.float32(MIN_RESOLUTION)
+    if len(points) > 0:
+        low, high = xyz.min(axis=0), xyz.max(axis=0)
+        origin = ((low + high) / 2).astype(np.float32)
+        half_extent = float((high - low).max()) / 2
+        scale = np.float32(max(half_extent / _INT16_MAX, MIN_RESOLUTION))
+
+    quantized = np.clip(np.rint((xyz - origin) / scale), -_INT16_MAX, _INT16_MAX)
+
+    # Whatever the range of the driver, the segment uses all 256 steps
+    intensity_low = np.float32(0)
+    intensity_step = np.float32(1)
+    if len(points) > 0:
+        intensity_low = points["intensity"].min()
+        intensity_high = points["intensity"].max()
+        if intensity_high > intensity_low:
+            intensity_step = np.float32((intensity_high - intensity_low) / _UINT8_MAX)
+    intensity = np.clip(
+        np.rint((points["intensity"] - intensity_low) / intensity_step), 0, _UINT8_MAX
+    )
+
+    header = _SEGMENT_HEADER.pack(
+        POINT_CLOUD_MAGIC,
+        POINT_CLOUD_VERSION,
+        0,
+        start_ns,
+        len(frames),
+        *origin.tolist(),
+        float(scale),
+        float(intensity_low),
+        float(intensity_step),
+    )
+    return b"".join(
+        [
+            header,
+            offsets.tobytes(),
+            counts.tobytes(),
+            quantized.astype("<i2").tobytes(),
+            intensity.astype(np.uint8).tobytes(),
+        ]
+    )
+
+
+def unpack_point_clouds(data: bytes) -> Tuple[int, List[PointCloudFrame]]:
+    """Inverse of pack_point_clouds, up to the quantization
+
+    Returns:
+        Tuple[int, List[PointCloudFrame]]: Start of the segment in ns, and its
+            clouds
+    """
+    (
+        magic,
+        version,
+        _,
+        start_ns,
+        frame_cnt,
+        *origin,
+        scale,
+        intensity_low,
+        intensity_step,
+    ) = _SEGMENT_HEADER.unpack_from(data)
+    if magic != POINT_CLOUD_MAGIC or version != POINT_CLOUD_VERSION:
+        raise ValueError(f"Not a point cloud segment of version {POINT_CLOUD_VERSION}")
+
+    offset = _SEGMENT_HEADER.size
+    offsets = np.frombuffer(data, "<i8", frame_cnt, offset)
+    offset += offsets.nbytes
+    counts = np.frombuffer(data, "<u4", frame_cnt, offset)
+    offset += counts.nbytes
+    point_cnt = int(counts.sum())
+    quantized = np.frombuffer(data, "<i2", point_cnt * 3, offset).reshape(-1, 3)
+    offset += quantized.nbytes
+    quantized_intensity = np.frombuffer(data, np.uint8, point_cnt, offset)
+    intensity = quantized_intensity * np.float32(intensity_step) + np.float32(
+        intensity_low
+    )
+
+    xyz = quantized * np.float32(scale) + np.array(origin, np.float32)
+    ends = np.cumsum(counts, dtype=np.int64)
+    frames = [
+        PointCloudFrame(
+            start_ns + int(offsets[idx]), xyz[begin:end], intensity[begin:end]
+        )
+        for idx, (begin, end) in enumerate(zip(ends - counts, ends))
+    ]
+    return start_ns, frames
+
+
+class LodFrame:
+    """A decoded cloud and its downsampled versions, by LodTier name"""
+
+    def __init__(self, points: np.ndarray, tiers: Dict[str, np.ndarray]) -> None:
+        self.points = points
+        self.tiers = tiers
+
+
+class VoxelLodStage(AbstractStage):
+    """Decodes the clouds pulled from the child executor, a McapReaderStage,
+    and downsamples each one at every tier, see voxel_downsample.
+
+    Methods:
+        next(topic) -> (LodFrame, timestamp in ns) of the next cloud
+    """
+
+    def __init__(self, tiers: List[LodTier] = DEFAULT_LOD_TIERS) -> None:
+        super().__init__()
+        self.tiers = tiers
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "tiers": [[tier.name, tier.voxel_size] for tier in self.tiers],
+        }
+
+    def next(self, topic: Topic) -> Tuple[LodFrame, int] | None:
+        assert self.child_executor is not None
+        val = self.child_executor.next(topic)
+        if val is None:
+            return None
+        cloud, ts = val
+        points = decode_point_cloud(cloud)
+        tiers = {
+            tier.name: voxel_downsample(points, tier.voxel_size) for tier in self.tiers
+        }
+        return LodFrame(points, tiers), ts
+
+
+class PointCloudStage(SegmentedStage):
+    """Packs the clouds of a LiDAR topic into segments of `segment_size`
+    seconds, see pack_point_clouds. The clouds are pulled from the child
+    executor, a McapReaderStage.
+
+    Like H264ConvertorStage, segments are aligned to the first message of the
+    topic unless `start_ns` is given, which lets `seek_segment` produce any
+    segment on its own. A window without clouds gives an empty segment, so
+    that segment indices always map to the same window of the recording.
+
+    When the child is a VoxelLodStage every tier of the segment is packed too,
+    and stored in the renditions of the segment under the name of its tier.
+    """
+
+    def __init__(
+        self, duration: int, start_ns: int | None = None, segment_size: int = 2
+    ) -> None:
+        super().__init__()
+        self._duration = duration
+        self.segment_size = segment_size
+        self.segment_duration_ns = segment_size * int(1e9)
+        self._start_ns = start_ns
+        self._recording_start_ns = start_ns
+        self._current_segment_idx = 0
+        # Cloud read past the end of the previous segment
+        self._pending: Tuple[msg.PointCloud2 | LodFrame, int] | None = None
+
+    def get_segment_count(self) -> int:
+        return math.ceil(self._duration / self.segment_duration_ns)
+
+    def get_lod_tiers(self) -> List[LodTier]:
+        if isinstance(self.child_executor, VoxelLodStage):
+            return self.child_executor.tiers
+        return []
+
+    def get_segment_seconds(self, segment_idx: int) -> float:
+        remaining_ns = self._duration - segment_idx * self.segment_duration_ns
+        return max(0, min(self.segment_duration_ns, remaining_ns)) / 1e9
+
+    def seek_segment(self, segment_idx: int) -> None:
+        assert self.child_executor is not None
+        assert self._start_ns is not None, "seek requires a fixed start_ns"
+        self.child_executor.seek(
+            self._start_ns + segment_idx * self.segment_duration_ns
+        )
+        self._pending = None
+        self._current_segment_idx = segment_idx
+
+    def get_last_segment_start_ns(self) -> int:
+        assert self._recording_start_ns is not None
+        return (
+            self._recording_start_ns
+            + (self._current_segment_idx - 1) * self.segment_duration_ns
+        )
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "format": POINT_CLOUD_VERSION,
+            "segment_size": self.segment_size,
+            "start_ns": self._start_ns,
+        }
+
+    def next(self, topic: Topic) -> SegmentNode | None:
+        assert self.child_executor is not None
+
+        if self._current_segment_idx >= self.get_segment_count():
+            return None
+
+        if self._pending is None:
+            self._pending = self.child_executor.next(topic)
+        if self._recording_start_ns is None:
+            if self._pending is None:
+                return None
+            self._recording_start_ns = self._pending[1]
+
+        segment_start_ns = (
+            self._recording_start_ns
+            + self._current_segment_idx * self.segment_duration_ns
+        )
+        segment_end_ns = segment_start_ns + self.segment_duration_ns
+
+        frames: List[Tuple[int, LodFrame]] = []
+        while self._pending is not None and self._pending[1] < segment_end_ns:
+            self._check_cancelled()
+            payload, ts = self._pending
+            if ts >= segment_start_ns:
+                if not isinstance(payload, LodFrame):
+                    payload = LodFrame(decode_point_cloud(payload), {})
+                frames.append((ts, payload))
+            self._pending = self.child_executor.next(topic)
+
+        self._current_segment_idx += 1
+        data = pack_point_clouds(
+            segment_start_ns, [(ts, frame.points) for ts, frame in frames]
+        )
+        renditions = {
+            tier.name: pack_point_clouds(
+                segment_start_ns, [(ts, frame.tiers[tier.name]) for ts, frame in frames]
+            )
+            for tier in self.get_lod_tiers()
+        }
+        return SegmentNode(data=data, renditions=renditions)
@@ -1,15 +1,22 @@
+import asyncio
 import av
 import io
+import logging
+import os
+import tempfile
+import threading
 import numpy as np
 import cv2
 import math
 from abc import ABC, abstractmethod
 from pathlib import Path
 from av import VideoFrame
-from typing import Dict, Deque, Tuple
+from typing import IO, Any, Dict, Deque, Iterable, Iterator, List, Set, Tuple
 from collections import deque
+from concurrent.futures import Executor
 from src.server.models import Topic
 from src.repository.rosbag import BagReader
+from .compression import DEFAULT_CODEC, CompressionDictionary, compress
 from sensor_msgs import msg
 
 
@@ -17,16 +24,127 @@ class SegmentNode:
     """A single node of data that is stored in
     the buffer pool. The `data` here is bytes, so it could
     be an video or a lidar etc.
+
+    A stage producing several variants of the same segment, ex. one video per
+    bitrate, stores them by name in `renditions`, `data` then holds the best one.
+
+    Compressed payloads record their codec in `encoding`, and the id of the
+    dictionary they were compressed with if any, see CompressionStage.
     """
 
-    def __init__(self, data: bytes):
+    def __init__(
+        self,
+        data: bytes,
+        renditions: Dict[str, bytes] | None = None,
+        encoding: str | None = None,
+        dictionary_id: str | None = None,
+    ):
         self.data = data
+        self.renditions: Dict[str, bytes] = renditions if renditions else {}
+        self.encoding = encoding
+        self.dictionary_id = dictionary_id
+
+
+class Batch:
+    """Columnar batch of consecutive items of one topic, `timestamps` is an
+    int64 array of the ns timestamps and `payloads` holds the matching items.
+    """
+
+    def __init__(self, timestamps: np.ndarray, payloads: List[object]) -> None:
+        assert len(timestamps) == len(payloads)
+        self.timestamps = timestamps
+        self.payloads = payloads
+
+    def __len__(self) -> int:
+        return len(self.payloads)
+
+    @classmethod
+    def from_lists(cls, timestamps: List[int], payloads: List[object]) -> "Batch":
+        return cls(np.array(timestamps, dtype=np.int64), payloads)
+
+
+class StageCancelledError(Exception):
+    """Raised inside a stage whose cancel event was set, the stage is left in an
+    unknown state and must be seeked before being used again.
+    """
+
+
+def _first_at_or_after(timestamps: np.ndarray, bound: int) -> int:
+    """Index of the first timestamp >= bound, len(timestamps) if there is none"""
+    mask = timestamps >= bound
+    return int(np.argmax(mask)) if mask.any() else len(timestamps)
+
+
+class Rendition:
+    """One rung of a bitrate ladder, the width follows the aspect ratio of the
+    source. A source smaller than `height` is never upscaled.
+    """
+
+    def __init__(self, name: str, height: int, bitrate: int) -> None:
+        self.name = name
+        self.height = height
+        self.bitrate = bitrate
+
+    def get_size(self, src_width: int, src_height: int) -> Tuple[int, int]:
+        height = min(self.height, src_height)
+        width = round(src_width * height / src_height)
+        # yuv420p needs even dimensions
+        return width - width % 2, height - height % 2
+
+
+DEFAULT_RENDITIONS = [
+    Rendition("1080p", 1080, 5_000_000),
+    Rendition("720p", 720, 2_800_000),
+    Rendition("360p", 360, 800_000),
+]
+
+
+class SegmentLayout:
+    """Maps a recording onto fixed length segments made of whole frames.
+
+    Every segment except the last holds `frames_per_segment` frames, so the
+    layout of a recording (and so a playlist) can be computed from its
+    duration alone, without reading a single message.
+    """
+
+    def __init__(self, duration: int, fps: int = 30, segment_size: int = 2) -> None:
+        self.duration = duration
+        self.fps = fps
+        self.segment_size = segment_size
+        self.per_frame_duration = int(1e9 / fps)
+        self.segment_duration_ns = segment_size * int(1e9)
+        self.frames_per_segment = math.ceil(
+            self.segment_duration_ns / self.per_frame_duration
+        )
+
+    def get_segment_count(self) -> int:
+        return math.ceil(
+            self.duration / (self.frames_per_segment * self.per_frame_duration)
+        )
+
+    def get_segment_offset_ns(self, segment_idx: int) -> int:
+        """Offset of the first frame of a segment from the recording start"""
+        return segment_idx * self.frames_per_segment * self.per_frame_duration
+
+    def get_frame_count(self, segment_idx: int) -> int:
+        remaining_ns = self.duration - self.get_segment_offset_ns(segment_idx)
+        if segment_idx < 0 or remaining_ns <= 0:
+            return 0
+        return min(
+            self.frames_per_segment, math.ceil(remaining_ns / self.per_frame_duration)
+        )
+
+    def get_segment_seconds(self, segment_idx: int) -> float:
+        return self.get_frame_count(segment_idx) / self.fps
 
 
 class AbstractStage(ABC):
 
+    STAGE_VERSION = 1
+
     def __init__(self) -> None:
         self.child_executor: AbstractStage | None = None
+        self._cancel_event: threading.Event | None = None
 
     def set_child_executor(self, child_executor):
         self.child_executor = child_executor
@@ -35,59 +153,369 @@ class AbstractStage(ABC):
     def next(self, topic: Topic):
         pass
 
+    async def anext(self, topic: Topic, executor: Executor | None = None):
+        """`next` for asyncio code. The blocking work (bag IO, decode, encode)
+        runs on `executor`, the default executor of the loop if None, so its
+        size bounds how many stages run at once.
+
+        Cancelling the awaiting task doesn't interrupt `next`, set the cancel
+        event of the stage for that, see `set_cancel_event`.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.next, topic)
+
+    def set_cancel_event(self, cancel_event: threading.Event | None) -> None:
+        """Once `cancel_event` is set, long running calls of the stage give up
+        with a StageCancelledError at their next check, instead of finishing
+        work nobody waits for anymore.
+        """
+        self._cancel_event = cancel_event
+
+    def _check_cancelled(self) -> None:
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise StageCancelledError()
+
+    def next_batch(self, topic: Topic, max_items: int) -> Batch | None:
+        """Up to max_items next items of the topic at once, None once it is
+        exhausted. Saves a python call per item through every stage on high
+        rate topics.
+
+        The default adapter calls `next` until the batch is full, it expects
+        `next` to return (payload, timestamp_ns) tuples. Stages returning
+        something else, or able to do better, override it, ex. SegmentedStage.
+        """
+        timestamps: List[int] = []
+        payloads: List[object] = []
+        while len(payloads) < max_items and (val := self.next(topic)) is not None:
+            payload, ts = val
+            timestamps.append(ts)
+            payloads.append(payload)
+
+        if len(payloads) == 0:
+            return None
+        return Batch.from_lists(timestamps, payloads)
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        """Everything that changes the output of the stage for the same input,
+        cached outputs are only reused when their profile is the same. Bump
+        STAGE_VERSION whenever the output of the stage changes. Includes the
+        profile of the child, whose output is the input of the stage.
+        """
+        profile: Dict[str, Any] = {
+            "stage": type(self).__name__,
+            "version": self.STAGE_VERSION,
+        }
+        if self.child_executor is not None:
+            profile["child"] = self.child_executor.get_cache_profile()
+        return profile
+
+    def seek(self, timestamp_ns: int) -> None:
+        """Reposition the stage so that the following `next` calls return data
+        at or after timestamp_ns. Stages without a notion of time simply
+        forward the seek to their child.
+        """
+        if self.child_executor is not None:
+            self.child_executor.seek(timestamp_ns)
+
+
+class SegmentedStage(AbstractStage):
+    """A stage whose output is split in a fixed number of segments known from
+    the metadata alone, any of which can be produced after a seek.
+    """
+
+    @abstractmethod
+    def get_segment_count(self) -> int:
+        pass
+
+    @abstractmethod
+    def seek_segment(self, segment_idx: int) -> None:
+        pass
+
+    @abstractmethod
+    def get_last_segment_start_ns(self) -> int:
+        """Timestamp of the start of the segment `next` returned last"""
+        pass
+
+    def next_batch(self, topic: Topic, max_items: int) -> Batch | None:
+        """Up to max_items next segments, with the ns timestamp of their start"""
+        timestamps: List[int] = []
+        payloads: List[object] = []
+        while len(payloads) < max_items and (segment := self.next(topic)) is not None:
+            timestamps.append(self.get_last_segment_start_ns())
+            payloads.append(segment)
+
+        if len(payloads) == 0:
+            return None
+        return Batch.from_lists(timestamps, payloads)
+
+
+class FrameDecoderStage(AbstractStage):
+    """A stage turning the CompressedImage messages of its child into RGB
+    frames, ex. an UndistortStage. Decoding is deferred: `next` and
+    `next_batch` hand the messages through as they are, and the stage
+    consuming them calls `decode_frame` on the ones it keeps, see
+    H264ConvertorStage. Messages dropped on the way are never decoded.
+    """
+
+    def next(self, topic: Topic):
+        assert self.child_executor is not None
+        return self.child_executor.next(topic)
+
+    def next_batch(self, topic: Topic, max_items: int) -> Batch | None:
+        assert self.child_executor is not None
+        return self.child_executor.next_batch(topic, max_items)
+
+    @abstractmethod
+    def decode_frame(self, compressed_image: msg.CompressedImage) -> np.ndarray:
+        """RGB frame of a message handed by `next` or `next_batch`"""
+        pass
+
+
+def fit_into(
+    width: int, height: int, box_width: int, box_height: int
+) -> Tuple[int, int, int, int]:
+    """Size and offset of an image scaled to fit a box, keeping its aspect
+
+    Returns:
+        Tuple[int, int, int, int]: width, height, x offset and y offset
+    """
+    scale = min(box_width / width, box_height / height)
+    fit_w = max(1, int(width * scale))
+    fit_h = max(1, int(height * scale))
+    return fit_w, fit_h, (box_width - fit_w) // 2, (box_height - fit_h) // 2
+
+
+class _TopicQueue:
+    """FIFO of the raw messages of one topic. The head is kept in memory and,
+    once the queue is over its budget, the tail is spilled to disk as
+    (offset, length, ts) entries into the spill file of the reader.
+    """
+
+    def __init__(self) -> None:
+        self.memory: Deque[Tuple[bytes, int]] = deque()
+        self.memory_bytes = 0
+        self.spilled: Deque[Tuple[int, int, int]] = deque()
+
+    def __len__(self) -> int:
+        return len(self.memory) + len(self.spilled)
+
 
 class McapReaderStage(AbstractStage):
     """Class responsible for reading the MCAP files sequentially
 
+    A single reader can feed the plans of several topics. Messages read while
+    looking for one topic are queued for their own topic until asked for, so
+    the bag is read and deserialized once. `topics` restricts what is read from
+    storage to the topics that are actually consumed.
+
+    Queued messages are kept serialized, and only deserialized when handed out.
+    The memory they use is bounded by `memory_budget` overall and by
+    `topic_queue_cap` per topic. Over budget, topics nobody asked for yet (and
+    not listed in `topics`) are dropped, then the tail of the queue being
+    appended to is spilled to a temporary file and read back lazily.
+
     Methods:
         next(topic) -> Next message on this topic
     """
 
-    def __init__(self, filename: str) -> None:
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+    # Message types read from the bag, the ones some stage consumes
+    MSG_TYPES = [msg.CompressedImage, msg.PointCloud2]
+    DEFAULT_TOPIC_QUEUE_CAP = 64 * 1024 * 1024
+
+    def __init__(
+        self,
+        filename: str,
+        topics: List[str] | None = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        topic_queue_cap: int = DEFAULT_TOPIC_QUEUE_CAP,
+    ) -> None:
         super().__init__()
         self._filename = filename
-        self._topic_wise_queue: Dict[str, Deque] = {}
-        self._bag_reader: BagReader = BagReader(uri=Path(filename))
-        self._bag_reader.__enter__()
-        self._iterator = iter(self._bag_reader)
+        self._topics = topics
+        self._memory_budget = memory_budget
+        self._topic_queue_cap = topic_queue_cap
+        self._logger = logging.getLogger(__name__)
 
-    def next(self, topic: Topic) -> Tuple[object, int] | None:
-        if topic.name not in self._topic_wise_queue:
-            self._topic_wise_queue[topic.name] = deque()
+        self._topic_wise_queue: Dict[str, _TopicQueue] = {}
+        self._queued_bytes = 0
+        self._requested_topics: Set[str] = set()
+        self._dropped_topics: Set[str] = set()
+
+        # Created on the first spill, truncated whenever nothing is spilled
+        self._spill_file: IO[bytes] | None = None
+        self._spill_end = 0
+        self._spilled_cnt = 0
+
+        # Opened on first use, a plan whose segments are all cached never reads
+        self._bag_reader: BagReader | None = None
+        self._iterator: Iterator[Tuple[str, bytes, int]] = iter(())
+
+    def _get_bag_reader(self) -> BagReader:
+        if self._bag_reader is None:
+            self._bag_reader = BagReader(
+                uri=Path(self._filename),
+                topics=self._topics,
+                msg_types=self.MSG_TYPES,
+            )
+            self._bag_reader.__enter__()
+            self._iterator = self._bag_reader.iter_raw()
+        return self._bag_reader
+
+    def get_queued_bytes(self) -> int:
+        """Bytes of queued messages held in memory"""
+        return self._queued_bytes
+
+    def get_spilled_count(self) -> int:
+        """Number of queued messages currently spilled to disk"""
+        return self._spilled_cnt
+
+    def seek(self, timestamp_ns: int) -> None:
+        # Whatever was queued belongs to the old position
+        self._topic_wise_queue.clear()
+        self._queued_bytes = 0
+        self._reset_spill_file()
+        bag_reader = self._get_bag_reader()
+        bag_reader.seek(timestamp_ns)
+        self._iterator = bag_reader.iter_raw()
+
+    def _reset_spill_file(self) -> None:
+        self._spilled_cnt = 0
+        self._spill_end = 0
+        if self._spill_file is not None:
+            self._spill_file.truncate(0)
+
+    def _is_droppable(self, topic_name: str) -> bool:
+        return topic_name not in self._requested_topics and (
+            self._topics is None or topic_name not in self._topics
+        )
 
+    def _drop_unrequested_topics(self) -> None:
+        for topic_name in list(self._topic_wise_queue.keys()):
+            if not self._is_droppable(topic_name):
+                continue
+            queue = self._topic_wise_queue.pop(topic_name)
+            self._queued_bytes -= queue.memory_bytes
+            self._spilled_cnt -= len(queue.spilled)
+            self._dropped_topics.add(topic_name)
+            self._logger.warning(
+                "Queue budget exceeded, dropping never requested topic %s of %s",
+                topic_name,
+                self._filename,
+            )
+        # Dead bytes of the dropped queues must not stay in the spill file
+        if self._spilled_cnt == 0:
+            self._reset_spill_file()
+
+    def _spill(self, queue: _TopicQueue, serial_data: bytes, ts: int) -> None:
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        os.pwrite(self._spill_file.fileno(), serial_data, self._spill_end)
+        queue.spilled.append((self._spill_end, len(serial_data), ts))
+        self._spill_end += len(serial_data)
+        self._spilled_cnt += 1
+
+    def _enqueue(self, topic_name: str, serial_data: bytes, ts: int) -> None:
+        if topic_name in self._dropped_topics:
+            return
+
+        size = len(serial_data)
+        if self._queued_bytes + size > self._memory_budget:
+            self._drop_unrequested_topics()
+            if topic_name in self._dropped_topics:
+                return
+
+        queue = self._topic_wise_queue.setdefault(topic_name, _TopicQueue())
+        # Once spilling, keep appending to disk so that the order is kept
         if (
-            self._topic_wise_queue[topic.name]
-            and len(self._topic_wise_queue[topic.name]) > 0
+            len(queue.spilled) > 0
+            or queue.memory_bytes + size > self._topic_queue_cap
+            or self._queued_bytes + size > self._memory_budget
         ):
-            return self._topic_wise_queue[topic.name].popleft()
+            self._spill(queue, serial_data, ts)
+        else:
+            queue.memory.append((serial_data, ts))
+            queue.memory_bytes += size
+            self._queued_bytes += size
+
+    def _dequeue(self, queue: _TopicQueue) -> Tuple[bytes, int]:
+        if len(queue.memory) > 0:
+            serial_data, ts = queue.memory.popleft()
+            queue.memory_bytes -= len(serial_data)
+            self._queued_bytes -= len(serial_data)
+            return serial_data, ts
+
+        assert self._spill_file is not None
+        offset, length, ts = queue.spilled.popleft()
+        serial_data = os.pread(self._spill_file.fileno(), length, offset)
+        self._spilled_cnt -= 1
+        if self._spilled_cnt == 0:
+            self._reset_spill_file()
+        return serial_data, ts
+
+    def _next_raw(self, topic_name: str) -> Tuple[bytes, int] | None:
+        queue = self._topic_wise_queue.get(topic_name)
+        if queue is not None and len(queue) > 0:
+            return self._dequeue(queue)
 
         # Read till we reach the next message of the topic we
         # need. Add all messages for all other topics to queue
         # so that we don't waste IO.
+        bag_reader = self._get_bag_reader()
+        for topic_from_file, serial_data, ts in self._iterator:
+            if not bag_reader.can_deserialize(topic_from_file):
+                continue
+            if topic_from_file == topic_name:
+                return serial_data, ts
+            self._enqueue(topic_from_file, serial_data, ts)
+        return None
 
-        # TODO: Check if this always returns sorted messages
-        # just in case they are not
-        try:
-            while True:
-                topic_from_file, data, dt_object = next(self._iterator)
-                # Convert datetime back to nanosecond timestamp
-                ts = int(dt_object.timestamp() * 1_000_000_000)
-
-                if topic_from_file == topic.name:
-                    return (data, ts)
-                else:
-                    if topic_from_file not in self._topic_wise_queue:
-                        self._topic_wise_queue[topic_from_file] = deque()
-                    self._topic_wise_queue[topic_from_file].append((data, ts))
-        except StopIteration:
+    def _mark_requested(self, topic_name: str) -> None:
+        self._requested_topics.add(topic_name)
+        if topic_name in self._dropped_topics:
+            self._logger.warning(
+                "Topic %s of %s was dropped from the queues, messages are missing",
+                topic_name,
+                self._filename,
+            )
+            self._dropped_topics.discard(topic_name)
+
+    def next(self, topic: Topic) -> Tuple[object, int] | None:
+        self._mark_requested(topic.name)
+
+        while (val := self._next_raw(topic.name)) is not None:
+            serial_data, ts = val
+            data = self._get_bag_reader().deserialize(topic.name, serial_data)
+            if data is not None:
+                return (data, ts)
+        return None
+
+    def next_batch(self, topic: Topic, max_items: int) -> Batch | None:
+        self._mark_requested(topic.name)
+
+        timestamps: List[int] = []
+        payloads: List[object] = []
+        while (
+            len(payloads) < max_items
+            and (val := self._next_raw(topic.name)) is not None
+        ):
+            serial_data, ts = val
+            data = self._get_bag_reader().deserialize(topic.name, serial_data)
+            if data is not None:
+                timestamps.append(ts)
+                payloads.append(data)
+
+        if len(payloads) == 0:
             return None
+        return Batch.from_lists(timestamps, payloads)
 
 
-class H264ConvertorStage(AbstractStage):
+class H264ConvertorStage(SegmentedStage):
     """Class to create chucks of video to be streamed to the UI
 
     Methods:
         next(topic) -> Next chuck stored as a SegmentNode
+        seek(timestamp_ns) -> Jump to the segment holding timestamp_ns
 
     Summary:
         The segment size is set as 2 and the fps is set as 30. This class
@@ -98,32 +526,56 @@ class H264ConvertorStage(AbstractStage):
 
         Each SegmentNode is a mpegts segment. That can be played on a browser.
         mpegts is the default video format used by HLS. HLS also requires a index file
-        that is used as a playlist, in our case the bufferPool can be used as a playlist,
-        the frontend can request for the segment is needs.
+        that is used as a playlist. Every segment but the last has the same number
+        of frames (see SegmentLayout), so the playlist only needs the duration.
+
+        Messages are pulled from the child `BATCH_SIZE` at a time with
+        `next_batch`, and only the last message mapped to each frame is decoded.
+        A FrameDecoderStage child, ex. an UndistortStage, decodes those
+        messages instead. The child may also hand images it already decoded,
+        as RGB arrays.
+
+        By default segments are aligned to the first message of the topic. When
+        `start_ns` is given they are aligned to it instead, which lets `seek`
+        produce any segment on its own without encoding the ones before it.
     """
 
-    def __init__(self, duration: int) -> None:
+    BATCH_SIZE = 256
+
+    def __init__(self, duration: int, start_ns: int | None = None) -> None:
         super().__init__()
         self._duration = duration
         self.segment_size = 2
         self.fps = 30
         self.bitrate = 2_000_000
-        self.per_frame_duration = int(1e9 / self.fps)
-        self.segment_duration_ns = self.segment_size * int(1e9)
+        self.layout = SegmentLayout(duration, self.fps, self.segment_size)
+        self.per_frame_duration = self.layout.per_frame_duration
+        self.segment_duration_ns = self.layout.segment_duration_ns
         self._is_initialized: bool = False
 
         # Start ts of the first segment
-        self._recording_start_ns: int = 0
+        self._start_ns = start_ns
+        self._recording_start_ns: int = start_ns if start_ns is not None else 0
         self._last_frame: np.ndarray | None = None
-        self._buffered_val: tuple | None = None
+        # Batch read from the child, messages before _batch_pos are consumed
+        self._batch: Batch | None = None
+        self._batch_pos: int = 0
         self._current_global_frame_index: int = 0
+        self._current_segment_idx: int = 0
+
+        # Set by seek, messages before the new segment still have to be skipped
+        self._pending_seek: bool = False
 
         # Cnt for debugging and Test cases
         self._total_messages_consumed: int = 0
 
     def _decode_compressed_image(
-        self, compressed_image: msg.CompressedImage
+        self, compressed_image: msg.CompressedImage | np.ndarray
     ) -> np.ndarray:
+        if isinstance(compressed_image, np.ndarray):
+            return compressed_image  # decoded by the child already
+        if isinstance(self.child_executor, FrameDecoderStage):
+            return self.child_executor.decode_frame(compressed_image)
         np_arr = np.frombuffer(compressed_image.data, np.uint8)
         image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
         return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
@@ -131,6 +583,167 @@ class H264ConvertorStage(AbstractStage):
     def get_total_messages_consumed(self) -> int:
         return self._total_messages_consumed
 
+    def get_segment_count(self) -> int:
+        return self.layout.get_segment_count()
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "fps": self.fps,
+            "segment_size": self.segment_size,
+            "bitrate": self.bitrate,
+            "start_ns": self._start_ns,
+        }
+
+    def seek(self, timestamp_ns: int) -> None:
+        """Position the stage on the segment that holds timestamp_ns.
+
+        Only possible when the stage was created with a `start_ns`. The child is
+        moved one segment earlier than needed, so that the last frame before the
+        segment is known and can be used to fill its first frames.
+        """
+        assert self._start_ns is not None, "seek requires a fixed start_ns"
+        assert self.child_executor is not None
+
+        frames_per_segment = self.layout.frames_per_segment
+        segment_idx = max(
+            0,
+            int(timestamp_ns - self._start_ns)
+            // (frames_per_segment * self.per_frame_duration),
+        )
+        self._current_segment_idx = segment_idx
+        self._current_global_frame_index = segment_idx * frames_per_segment
+        self._last_frame = None
+        self._batch = None
+        self._is_initialized = False
+        self._pending_seek = True
+
+        segment_start_ns = self._start_ns + self.layout.get_segment_offset_ns(
+            segment_idx
+        )
+        self.child_executor.seek(
+            max(self._start_ns, segment_start_ns - self.segment_duration_ns)
+        )
+
+    def seek_segment(self, segment_idx: int) -> None:
+        assert self._start_ns is not None, "seek requires a fixed start_ns"
+        self.seek(self._start_ns + self.layout.get_segment_offset_ns(segment_idx))
+
+    def _fill_batch(self, topic: Topic) -> bool:
+        """Make sure there is an unconsumed message in the batch, reading the
+        next batch from the child if needed. False once the topic is exhausted.
+        """
+        assert self.child_executor is not None
+
+        if self._batch is not None and self._batch_pos < len(self._batch):
+            return True
+        self._batch = self.child_executor.next_batch(topic, self.BATCH_SIZE)
+        self._batch_pos = 0
+        return self._batch is not None
+
+    def _skip_to_current_segment(self, topic: Topic) -> None:
+        """After a seek, drop the messages before the current segment but keep
+        the last one of them as the frame to fill in with.
+        """
+        segment_start_ns = self._recording_start_ns + (
+            self._current_global_frame_index * self.per_frame_duration
+        )
+        previous = None
+        while self._fill_batch(topic):
+            assert self._batch is not None
+            pos = self._batch_pos
+            timestamps = self._batch.timestamps[pos:]
+            cut = _first_at_or_after(timestamps, segment_start_ns)
+            if cut > 0:
+                previous = self._batch.payloads[pos + cut - 1]
+            self._batch_pos = pos + cut
+            if cut < len(timestamps):
+                break
+
+        if previous is not None:
+            self._last_frame = self._decode_compressed_image(previous)
+            self._is_initialized = True
+        self._pending_seek = False
+
+    def _collect_frames(
+        self, topic: Topic, segment_end_ns: int
+    ) -> Dict[int, np.ndarray]:
+        """Map every message before segment_end_ns to the global index of the
+        frame it is closest to, and decode the last message of each frame.
+        """
+        message_map: Dict[int, msg.CompressedImage] = {}
+        while self._fill_batch(topic):
+            self._check_cancelled()
+            assert self._batch is not None
+            pos = self._batch_pos
+
+            # Messages from cut on are a part of next segment, so keep them in
+            # the batch but don't use them in this segment
+            timestamps = self._batch.timestamps[pos:]
+            cut = _first_at_or_after(timestamps, segment_end_ns)
+            end = pos + cut
+
+            # Find the perfect index based on message's ts
+            indices = np.rint(
+                (timestamps[:cut] - self._recording_start_ns) / self.per_frame_duration
+            ).astype(np.int64)
+            message_map.update(zip(indices.tolist(), self._batch.payloads[pos:end]))
+
+            self._total_messages_consumed += cut
+            self._batch_pos = end
+            if cut < len(timestamps):
+                break
+
+        frame_map: Dict[int, np.ndarray] = {}
+        for index, data in message_map.items():
+            self._check_cancelled()
+            frame_map[index] = self._decode_compressed_image(data)
+        return frame_map
+
+    def _fill_frames(
+        self, frame_map: Dict[int, np.ndarray], frames_to_generate: int
+    ) -> List[np.ndarray]:
+        """One frame per pts of the segment. Either get the new frame, or fill in
+        the last known one.
+        """
+        frames: List[np.ndarray] = []
+        for pts in range(frames_to_generate):
+            frame = frame_map.get(self._current_global_frame_index + pts)
+            if frame is not None:
+                self._last_frame = frame
+            frames.append(self._last_frame)
+        return frames
+
+    def _encode(
+        self, frames: Iterable[np.ndarray], width: int, height: int, bitrate: int
+    ) -> bytes:
+        output_buffer = io.BytesIO()
+        container = av.open(file=output_buffer, mode="w", format="mpegts")
+        stream = container.add_stream("libx264", rate=self.fps)
+        stream.width, stream.height, stream.pix_fmt, stream.bit_rate = (
+            width,
+            height,
+            "yuv420p",
+            bitrate,
+        )
+
+        # A pts is "Presentation time" which is a multiple of 1/fps.
+        # Basically, its pyav's way of saying frame_index. The global index is
+        # used so that timestamps keep increasing from one segment to the next
+        # and the segments can be played back to back by a HLS player.
+        # Each frame is copied by pyav, so the same array can be yielded again.
+        for pts, frame in enumerate(frames):
+            self._check_cancelled()
+            pyav_frame = VideoFrame.from_ndarray(frame, format="rgb24")
+            pyav_frame.pts = self._current_global_frame_index + pts
+            for packet in stream.encode(pyav_frame):
+                container.mux(packet)
+
+        for packet in stream.encode(None):
+            container.mux(packet)
+        container.close()
+        return output_buffer.getvalue()
+
     def next(self, topic: Topic) -> SegmentNode | None:
         """Returns the next segment as a 2 sec video
 
@@ -148,105 +761,567 @@ class H264ConvertorStage(AbstractStage):
 
         assert self.child_executor is not None
 
-        if not self._is_initialized:
-            val = (
-                self._buffered_val
-                if self._buffered_val
-                else self.child_executor.next(topic)
-            )
+        if self._pending_seek:
+            self._skip_to_current_segment(topic)
 
-            # This is an empty mcap topic as _is_initialized = false and val = None
-            if val is None:
+        if not self._is_initialized:
+            # This is an empty mcap topic as _is_initialized = false and no data
+            if not self._fill_batch(topic):
                 return None
 
-            assert len(val) == 2
-            data, ts = val
-            self._recording_start_ns = ts
+            # Peek at the first message, it is still used by the segment
+            assert self._batch is not None
+            data = self._batch.payloads[self._batch_pos]
+            ts = int(self._batch.timestamps[self._batch_pos])
+            if self._start_ns is None:
+                self._recording_start_ns = ts
             self._last_frame = self._decode_compressed_image(data)
-            h, w = self._last_frame.shape[:2]
-
-            self._buffered_val = val
             self._is_initialized = True
 
-        recording_end_ns = self._recording_start_ns + self._duration
+        frames_to_generate = self.layout.get_frame_count(self._current_segment_idx)
+
+        # Our current start idx is more than total length of video
+        if frames_to_generate <= 0:
+            return None
+
         segment_start_ns = self._recording_start_ns + (
             self._current_global_frame_index * self.per_frame_duration
         )
+        segment_end_ns = segment_start_ns + frames_to_generate * self.per_frame_duration
 
-        # Our current start idx is more than total length of video
-        if segment_start_ns >= recording_end_ns:
-            return None
+        frame_map = self._collect_frames(topic, segment_end_ns)
+        frames = self._fill_frames(frame_map, frames_to_generate)
 
-        segment_end_ns = min(
-            segment_start_ns + self.segment_duration_ns, recording_end_ns
+        segment = self._encode_segment(frames)
+        self._current_global_frame_index += frames_to_generate
+        self._current_segment_idx += 1
+        return segment
+
+    def get_last_segment_start_ns(self) -> int:
+        # The start of the recording is only known once a segment is produced
+        assert self._recording_start_ns is not None
+        return self._recording_start_ns + self.layout.get_segment_offset_ns(
+            self._current_segment_idx - 1
         )
-        frames_to_generate = math.ceil(
-            (segment_end_ns - segment_start_ns) / self.per_frame_duration
+
+    def _encode_segment(self, frames: List[np.ndarray]) -> SegmentNode:
+        h, w = frames[0].shape[:2]
+        return SegmentNode(data=self._encode(frames, w, h, self.bitrate))
+
+
+class H264LadderStage(H264ConvertorStage):
+    """Same as H264ConvertorStage but every segment is encoded at each rung of a
+    bitrate ladder, so that a HLS player can switch between them.
+
+    Summary:
+        Messages are decoded once by H264ConvertorStage. Each decoded frame is
+        then downscaled once per rung and fed to one encoder per rung, all the
+        encoders running in the same pass over the frames. The decode cost does
+        not depend on the number of renditions.
+
+        The returned SegmentNode holds each rendition in `renditions`, and the
+        first rendition of the ladder in `data`.
+    """
+
+    def __init__(
+        self,
+        duration: int,
+        start_ns: int | None = None,
+        renditions: List[Rendition] = DEFAULT_RENDITIONS,
+    ) -> None:
+        super().__init__(duration, start_ns)
+        assert len(renditions) > 0
+        self.renditions = renditions
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "renditions": [
+                [rendition.name, rendition.height, rendition.bitrate]
+                for rendition in self.renditions
+            ],
+        }
+
+    def _encode_segment(self, frames: List[np.ndarray]) -> SegmentNode:
+        src_h, src_w = frames[0].shape[:2]
+        sizes = [rendition.get_size(src_w, src_h) for rendition in self.renditions]
+
+        buffers = []
+        containers = []
+        streams = []
+        for rendition, (w, h) in zip(self.renditions, sizes):
+            output_buffer = io.BytesIO()
+            container = av.open(file=output_buffer, mode="w", format="mpegts")
+            stream = container.add_stream("libx264", rate=self.fps)
+            stream.width, stream.height, stream.pix_fmt, stream.bit_rate = (
+                w,
+                h,
+                "yuv420p",
+                rendition.bitrate,
+            )
+            buffers.append(output_buffer)
+            containers.append(container)
+            streams.append(stream)
+
+        # Filled in frames are the same array repeated, only scale them once
+        last_src: np.ndarray | None = None
+        scaled: List[np.ndarray] = []
+        for pts, frame in enumerate(frames):
+            self._check_cancelled()
+            if frame is not last_src:
+                scaled = [
+                    (
+                        frame
+                        if (w, h) == (src_w, src_h)
+                        else cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+                    )
+                    for w, h in sizes
+                ]
+                last_src = frame
+
+            for container, stream, scaled_frame in zip(containers, streams, scaled):
+                pyav_frame = VideoFrame.from_ndarray(scaled_frame, format="rgb24")
+                pyav_frame.pts = self._current_global_frame_index + pts
+                for packet in stream.encode(pyav_frame):
+                    container.mux(packet)
+
+        for container, stream in zip(containers, streams):
+            for packet in stream.encode(None):
+                container.mux(packet)
+            container.close()
+
+        renditions = {
+            rendition.name: output_buffer.getvalue()
+            for rendition, output_buffer in zip(self.renditions, buffers)
+        }
+        return SegmentNode(
+            data=renditions[self.renditions[0].name], renditions=renditions
         )
-        if frames_to_generate <= 0:
-            return None  # never reach
 
-        frame_map: Dict[int, np.ndarray] = {}
-        while self._buffered_val is not None:
-            data, ts = self._buffered_val
 
-            # This would be a part of next segment, so buffer is now but don't use
-            # it in this segment
-            if ts >= segment_end_ns:
-                break
+class MosaicStage(H264ConvertorStage):
+    """Composes the frames of several cameras into a single grid video
 
-            time_offset = ts - self._recording_start_ns
+    Methods:
+        next(topic) -> Next chuck of the grid video stored as a SegmentNode
 
-            # Find the perfect index based on message's ts
-            index = round(time_offset / self.per_frame_duration)
+    Summary:
+        The topic given to `next` is only a name for the output, the cameras are
+        the `camera_topics` given at init. Each segment is built like in
+        H264ConvertorStage, every message is mapped to the frame index it is the
+        closest to, and this is done for all cameras against the same timeline,
+        so the tiles of a frame are time aligned.
 
-            self._total_messages_consumed += 1
-            frame_map[int(index)] = self._decode_compressed_image(data)
-            self._buffered_val = self.child_executor.next(topic)
+        Only the last message mapped to a frame index is decoded. It is scaled
+        to its tile and blitted into a canvas allocated once, which is encoded
+        as a single stream. Tiles keep their last frame until a new one arrives
+        and stay black before the first one.
+    """
 
-        # Fill a black frame till we get the first message of the first segment
-        if self._last_frame is None:
-            self._last_frame = np.zeros((h, w, 3), dtype=np.uint8)
+    def __init__(
+        self,
+        duration: int,
+        camera_topics: List[Topic],
+        start_ns: int | None = None,
+        tile_width: int = 640,
+        tile_height: int = 360,
+    ) -> None:
+        super().__init__(duration, start_ns)
+        assert len(camera_topics) > 0
+        self.bitrate = 6_000_000
+        self._camera_topics = camera_topics
+        self._tile_width = tile_width
+        self._tile_height = tile_height
 
-        h, w = self._last_frame.shape[:2]
+        cols = math.ceil(math.sqrt(len(camera_topics)))
+        rows = math.ceil(len(camera_topics) / cols)
+        self._canvas = np.zeros((rows * tile_height, cols * tile_width, 3), np.uint8)
+        self._tile_origins: List[Tuple[int, int]] = [
+            ((idx // cols) * tile_height, (idx % cols) * tile_width)
+            for idx in range(len(camera_topics))
+        ]
+        # Placement of an image inside its tile, keyed by the image shape
+        self._fit_cache: Dict[Tuple[int, int], Tuple[int, int, int, int]] = {}
+        # Next message of each camera, not yet part of a segment
+        self._buffered_vals: List[tuple | None] = [None] * len(camera_topics)
 
-        output_buffer = io.BytesIO()
-        container = av.open(file=output_buffer, mode="w", format="mpegts")
-        stream = container.add_stream("libx264", rate=self.fps)
-        stream.width, stream.height, stream.pix_fmt, stream.bit_rate = (
-            w,
-            h,
-            "yuv420p",
-            self.bitrate,
+    def _fit(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        """Size and offset of an image scaled to fit its tile, keeping its aspect"""
+        fit = self._fit_cache.get((height, width))
+        if fit is None:
+            fit = fit_into(width, height, self._tile_width, self._tile_height)
+            self._fit_cache[(height, width)] = fit
+        return fit
+
+    def _blit(self, tile_idx: int, compressed_image: msg.CompressedImage) -> None:
+        image = self._decode_compressed_image(compressed_image)
+        fit_w, fit_h, dx, dy = self._fit(*image.shape[:2])
+        y, x = self._tile_origins[tile_idx]
+        y, x = y + dy, x + dx
+        y_end, x_end = y + fit_h, x + fit_w
+        self._canvas[y:y_end, x:x_end] = cv2.resize(
+            image, (fit_w, fit_h), interpolation=cv2.INTER_AREA
         )
 
-        # A pts is "Presentation time" which is a multiple of 1/fps.
-        # Basically, its pyav's way of saying frame_index
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "camera_topics": [topic.name for topic in self._camera_topics],
+            "tile_size": [self._tile_width, self._tile_height],
+        }
+
+    def get_canvas_size(self) -> Tuple[int, int]:
+        h, w = self._canvas.shape[:2]
+        return w, h
+
+    def seek(self, timestamp_ns: int) -> None:
+        super().seek(timestamp_ns)
+        self._buffered_vals = [None] * len(self._camera_topics)
+        self._canvas[:] = 0
+
+    def _skip_to_current_segment(self, topic: Topic) -> None:
+        """Drop every message before the current segment, the tiles are left
+        with the last frame of their camera before it.
+        """
+        assert self.child_executor is not None
+
+        segment_start_ns = self._recording_start_ns + (
+            self._current_global_frame_index * self.per_frame_duration
+        )
+        for tile_idx, camera_topic in enumerate(self._camera_topics):
+            previous = None
+            val = self.child_executor.next(camera_topic)
+            while val is not None and val[1] < segment_start_ns:
+                previous = val
+                val = self.child_executor.next(camera_topic)
+            if previous is not None:
+                self._blit(tile_idx, previous[0])
+            self._buffered_vals[tile_idx] = val
+        self._pending_seek = False
+        self._is_initialized = True
+
+    def _initialize(self) -> bool:
+        """Read the first message of every camera, the earliest one is the start
+        of the recording unless a start_ns was given. False if all are empty.
+        """
+        assert self.child_executor is not None
+
+        self._buffered_vals = [
+            self.child_executor.next(camera_topic)
+            for camera_topic in self._camera_topics
+        ]
+        timestamps = [val[1] for val in self._buffered_vals if val is not None]
+        if len(timestamps) == 0:
+            return False
+        if self._start_ns is None:
+            self._recording_start_ns = min(timestamps)
+        self._is_initialized = True
+        return True
+
+    def _collect_tile_messages(
+        self, tile_idx: int, segment_end_ns: int
+    ) -> Dict[int, msg.CompressedImage]:
+        """Map the messages of one camera to frame indexes, without decoding"""
+        assert self.child_executor is not None
+
+        camera_topic = self._camera_topics[tile_idx]
+        message_map: Dict[int, msg.CompressedImage] = {}
+        while (val := self._buffered_vals[tile_idx]) is not None:
+            data, ts = val
+            if ts >= segment_end_ns:
+                break
+
+            index = round((ts - self._recording_start_ns) / self.per_frame_duration)
+            self._total_messages_consumed += 1
+            message_map[int(index)] = data
+            self._buffered_vals[tile_idx] = self.child_executor.next(camera_topic)
+        return message_map
+
+    def _compose_frames(
+        self, message_maps: List[Dict[int, msg.CompressedImage]], frames_to_generate
+    ) -> Iterable[np.ndarray]:
         for pts in range(frames_to_generate):
             global_index = self._current_global_frame_index + pts
-            frame_to_encode = frame_map.get(global_index)
+            for tile_idx, message_map in enumerate(message_maps):
+                compressed_image = message_map.get(global_index)
+                if compressed_image is not None:
+                    self._blit(tile_idx, compressed_image)
+            yield self._canvas
 
-            # Either get the new frame, or fill in the last known
-            if frame_to_encode is not None:
-                self._last_frame = frame_to_encode
-            else:
-                frame_to_encode = self._last_frame
+    def next(self, topic: Topic) -> SegmentNode | None:
+        if self._pending_seek:
+            self._skip_to_current_segment(topic)
 
-            pyav_frame = VideoFrame.from_ndarray(frame_to_encode, format="rgb24")
-            pyav_frame.pts = pts
-            for packet in stream.encode(pyav_frame):
-                container.mux(packet)
+        if not self._is_initialized and not self._initialize():
+            return None
 
+        frames_to_generate = self.layout.get_frame_count(self._current_segment_idx)
+        if frames_to_generate <= 0:
+            return None
+
+        segment_start_ns = self._recording_start_ns + (
+            self._current_global_frame_index * self.per_frame_duration
+        )
+        segment_end_ns = segment_start_ns + frames_to_generate * self.per_frame_duration
+
+        message_maps = [
+            self._collect_tile_messages(tile_idx, segment_end_ns)
+            for tile_idx in range(len(self._camera_topics))
+        ]
+        w, h = self.get_canvas_size()
+        data = self._encode(
+            self._compose_frames(message_maps, frames_to_generate), w, h, self.bitrate
+        )
         self._current_global_frame_index += frames_to_generate
-        for packet in stream.encode(None):
-            container.mux(packet)
-        container.close()
-        return SegmentNode(data=output_buffer.getvalue())
+        self._current_segment_idx += 1
+        return SegmentNode(data=data)
 
 
-class CompressionStage(AbstractStage):
-    def __init__(self) -> None:
+class SpriteSheetLayout:
+    """Maps a recording onto thumbnails taken every `interval_ns`, packed
+    row by row into sprite sheets of `cols` x `rows` tiles.
+
+    Like SegmentLayout, it only depends on the duration, so the WebVTT index of
+    the thumbnails can be served before any sheet is produced.
+    """
+
+    def __init__(
+        self,
+        duration: int,
+        interval_ns: int = int(1e9),
+        tile_width: int = 160,
+        tile_height: int = 90,
+        cols: int = 10,
+        rows: int = 10,
+    ) -> None:
+        self.duration = duration
+        self.interval_ns = interval_ns
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.cols = cols
+        self.rows = rows
+        self.thumbnails_per_sheet = cols * rows
+
+    def get_thumbnail_count(self) -> int:
+        return math.ceil(self.duration / self.interval_ns)
+
+    def get_sheet_count(self) -> int:
+        return math.ceil(self.get_thumbnail_count() / self.thumbnails_per_sheet)
+
+    def get_position(self, thumbnail_idx: int) -> Tuple[int, int, int]:
+        """Sheet index, x and y of a thumbnail"""
+        sheet_idx, cell = divmod(thumbnail_idx, self.thumbnails_per_sheet)
+        row, col = divmod(cell, self.cols)
+        return sheet_idx, col * self.tile_width, row * self.tile_height
+
+
+class ThumbnailStage(SegmentedStage):
+    """Produces low resolution thumbnails of a camera packed into JPEG sprite
+    sheets, used to preview the timeline while scrubbing.
+
+    Methods:
+        next(topic) -> Next sprite sheet stored as a SegmentNode
+
+    Summary:
+        Each `next` call produces one sheet, see SpriteSheetLayout. For every
+        thumbnail, the child is seeked to its time and only the first message
+        read is decoded. The JPEG is decoded directly at a reduced scale
+        (cv2.IMREAD_REDUCED_*) close to the tile size, so a thumbnail costs a
+        small fraction of a full resolution decode. This is cheaper than
+        sharing the full resolution decode of H264ConvertorStage, and it keeps
+        the sheets independent of the video segments, so any sheet can be
+        produced on demand.
+
+        A thumbnail without a message before the next one reuses the previous
+        thumbnail.
+    """
+
+    REDUCED_DECODE_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def __init__(
+        self,
+        duration: int,
+        camera_topic: Topic,
+        start_ns: int | None = None,
+        layout: SpriteSheetLayout | None = None,
+    ) -> None:
+        super().__init__()
+        self.layout = layout if layout else SpriteSheetLayout(duration)
+        self.jpeg_quality = 70
+        self._camera_topic = camera_topic
+        self._start_ns = start_ns
+        self._current_sheet_idx = 0
+        # Picked once the size of the source images is known
+        self._reduction = 1
+
+    def get_segment_count(self) -> int:
+        return self.layout.get_sheet_count()
+
+    def seek_segment(self, segment_idx: int) -> None:
+        self._current_sheet_idx = segment_idx
+
+    def get_last_segment_start_ns(self) -> int:
+        assert self._start_ns is not None
+        first_thumbnail = (
+            self._current_sheet_idx - 1
+        ) * self.layout.thumbnails_per_sheet
+        return self._start_ns + first_thumbnail * self.layout.interval_ns
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "jpeg_quality": self.jpeg_quality,
+            "start_ns": self._start_ns,
+            "interval_ns": self.layout.interval_ns,
+            "tile_size": [self.layout.tile_width, self.layout.tile_height],
+            "grid": [self.layout.cols, self.layout.rows],
+        }
+
+    def _decode_thumbnail(self, compressed_image: msg.CompressedImage) -> np.ndarray:
+        np_arr = np.frombuffer(compressed_image.data, np.uint8)
+        image = cv2.imdecode(np_arr, self.REDUCED_DECODE_FLAGS[self._reduction])
+        if self._reduction == 1:
+            # Largest reduction that still leaves at least a tile of pixels
+            height, width = image.shape[:2]
+            while (
+                self._reduction < 8
+                and width // (self._reduction * 2) >= self.layout.tile_width
+                and height // (self._reduction * 2) >= self.layout.tile_height
+            ):
+                self._reduction *= 2
+
+        fit_w, fit_h, dx, dy = fit_into(
+            image.shape[1],
+            image.shape[0],
+            self.layout.tile_width,
+            self.layout.tile_height,
+        )
+        thumbnail = np.zeros(
+            (self.layout.tile_height, self.layout.tile_width, 3), np.uint8
+        )
+        # Kept in BGR, the order cv2.imencode expects
+        y_end, x_end = dy + fit_h, dx + fit_w
+        thumbnail[dy:y_end, dx:x_end] = cv2.resize(
+            image, (fit_w, fit_h), interpolation=cv2.INTER_AREA
+        )
+        return thumbnail
+
+    def next(self, topic: Topic) -> SegmentNode | None:
+        assert self.child_executor is not None
+
+        if self._current_sheet_idx >= self.layout.get_sheet_count():
+            return None
+
+        if self._start_ns is None:
+            # Align the thumbnails to the first message of the camera
+            first = self.child_executor.next(self._camera_topic)
+            if first is None:
+                return None
+            self._start_ns = first[1]
+
+        first_thumbnail = self._current_sheet_idx * self.layout.thumbnails_per_sheet
+        last_thumbnail = min(
+            first_thumbnail + self.layout.thumbnails_per_sheet,
+            self.layout.get_thumbnail_count(),
+        )
+
+        sheet = np.zeros(
+            (
+                self.layout.rows * self.layout.tile_height,
+                self.layout.cols * self.layout.tile_width,
+                3,
+            ),
+            np.uint8,
+        )
+        thumbnail: np.ndarray | None = None
+        for thumbnail_idx in range(first_thumbnail, last_thumbnail):
+            self._check_cancelled()
+            thumbnail_ns = self._start_ns + thumbnail_idx * self.layout.interval_ns
+            self.child_executor.seek(thumbnail_ns)
+            val = self.child_executor.next(self._camera_topic)
+            if val is not None and val[1] < thumbnail_ns + self.layout.interval_ns:
+                thumbnail = self._decode_thumbnail(val[0])
+
+            if thumbnail is not None:
+                _, x, y = self.layout.get_position(thumbnail_idx)
+                y_end, x_end = y + self.layout.tile_height, x + self.layout.tile_width
+                sheet[y:y_end, x:x_end] = thumbnail
+
+        ok, jpeg = cv2.imencode(
+            ".jpg", sheet, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        )
+        assert ok
+        self._current_sheet_idx += 1
+        return SegmentNode(data=jpeg.tobytes())
+
+
+class CompressionStage(SegmentedStage):
+    """Compresses the payloads of the segments of its child, at `level` with
+    `codec`, see compression.py. Meant for the payloads that aren't already
+    compressed, ex. LiDAR segments, video would gain nothing.
+
+    A trained `dictionary` (zstd only) is used for every payload, it pays off
+    for small payloads, see train_dictionary. The codec and the dictionary are
+    recorded on the SegmentNode, so that the server can send the compressed
+    bytes as is to the clients that accept them.
+
+    Seeks and cancellation are forwarded to the child, which must be a
+    SegmentedStage, so that the stage can head an on demand plan.
+    """
+
+    def __init__(
+        self,
+        codec: str = DEFAULT_CODEC,
+        level: int | None = None,
+        dictionary: CompressionDictionary | None = None,
+    ) -> None:
         super().__init__()
+        self.codec = codec
+        self.level = level
+        self.dictionary = dictionary
+
+    def _get_child(self) -> SegmentedStage:
+        assert isinstance(self.child_executor, SegmentedStage)
+        return self.child_executor
+
+    def get_segment_count(self) -> int:
+        return self._get_child().get_segment_count()
+
+    def seek_segment(self, segment_idx: int) -> None:
+        self._get_child().seek_segment(segment_idx)
+
+    def get_last_segment_start_ns(self) -> int:
+        return self._get_child().get_last_segment_start_ns()
+
+    def set_cancel_event(self, cancel_event: threading.Event | None) -> None:
+        super().set_cancel_event(cancel_event)
+        self._get_child().set_cancel_event(cancel_event)
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "codec": self.codec,
+            "level": self.level,
+            "dictionary": self.dictionary.id if self.dictionary else None,
+        }
+
+    def _compress(self, data: bytes) -> bytes:
+        return compress(data, self.codec, self.level, self.dictionary)
 
     def next(self, topic: Topic) -> SegmentNode | None:
-        return None
+        segment = self._get_child().next(topic)
+        if segment is None or segment.encoding is not None:
+            return segment
+        return SegmentNode(
+            data=self._compress(segment.data),
+            renditions={
+                name: self._compress(data) for name, data in segment.renditions.items()
+            },
+            encoding=self.codec,
+            dictionary_id=self.dictionary.id if self.dictionary else None,
+        )
@@ -0,0 +1,189 @@
+"""
+Camera undistortion
+src/server/executors/undistort.py
+
+Raw cameras, unlike their image_rect topics, show the distortion of their
+lens. UndistortStage removes it with the calibration of the camera, read from
+the first CameraInfo message of its camera_info topic.
+
+The remap tables of cv2.initUndistortRectifyMap only depend on the calibration
+and on the size of the images, so they are computed once per (calibration,
+resolution) and cached, in memory for every stage of the process and in a
+directory to survive restarts. A frame then costs a single cv2.remap.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import zipfile
+import cv2
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, Tuple
+from sensor_msgs import msg
+from src.repository.rosbag import BagReader
+from .stages import FrameDecoderStage
+
+# Map of cv2.remap, fixed point coordinates and interpolation weights
+RemapTables = Tuple[np.ndarray, np.ndarray]
+
+# Calibrations with this distortion model use the fisheye camera model
+FISHEYE_MODEL = "equidistant"
+
+_remap_tables: Dict[str, RemapTables] = {}
+_remap_tables_lock = threading.Lock()
+
+
+def get_remap_key(camera_info: msg.CameraInfo, width: int, height: int) -> str:
+    """Identify the remap tables of a calibration at a resolution"""
+    content = json.dumps(
+        [
+            camera_info.distortion_model,
+            [float(v) for v in camera_info.k],
+            [float(v) for v in camera_info.d],
+            [float(v) for v in camera_info.r],
+            [float(v) for v in camera_info.p],
+            camera_info.width,
+            camera_info.height,
+            width,
+            height,
+        ]
+    )
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def compute_remap_tables(
+    camera_info: msg.CameraInfo, width: int, height: int
+) -> RemapTables | None:
+    """Remap tables undistorting and rectifying `width` x `height` images
+
+    Images of another resolution than the calibration scale its intrinsics.
+
+    Returns:
+        RemapTables | None: The tables, None if the camera isn't calibrated
+    """
+    k = np.array(camera_info.k, np.float64).reshape(3, 3)
+    if not k.any():
+        return None
+    d = np.array(camera_info.d, np.float64)
+    r = np.array(camera_info.r, np.float64).reshape(3, 3)
+    if not r.any():
+        r = np.eye(3)
+    p = np.array(camera_info.p, np.float64).reshape(3, 4)[:, :3]
+    if not p.any():
+        p = k.copy()
+
+    if camera_info.width > 0 and camera_info.height > 0:
+        scale = np.diag([width / camera_info.width, height / camera_info.height, 1])
+        k = scale @ k
+        p = scale @ p
+
+    if camera_info.distortion_model == FISHEYE_MODEL:
+        # The fisheye model takes exactly k1..k4, missing ones are 0
+        d = np.pad(d[:4], (0, max(0, 4 - len(d))))
+        return cv2.fisheye.initUndistortRectifyMap(
+            k, d, r, p, (width, height), cv2.CV_16SC2
+        )
+    return cv2.initUndistortRectifyMap(k, d, r, p, (width, height), cv2.CV_16SC2)
+
+
+def _load_remap_tables(path: Path) -> RemapTables | None:
+    if not path.exists():
+        return None
+    try:
+        with np.load(path) as cached:
+            return (cached["map1"], cached["map2"])
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        # A corrupt cache is just a cache miss, it is computed and overwritten
+        return None
+
+
+def get_remap_tables(
+    camera_info: msg.CameraInfo,
+    width: int,
+    height: int,
+    cache_dir: str | Path | None = None,
+) -> RemapTables | None:
+    """compute_remap_tables, cached in memory and in `cache_dir` if given"""
+    key = get_remap_key(camera_info, width, height)
+    with _remap_tables_lock:
+        if key in _remap_tables:
+            return _remap_tables[key]
+
+    path = Path(cache_dir) / f"{key}.npz" if cache_dir is not None else None
+    tables = _load_remap_tables(path) if path is not None else None
+    if tables is None:
+        tables = compute_remap_tables(camera_info, width, height)
+        if tables is not None and path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as cache_file:
+                np.savez(cache_file, map1=tables[0], map2=tables[1])
+            os.replace(tmp_path, path)
+
+    if tables is not None:
+        with _remap_tables_lock:
+            _remap_tables[key] = tables
+    return tables
+
+
+class UndistortStage(FrameDecoderStage):
+    """Decodes the images of a camera kept by the stage above, from a
+    McapReaderStage child, and undistorts them, see get_remap_tables and
+    FrameDecoderStage. The first CameraInfo of `camera_info_topic` is read on
+    first use, with a reader of its own. Images of an uncalibrated camera are
+    only decoded.
+
+    Methods:
+        decode_frame(compressed_image) -> RGB image as np.ndarray
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        camera_info_topic: str,
+        cache_dir: str | Path | None = None,
+    ) -> None:
+        super().__init__()
+        self._filename = filename
+        self._camera_info_topic = camera_info_topic
+        self._cache_dir = cache_dir
+        self._logger = logging.getLogger(__name__)
+        self._camera_info: msg.CameraInfo | None = None
+        self._is_camera_info_read = False
+
+    def get_cache_profile(self) -> Dict[str, Any]:
+        return {
+            **super().get_cache_profile(),
+            "camera_info_topic": self._camera_info_topic,
+        }
+
+    def get_camera_info(self) -> msg.CameraInfo | None:
+        if not self._is_camera_info_read:
+            self._is_camera_info_read = True
+            with BagReader(
+                uri=Path(self._filename),
+                topics=[self._camera_info_topic],
+                msg_types=[msg.CameraInfo],
+            ) as bag_reader:
+                self._camera_info = next((data for _, data, _ in bag_reader), None)
+            if self._camera_info is None:
+                self._logger.warning(
+                    "No CameraInfo on %s of %s, images are left distorted",
+                    self._camera_info_topic,
+                    self._filename,
+                )
+        return self._camera_info
+
+    def decode_frame(self, compressed_image: msg.CompressedImage) -> np.ndarray:
+        np_arr = np.frombuffer(compressed_image.data, np.uint8)
+        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        camera_info = self.get_camera_info()
+        if camera_info is not None:
+            height, width = image.shape[:2]
+            tables = get_remap_tables(camera_info, width, height, self._cache_dir)
+            if tables is not None:
+                image = cv2.remap(image, tables[0], tables[1], cv2.INTER_LINEAR)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
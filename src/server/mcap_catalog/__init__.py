@@ -1 +1,2 @@
 from .create_catalog import *  # noqa
+from .alignment import *  # noqa
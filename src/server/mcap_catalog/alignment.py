@@ -0,0 +1,213 @@
+import os
+import numpy as np
+from pathlib import Path
+from typing import Dict, List
+from src.repository.rosbag import BagReader
+
+# Marks a reference message with no match within the skew tolerance
+NO_MATCH = -1
+
+
+def nearest_indices(
+    timestamps: np.ndarray, reference: np.ndarray, max_skew_ns: int | None = None
+) -> np.ndarray:
+    """For each reference timestamp, index of the closest timestamp
+
+    Args:
+        timestamps (np.ndarray): Sorted int64 timestamps to search in
+        reference (np.ndarray): int64 timestamps to match
+        max_skew_ns (int | None): Matches further away than this are NO_MATCH
+
+    Returns:
+        np.ndarray: int64 index into `timestamps` per reference timestamp
+    """
+    if len(timestamps) == 0:
+        return np.full(len(reference), NO_MATCH, dtype=np.int64)
+
+    # The closest is either the first timestamp >= reference or the one before
+    right = np.searchsorted(timestamps, reference, side="left")
+    left = np.clip(right - 1, 0, len(timestamps) - 1)
+    right = np.clip(right, 0, len(timestamps) - 1)
+    take_right = np.abs(timestamps[right] - reference) < np.abs(
+        reference - timestamps[left]
+    )
+    indices = np.where(take_right, right, left).astype(np.int64)
+
+    if max_skew_ns is not None:
+        too_far = np.abs(timestamps[indices] - reference) > max_skew_ns
+        indices[too_far] = NO_MATCH
+    return indices
+
+
+class Alignment:
+    """Join table of a reference topic against other topics.
+
+    Row i is the i-th message of the reference topic. For every other topic
+    `indices[topic][i]` is the index of its closest message (NO_MATCH if none
+    is within the tolerance) and `skews[topic][i]` is its timestamp minus the
+    reference timestamp, 0 for NO_MATCH.
+    """
+
+    def __init__(
+        self,
+        reference_topic: str,
+        reference_timestamps: np.ndarray,
+        indices: Dict[str, np.ndarray],
+        skews: Dict[str, np.ndarray],
+    ) -> None:
+        self.reference_topic = reference_topic
+        self.reference_timestamps = reference_timestamps
+        self.indices = indices
+        self.skews = skews
+
+    def save(self, path: Path) -> None:
+        topics = list(self.indices.keys())
+        arrays = {"reference_timestamps": self.reference_timestamps}
+        for idx, topic in enumerate(topics):
+            arrays[f"indices_{idx}"] = self.indices[topic]
+            arrays[f"skews_{idx}"] = self.skews[topic]
+        _atomic_savez(
+            path,
+            reference_topic=np.array(self.reference_topic),
+            topics=np.array(topics, dtype=str),
+            **arrays,
+        )
+
+    @staticmethod
+    def load(path: Path) -> "Alignment":
+        with np.load(path) as npz:
+            topics = [str(topic) for topic in npz["topics"]]
+            return Alignment(
+                str(npz["reference_topic"]),
+                npz["reference_timestamps"],
+                {topic: npz[f"indices_{idx}"] for idx, topic in enumerate(topics)},
+                {topic: npz[f"skews_{idx}"] for idx, topic in enumerate(topics)},
+            )
+
+
+class TopicAligner:
+    """Finds, for every message of a reference topic, the closest message of
+    each other topic of a mcap.
+
+    Summary:
+        The timestamps of every topic are read in a single pass over the bag,
+        without deserializing any message, into one int64 array per topic. They
+        are cached next to the bag in `<bag>.timestamps.npz`, the cache is
+        thrown away if the size or mtime of the bag changed.
+
+        A join is then a np.searchsorted per topic over the whole bag.
+
+    Methods:
+        get_timestamps() -> int64 timestamps of each topic, in message order
+        align(reference_topic, topics, max_skew_ns) -> Alignment
+    """
+
+    def __init__(self, filename: str, use_cache: bool = True) -> None:
+        self._filename = filename
+        self._use_cache = use_cache
+        self._timestamps: Dict[str, np.ndarray] = {}
+
+    def get_cache_path(self) -> Path:
+        bag_path = Path(self._filename)
+        return bag_path.with_name(bag_path.name + ".timestamps.npz")
+
+    def _bag_signature(self) -> np.ndarray:
+        stat = os.stat(self._filename)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _load_cache(self) -> Dict[str, np.ndarray] | None:
+        cache_path = self.get_cache_path()
+        if not cache_path.exists():
+            return None
+        try:
+            with np.load(cache_path) as npz:
+                if not np.array_equal(npz["signature"], self._bag_signature()):
+                    return None
+                topics = [str(topic) for topic in npz["topics"]]
+                return {topic: npz[f"ts_{idx}"] for idx, topic in enumerate(topics)}
+        except (OSError, KeyError, ValueError):
+            # A corrupt cache is just a cache miss
+            return None
+
+    def _save_cache(self, timestamps: Dict[str, np.ndarray]) -> None:
+        topics = list(timestamps.keys())
+        arrays = {f"ts_{idx}": timestamps[topic] for idx, topic in enumerate(topics)}
+        try:
+            _atomic_savez(
+                self.get_cache_path(),
+                signature=self._bag_signature(),
+                topics=np.array(topics, dtype=str),
+                **arrays,
+            )
+        except OSError:
+            # Read only dataset, the timestamps are simply not cached
+            pass
+
+    def _read_timestamps(self) -> Dict[str, np.ndarray]:
+        per_topic: Dict[str, List[int]] = {}
+        with BagReader(Path(self._filename)) as bag:
+            for topic, _, timestamp in bag.iter_raw():
+                per_topic.setdefault(topic, []).append(timestamp)
+        return {
+            topic: np.asarray(timestamps, dtype=np.int64)
+            for topic, timestamps in per_topic.items()
+        }
+
+    def get_timestamps(self) -> Dict[str, np.ndarray]:
+        if len(self._timestamps) == 0:
+            timestamps = self._load_cache() if self._use_cache else None
+            if timestamps is None:
+                timestamps = self._read_timestamps()
+                if self._use_cache:
+                    self._save_cache(timestamps)
+            self._timestamps = timestamps
+        return self._timestamps
+
+    def align(
+        self,
+        reference_topic: str,
+        topics: List[str] | None = None,
+        max_skew_ns: int | None = None,
+    ) -> Alignment:
+        """Join a reference topic against other topics, all of them by default"""
+        timestamps = self.get_timestamps()
+        reference = timestamps.get(reference_topic, np.empty(0, dtype=np.int64))
+        if topics is None:
+            topics = [topic for topic in timestamps if topic != reference_topic]
+
+        indices: Dict[str, np.ndarray] = {}
+        skews: Dict[str, np.ndarray] = {}
+        for topic in topics:
+            topic_ts = timestamps.get(topic, np.empty(0, dtype=np.int64))
+
+            # Messages are usually already in order, only sort when needed and
+            # map the result back to message order
+            order = None
+            if np.any(np.diff(topic_ts) < 0):
+                order = np.argsort(topic_ts, kind="stable")
+                topic_ts = topic_ts[order]
+
+            nearest = nearest_indices(topic_ts, reference, max_skew_ns)
+            matched = nearest != NO_MATCH
+            skew = np.zeros(len(reference), dtype=np.int64)
+            skew[matched] = topic_ts[nearest[matched]] - reference[matched]
+            if order is not None:
+                nearest[matched] = order[nearest[matched]]
+
+            indices[topic] = nearest
+            skews[topic] = skew
+        return Alignment(reference_topic, reference, indices, skews)
+
+
+def _atomic_savez(path: Path, **arrays) -> None:
+    """np.savez to a temporary file renamed over `path`, readers never see a
+    partially written file.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
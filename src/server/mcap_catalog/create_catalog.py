@@ -3,12 +3,29 @@ from typing import List, Type, Any
 from sensor_msgs import msg
 from src.server.executors import (
     AbstractStage,
+    CompressionStage,
+    DepthStage,
     H264ConvertorStage,
+    H264LadderStage,
+    LodTier,
     McapReaderStage,
+    MosaicStage,
+    PointCloudStage,
+    Rendition,
     SegmentNode,
+    ThumbnailStage,
+    UndistortStage,
+    VoxelLodStage,
+    is_depth_topic,
 )
 from src.server.models import Topic
 from src.repository.rosbag import BagReader
+from src.server.mcap_catalog.alignment import Alignment, TopicAligner
+
+# Name of the topic under which the grid of all cameras is published
+MOSAIC_TOPIC_NAME = "/mosaic"
+# Suffix of the topic under which the thumbnails of a camera are published
+THUMBNAILS_SUFFIX = "/thumbnails"
 
 
 class ExecutionNode:
@@ -27,6 +44,9 @@ class ExecutionPlan:
 
     Example: To process a topic that the schema_type CompressedImage, the execution plan would
     look like = [ExecutionNode(H264ConvertorStage, next=McapReaderStage), ExecutionNode(McapReaderStage, next=None)]
+
+    The McapReaderStage at the end of a plan can be shared with other plans of the same
+    bag, see Catalog._get_reader_stage.
     """
 
     def __init__(self, topic: Topic) -> None:
@@ -39,6 +59,12 @@ class ExecutionPlan:
         )
         self.plan.append(execution_node)
 
+    def get_head(self) -> AbstractStage | None:
+        """The stage whose output is the output of the plan"""
+        if len(self.plan) == 0:
+            return None
+        return self.plan[0].executor_class
+
     def next(self) -> SegmentNode | None:
         if len(self.plan) == 0:
             return None
@@ -55,7 +81,16 @@ class Catalog:
     Finally, there are 3 things that this class exposes
         get_all_topics() : List of all topics as List[Topic]
         get_duration() : Duration of the mcap
+        get_start_time() : Timestamp of the first message of the mcap
         set_include_topics(List[str]) : Takes in list of topics to be included.
+        set_on_demand(bool) : Build plans that can seek, see #OnDemandProcessor.
+        set_renditions(List[Rendition]) : Encode videos at each rung of a bitrate ladder.
+        set_mosaic(bool) : Serve all cameras as a single grid video, see #MosaicStage.
+        set_thumbnails(bool) : Add a sprite sheet plan per camera, see #ThumbnailStage.
+        set_lod_tiers(List[LodTier]) : Downsample LiDAR clouds per tier, see #VoxelLodStage.
+        set_compression(str | None) : Compress LiDAR segments with a codec, see #CompressionStage.
+        set_undistort(bool, str | None) : Undistort raw cameras, see #UndistortStage.
+        align(str, List[str], int) : Closest message of each topic per reference message.
         get_execution_plans() : Execution plan of topics set as included, defaults to all topics.
     """
 
@@ -65,6 +100,18 @@ class Catalog:
         self._execution_plans: List[ExecutionPlan] = []
         self._included_topics: List[str] = []
         self._duration = 0
+        self._start_time = 0
+        self._on_demand = False
+        self._renditions: List[Rendition] = []
+        self._mosaic = False
+        self._thumbnails = False
+        self._lod_tiers: List[LodTier] = []
+        self._compression: str | None = None
+        self._undistort = False
+        self._remap_cache_dir: str | None = None
+        self._aligner: TopicAligner | None = None
+        # Single reader feeding every plan that reads the bag sequentially
+        self._shared_reader: McapReaderStage | None = None
 
     def _get_type_from_schema_type_str(self, schema_type: str) -> Type[Any] | None:
         values = {
@@ -81,6 +128,7 @@ class Catalog:
         topic_types = bag_reader._reader.get_all_topics_and_types()
         metadata = bag_reader._reader.get_metadata()
         self._duration = metadata.duration.nanoseconds
+        self._start_time = metadata.starting_time.nanoseconds
 
         # NOTICE: A buffer is added to the duration
         # as we generate videos, and round of the frames timestamps to their
@@ -110,35 +158,221 @@ class Catalog:
             self._get_topics_and_duration_from_mcap()
         return self._duration
 
+    def get_start_time(self) -> int:
+        if len(self._topics) == 0:
+            self._get_topics_and_duration_from_mcap()
+        return self._start_time
+
+    def align(
+        self,
+        reference_topic: str,
+        topics: List[str] | None = None,
+        max_skew_ns: int | None = None,
+    ) -> Alignment:
+        """Join table of a reference topic against other topics, see #TopicAligner"""
+        if self._aligner is None:
+            self._aligner = TopicAligner(self._filename)
+        return self._aligner.align(reference_topic, topics, max_skew_ns)
+
     def set_include_topics(self, topic_list: List[str]):
         self._included_topics = topic_list
 
+    def set_on_demand(self, on_demand: bool):
+        """On demand plans read only their own topic and align their segments to
+        the start of the bag, so that any segment can be produced with a seek.
+        """
+        self._on_demand = on_demand
+
+    def set_renditions(self, renditions: List[Rendition]):
+        """Camera topics get a H264LadderStage producing every rendition from a
+        single decode, instead of a single bitrate H264ConvertorStage.
+        """
+        self._renditions = renditions
+
+    def set_mosaic(self, mosaic: bool):
+        """Replace the plans of the included camera topics by a single plan that
+        encodes all of them as one grid video, published as MOSAIC_TOPIC_NAME.
+        """
+        self._mosaic = mosaic
+
+    def set_thumbnails(self, thumbnails: bool):
+        """Add a plan per included camera topic producing its thumbnail sprite
+        sheets, published as the camera topic name + THUMBNAILS_SUFFIX.
+        """
+        self._thumbnails = thumbnails
+
+    def set_lod_tiers(self, lod_tiers: List[LodTier]):
+        """LiDAR plans get a VoxelLodStage between the reader and the packing
+        stage, their segments then hold a packed cloud per tier.
+        """
+        self._lod_tiers = lod_tiers
+
+    def set_compression(self, codec: str | None):
+        """LiDAR plans get a CompressionStage compressing their segments with
+        `codec`, None leaves them uncompressed. Videos are never compressed.
+        """
+        self._compression = codec
+
+    def set_undistort(self, undistort: bool, remap_cache_dir: str | None = None):
+        """Camera plans get an UndistortStage between the reader and the video
+        stage when the camera is raw (not image_rect) and has a camera_info
+        topic. Its remap tables are cached in `remap_cache_dir` if given.
+        """
+        self._undistort = undistort
+        self._remap_cache_dir = remap_cache_dir
+
+    def _get_camera_info_topic(self, camera_topic: Topic) -> str | None:
+        """camera_info topic of a raw camera, in the namespace of the camera or
+        of one of its parents, ex. /front/camera_info for
+        /front/image_raw/compressed. None for rectified cameras.
+        """
+        if "image_rect" in camera_topic.name:
+            return None
+        topic_names = {topic.name for topic in self._topics}
+        namespace = camera_topic.name
+        while "/" in namespace:
+            namespace = namespace.rsplit("/", 1)[0]
+            if f"{namespace}/camera_info" in topic_names:
+                return f"{namespace}/camera_info"
+        return None
+
+    def _is_included(self, topic: Topic) -> bool:
+        return len(self._included_topics) == 0 or topic.name in self._included_topics
+
+    def _get_source_topic_names(self) -> List[str]:
+        """Topics read by at least one sequential plan"""
+        return [
+            topic.name
+            for topic in self._topics
+            if self._is_included(topic)
+            and topic.schema_type in (msg.CompressedImage, msg.PointCloud2)
+        ]
+
+    def _get_reader_stage(self, topics: List[Topic]) -> McapReaderStage:
+        """Reader feeding a plan that consumes `topics`.
+
+        Plans that read the bag sequentially all share a single reader, that
+        only reads the topics they consume. It reads the bag once and its topic
+        wise queues hand every message to the plan of its topic, so IO and
+        deserialization don't grow with the number of plans. Plans that seek,
+        i.e on demand plans, each need a reader of their own.
+        """
+        if self._on_demand:
+            return McapReaderStage(
+                self._filename, topics=[topic.name for topic in topics]
+            )
+
+        if self._shared_reader is None:
+            self._shared_reader = McapReaderStage(
+                self._filename, topics=self._get_source_topic_names()
+            )
+        return self._shared_reader
+
+    def _populate_thumbnail_execution_plan(self, camera_topic: Topic):
+        start_ns = self._start_time if self._on_demand else None
+        # Thumbnails seek for every tile, they can't share a reader
+        reader_stage = McapReaderStage(self._filename, topics=[camera_topic.name])
+        thumbnail_stage = ThumbnailStage(self._duration, camera_topic, start_ns)
+
+        thumbnail_topic_name = camera_topic.name + THUMBNAILS_SUFFIX
+        execution_plan = ExecutionPlan(
+            Topic(
+                name=thumbnail_topic_name,
+                schema_name=thumbnail_topic_name,
+                schema_type=msg.CompressedImage,
+            )
+        )
+        execution_plan.add_stage(ExecutionNode(thumbnail_stage, reader_stage))
+        execution_plan.add_stage(ExecutionNode(reader_stage, None))
+        self._execution_plans.append(execution_plan)
+
+    def _populate_mosaic_execution_plan(self, camera_topics: List[Topic]):
+        start_ns = self._start_time if self._on_demand else None
+        reader_stage = self._get_reader_stage(camera_topics)
+        mosaic_stage = MosaicStage(self._duration, camera_topics, start_ns)
+
+        execution_plan = ExecutionPlan(
+            Topic(
+                name=MOSAIC_TOPIC_NAME,
+                schema_name=MOSAIC_TOPIC_NAME,
+                schema_type=msg.CompressedImage,
+            )
+        )
+        execution_plan.add_stage(ExecutionNode(mosaic_stage, reader_stage))
+        execution_plan.add_stage(ExecutionNode(reader_stage, None))
+        self._execution_plans.append(execution_plan)
+
     def _populate_execution_plan(self):
         if len(self._topics) == 0:
             self._get_topics_and_duration_from_mcap()
 
+        camera_topics: List[Topic] = []
         for topic in self._topics:
-            if (
-                len(self._included_topics) > 0
-                and topic.name not in self._included_topics
-            ):
+            if not self._is_included(topic):
                 continue
 
             if topic.schema_type is None:
                 continue
 
+            # Depth cameras are colour mapped by their own plan only
+            is_depth = is_depth_topic(topic.name)
+            is_camera = topic.schema_type is msg.CompressedImage and not is_depth
+            if self._thumbnails and is_camera:
+                self._populate_thumbnail_execution_plan(topic)
+
+            if self._mosaic and is_camera:
+                camera_topics.append(topic)
+                continue
+
             execution_plan = ExecutionPlan(topic)
+            start_ns = self._start_time if self._on_demand else None
 
-            reader_stage = McapReaderStage(self._filename)
             if topic.schema_type is msg.CompressedImage:
-                execution_plan.add_stage(
-                    ExecutionNode(H264ConvertorStage(self._duration), reader_stage)
-                )
+                reader_stage = self._get_reader_stage([topic])
+                if len(self._renditions) > 0:
+                    video_stage = H264LadderStage(
+                        self._duration, start_ns, self._renditions
+                    )
+                else:
+                    video_stage = H264ConvertorStage(self._duration, start_ns)
+                camera_info_topic = self._get_camera_info_topic(topic)
+                if is_depth:
+                    depth_stage = DepthStage()
+                    execution_plan.add_stage(ExecutionNode(video_stage, depth_stage))
+                    execution_plan.add_stage(ExecutionNode(depth_stage, reader_stage))
+                elif self._undistort and camera_info_topic is not None:
+                    undistort_stage = UndistortStage(
+                        self._filename, camera_info_topic, self._remap_cache_dir
+                    )
+                    execution_plan.add_stage(
+                        ExecutionNode(video_stage, undistort_stage)
+                    )
+                    execution_plan.add_stage(
+                        ExecutionNode(undistort_stage, reader_stage)
+                    )
+                else:
+                    execution_plan.add_stage(ExecutionNode(video_stage, reader_stage))
                 execution_plan.add_stage(ExecutionNode(reader_stage, None))
             elif topic.schema_type is msg.PointCloud2:
-                pass
+                reader_stage = self._get_reader_stage([topic])
+                cloud_stage = PointCloudStage(self._duration, start_ns)
+                if self._compression is not None:
+                    compression_stage = CompressionStage(self._compression)
+                    execution_plan.add_stage(
+                        ExecutionNode(compression_stage, cloud_stage)
+                    )
+                if len(self._lod_tiers) > 0:
+                    lod_stage = VoxelLodStage(self._lod_tiers)
+                    execution_plan.add_stage(ExecutionNode(cloud_stage, lod_stage))
+                    execution_plan.add_stage(ExecutionNode(lod_stage, reader_stage))
+                else:
+                    execution_plan.add_stage(ExecutionNode(cloud_stage, reader_stage))
+                execution_plan.add_stage(ExecutionNode(reader_stage, None))
             self._execution_plans.append(execution_plan)
 
+        if len(camera_topics) > 0:
+            self._populate_mosaic_execution_plan(camera_topics)
+
     def get_execution_plans(self):
         if len(self._execution_plans) == 0:
             self._populate_execution_plan()
@@ -21,6 +21,8 @@ class File(BaseModel):
     size_bytes: int
     created_at: datetime
     thumbnail_url: Optional[str] = None
+    # Relative to the data root, the `file` of the streaming endpoints
+    path: Optional[str] = None
 
 
 class Directory(BaseModel):
@@ -29,6 +31,8 @@ class Directory(BaseModel):
     name: str
     files: List[File]
     file_count: int
+    # Cursor of the next page of files, None on the last page
+    next_cursor: Optional[str] = None
 
 
 class Feed(BaseModel):
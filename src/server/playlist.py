@@ -0,0 +1,102 @@
+"""
+HLS playlist and thumbnail index generation
+src/server/playlist.py
+
+Playlists are generated from a SegmentLayout only, i.e from the catalog
+metadata, so they can be served before a single segment has been encoded.
+The same goes for the WebVTT index of the thumbnail sprite sheets.
+"""
+
+import math
+from typing import Callable, List
+from src.server.executors import Rendition, SegmentLayout, SpriteSheetLayout
+
+HLS_VERSION = 3
+PLAYLIST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+VTT_MEDIA_TYPE = "text/vtt"
+
+
+def build_media_playlist(
+    layout: SegmentLayout, segment_uri: Callable[[int], str]
+) -> str:
+    """Build a VOD media playlist listing every segment of a layout
+
+    Args:
+        layout (SegmentLayout): Segment layout of the stream
+        segment_uri (Callable[[int], str]): Maps a segment index to its uri
+
+    Returns:
+        str: The m3u8 playlist
+    """
+    segment_cnt = layout.get_segment_count()
+    target_duration = math.ceil(
+        max((layout.get_segment_seconds(idx) for idx in range(segment_cnt)), default=0)
+    )
+
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-VERSION:{HLS_VERSION}",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for idx in range(segment_cnt):
+        lines.append(f"#EXTINF:{layout.get_segment_seconds(idx):.5f},")
+        lines.append(segment_uri(idx))
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def build_master_playlist(
+    renditions: List[Rendition], playlist_uri: Callable[[Rendition], str]
+) -> str:
+    """Build a master playlist pointing to one media playlist per rendition,
+    the player picks the one that fits its bandwidth.
+
+    Args:
+        renditions (List[Rendition]): Rungs of the bitrate ladder
+        playlist_uri (Callable[[Rendition], str]): Maps a rendition to the uri of
+            its media playlist
+
+    Returns:
+        str: The m3u8 playlist
+    """
+    lines = ["#EXTM3U", f"#EXT-X-VERSION:{HLS_VERSION}"]
+    for rendition in renditions:
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={rendition.bitrate}")
+        lines.append(playlist_uri(rendition))
+    return "\n".join(lines) + "\n"
+
+
+def _vtt_timestamp(ns: int) -> str:
+    ms = ns // 1_000_000
+    hours, ms = divmod(ms, 3_600_000)
+    minutes, ms = divmod(ms, 60_000)
+    seconds, ms = divmod(ms, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{ms:03d}"
+
+
+def build_thumbnail_vtt(
+    layout: SpriteSheetLayout, sheet_uri: Callable[[int], str]
+) -> str:
+    """Build a WebVTT index mapping each interval of the recording to the tile
+    of its thumbnail, using media fragments (#xywh=) into the sprite sheets.
+
+    Args:
+        layout (SpriteSheetLayout): Layout of the thumbnails
+        sheet_uri (Callable[[int], str]): Maps a sheet index to its uri
+
+    Returns:
+        str: The WebVTT file
+    """
+    lines = ["WEBVTT", ""]
+    for thumbnail_idx in range(layout.get_thumbnail_count()):
+        start_ns = thumbnail_idx * layout.interval_ns
+        end_ns = min(start_ns + layout.interval_ns, int(layout.duration))
+        sheet_idx, x, y = layout.get_position(thumbnail_idx)
+        lines.append(f"{_vtt_timestamp(start_ns)} --> {_vtt_timestamp(end_ns)}")
+        lines.append(
+            f"{sheet_uri(sheet_idx)}#xywh={x},{y},{layout.tile_width},{layout.tile_height}"
+        )
+        lines.append("")
+    return "\n".join(lines)
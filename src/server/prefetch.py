@@ -0,0 +1,115 @@
+"""
+Playback aware prefetching
+src/server/prefetch.py
+
+Tracks where each client is in each topic, so that the segments it is about
+to play are produced before it asks for them.
+"""
+
+import math
+import time
+from typing import Callable, Dict, Hashable, List, Tuple
+
+# Weight of the last request in the playback speed estimate
+SPEED_SMOOTHING = 0.5
+
+
+class Playhead:
+    """Position of a client in a topic, and its estimated playback speed"""
+
+    def __init__(self, segment_idx: int, updated_at: float) -> None:
+        self.segment_idx = segment_idx
+        self.updated_at = updated_at
+        # Seconds of video played per second, 1 is real time
+        self.speed = 1.0
+
+
+class PrefetchScheduler:
+    """Decides which segments to produce speculatively.
+
+    Each client has a playhead per topic, moved by its requests. Sequential
+    requests update an estimate of its playback speed, so that a client
+    watching at 4x gets a read-ahead window 4 times larger than `prefetch_cnt`,
+    up to `max_prefetch_cnt`. A request elsewhere (a seek) moves the window
+    along with the playhead, segments no client wants anymore can be cancelled.
+
+    Clients are identified by any hashable, None being a single anonymous
+    client. Playheads that didn't move for `client_timeout` seconds are dropped.
+    Not thread safe, the caller serializes the calls.
+    """
+
+    def __init__(
+        self,
+        prefetch_cnt: int = 2,
+        max_prefetch_cnt: int = 16,
+        client_timeout: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.prefetch_cnt = prefetch_cnt
+        self.max_prefetch_cnt = max_prefetch_cnt
+        self.client_timeout = client_timeout
+        self._clock = clock
+        self._playheads: Dict[Tuple[Hashable, str], Playhead] = {}
+
+    def update(
+        self,
+        client_id: Hashable,
+        topic_name: str,
+        segment_idx: int,
+        segment_seconds: float,
+    ) -> None:
+        """A client requested a segment of `segment_seconds` seconds"""
+        now = self._clock()
+        key = (client_id, topic_name)
+        playhead = self._playheads.get(key)
+        if playhead is None:
+            self._playheads[key] = Playhead(segment_idx, now)
+            return
+
+        elapsed = now - playhead.updated_at
+        if segment_idx == playhead.segment_idx + 1 and elapsed > 0:
+            speed = segment_seconds / elapsed
+            playhead.speed = (
+                SPEED_SMOOTHING * speed + (1 - SPEED_SMOOTHING) * playhead.speed
+            )
+        playhead.segment_idx = segment_idx
+        playhead.updated_at = now
+
+    def get_playhead(self, client_id: Hashable, topic_name: str) -> Playhead | None:
+        return self._playheads.get((client_id, topic_name))
+
+    def get_window(self, playhead: Playhead) -> int:
+        """Number of segments after the playhead to have ready"""
+        window = math.ceil(self.prefetch_cnt * max(1.0, playhead.speed))
+        return min(window, self.max_prefetch_cnt)
+
+    def _get_live_playheads(self) -> List[Tuple[str, Playhead]]:
+        now = self._clock()
+        for key in list(self._playheads.keys()):
+            if now - self._playheads[key].updated_at > self.client_timeout:
+                del self._playheads[key]
+        return [
+            (topic_name, playhead)
+            for (_, topic_name), playhead in self._playheads.items()
+        ]
+
+    def is_wanted(self, topic_name: str, segment_idx: int) -> bool:
+        """Whether a segment is within the window of any client"""
+        return any(
+            topic == topic_name
+            and playhead.segment_idx
+            <= segment_idx
+            <= playhead.segment_idx + self.get_window(playhead)
+            for topic, playhead in self._get_live_playheads()
+        )
+
+    def get_candidates(self) -> List[Tuple[str, int]]:
+        """(topic name, segment index) of every segment within the window of a
+        client, the most urgent first: the closest to a playhead.
+        """
+        candidates: Dict[Tuple[str, int], int] = {}
+        for topic_name, playhead in self._get_live_playheads():
+            for distance in range(1, self.get_window(playhead) + 1):
+                key = (topic_name, playhead.segment_idx + distance)
+                candidates[key] = min(distance, candidates.get(key, distance))
+        return sorted(candidates.keys(), key=lambda key: candidates[key])
@@ -1,85 +1,1520 @@
-from typing import Dict, Deque, List
-from collections import deque
-from src.server.mcap_catalog import Catalog
-from src.server.executors import SegmentNode
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Hashable, List, Set, Tuple
+from src.server.mcap_catalog import Catalog, ExecutionPlan
+from src.server.executors import (
+    H264ConvertorStage,
+    AbstractStage,
+    CompressionDictionary,
+    CompressionStage,
+    H264LadderStage,
+    LodTier,
+    PointCloudStage,
+    Rendition,
+    SegmentedStage,
+    SegmentNode,
+    StageCancelledError,
+    ThumbnailStage,
+    get_dictionary,
+)
+from src.server.prefetch import PrefetchScheduler
+from src.server.segment_cache import SegmentCache, bag_fingerprint
+from src.server.playlist import (
+    build_master_playlist,
+    build_media_playlist,
+    build_thumbnail_vtt,
+)
+
+# Key of a segment in the buffer pool, (namespace, topic name, segment index)
+SegmentKey = Tuple[str, str, int]
+
+
+def _segment_size(segment: SegmentNode) -> int:
+    return len(segment.data) + sum(len(data) for data in segment.renditions.values())
+
+
+# Length of the json header that starts an encoded segment
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+def encode_segment(segment: SegmentNode) -> bytes:
+    """Flatten a segment to bytes: the length of a json header, the header
+    listing the renditions and the length of every payload, then the payloads.
+    """
+    names = list(segment.renditions.keys())
+    payloads = [segment.data] + [segment.renditions[name] for name in names]
+    header = json.dumps(
+        {
+            "renditions": names,
+            "lengths": [len(data) for data in payloads],
+            "encoding": segment.encoding,
+            "dictionary_id": segment.dictionary_id,
+        }
+    ).encode()
+    return b"".join([_HEADER_LENGTH.pack(len(header)), header] + payloads)
+
+
+def decode_segment(buffer: bytes | memoryview) -> SegmentNode:
+    """Inverse of encode_segment, `buffer` may be longer than the segment"""
+    (header_length,) = _HEADER_LENGTH.unpack_from(buffer)
+    header_start = _HEADER_LENGTH.size
+    offset = header_start + header_length
+    header = json.loads(bytes(buffer[header_start:offset]))
+
+    payloads = []
+    for length in header["lengths"]:
+        end = offset + length
+        payloads.append(bytes(buffer[offset:end]))
+        offset = end
+    return SegmentNode(
+        data=payloads[0],
+        renditions=dict(zip(header["renditions"], payloads[1:])),
+        encoding=header.get("encoding"),
+        dictionary_id=header.get("dictionary_id"),
+    )
+
+
+def store_segment(segment_cache: SegmentCache, key: str, segment: SegmentNode) -> None:
+    """Put a segment in the segment cache, along with the dictionary its
+    payloads were compressed with if any
+    """
+    if segment.dictionary_id is not None:
+        dictionary = get_dictionary(segment.dictionary_id)
+        segment_cache.put_dictionary(dictionary.id, dictionary.data)
+    segment_cache.put(key, encode_segment(segment))
+
+
+def load_segment(segment_cache: SegmentCache, key: str) -> SegmentNode | None:
+    """Inverse of store_segment, None on a miss. The dictionary of the segment
+    is registered if this process doesn't know it yet, a segment whose
+    dictionary is lost is a miss.
+    """
+    data = segment_cache.get(key)
+    if data is None:
+        return None
+    segment = decode_segment(data)
+    if segment.dictionary_id is not None:
+        try:
+            get_dictionary(segment.dictionary_id)
+        except KeyError:
+            dictionary_data = segment_cache.get_dictionary(segment.dictionary_id)
+            if dictionary_data is None:
+                return None
+            CompressionDictionary(dictionary_data)
+    return segment
+
+
+def read_payload_span(
+    segment_file: BinaryIO, rendition: str | None = None
+) -> Tuple[int, int, str | None]:
+    """Locate a payload in a file holding an encoded segment, see
+    encode_segment, by reading its header only
+
+    Args:
+        segment_file (BinaryIO): File positioned at the start of the segment
+        rendition (str | None): Rendition of the payload, `data` if None
+
+    Returns:
+        Tuple[int, int, str | None]: Offset of the payload from the start of
+            the segment, its length, and the codec it is compressed with
+    """
+    (header_length,) = _HEADER_LENGTH.unpack(segment_file.read(_HEADER_LENGTH.size))
+    header = json.loads(segment_file.read(header_length))
+    payload_idx = 0
+    if rendition is not None:
+        if rendition not in header["renditions"]:
+            raise KeyError(f"Segment has no rendition {rendition}")
+        payload_idx = header["renditions"].index(rendition) + 1
+
+    lengths = header["lengths"]
+    offset = _HEADER_LENGTH.size + header_length + sum(lengths[:payload_idx])
+    return offset, lengths[payload_idx], header.get("encoding")
+
+
+def _resolve_waiter(future: asyncio.Future, segment: SegmentNode | None) -> None:
+    if not future.done():
+        future.set_result(segment)
 
 
 class BufferPool:
     """Represent a buffer pool.
 
-    This class has a topic wise queue, a process would enqueue segments / chunks
-    and another process would consume them. Later a LRU Cache can also be
-    implemented.
+    Segments are stored per topic, a process would enqueue segments / chunks
+    and another process would consume them. Topics are scoped by a namespace,
+    the bag they come from, so that a single pool can serve every bag.
+
+    With a `memory_budget` the pool is a LRU cache: once the segments in memory
+    exceed the budget, the least recently used ones are evicted. When a
+    `spill_dir` is given evicted segments move to a disk tier in that
+    directory, itself bounded by `disk_budget`, and are loaded back on their
+    next hit. Hits, misses and evictions are counted, see `get_stats`.
+
+    Consumers can wait for a segment that isn't produced yet with
+    `wait_segment`, or `await_segment` from asyncio code, so that a topic can
+    be played back while it is being processed. Once the final number of
+    segments of a topic is known, see `set_segment_count`, waiting for a
+    segment past it returns None right away.
     """
 
-    def __init__(self) -> None:
-        self.topics: Dict[str, Deque[SegmentNode]] = {}
+    def __init__(
+        self,
+        memory_budget: int | None = None,
+        spill_dir: str | Path | None = None,
+        disk_budget: int | None = None,
+    ) -> None:
+        self._memory_budget = memory_budget
+        self._spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self._disk_budget = disk_budget
+        if self._spill_dir is not None:
+            self._spill_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Notified whenever a segment is added or a segment count is set
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters: Dict[
+            SegmentKey, List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]
+        ] = {}
+        self._segment_cnt: Dict[Tuple[str, str], int] = {}
+        # Least recently used first
+        self._memory: OrderedDict[SegmentKey, SegmentNode] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[SegmentKey, int] = OrderedDict()
+        self._disk_bytes = 0
+        # Evicted segments being written to disk, with the temporary file they
+        # are written to, see _evict
+        self._spilling: Dict[SegmentKey, Tuple[SegmentNode, Path]] = {}
+        self._pending_spills: List[Tuple[SegmentKey, SegmentNode, Path]] = []
+        self._spill_seq = 0
+        # Index the next appended segment of a topic gets
+        self._append_idx: Dict[Tuple[str, str], int] = {}
 
-    def add_segment(self, topic_name: str, segment: SegmentNode):
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "spills": 0,
+            "disk_evictions": 0,
+        }
+
+    def add_segment(
+        self,
+        topic_name: str,
+        segment: SegmentNode,
+        segment_idx: int | None = None,
+        namespace: str = "",
+    ):
         """Add a segment on a topic. All the last executors must return a
         SegmentNode
 
         Args:
             topic_name (str): Topic name
             segment (SegmentNode): A SegmentNode(data: bytes) object
+            segment_idx (int | None): Index of the segment, segments produced on
+                demand arrive out of order. Defaults to appending.
+            namespace (str): Scope of the topic, ex. the bag it comes from
         """
-        if topic_name not in self.topics:
-            self.topics[topic_name] = deque()
-        self.topics[topic_name].append(segment)
+        with self._lock:
+            if segment_idx is None:
+                segment_idx = self._append_idx.get((namespace, topic_name), 0)
+            self._append_idx[(namespace, topic_name)] = max(
+                segment_idx + 1, self._append_idx.get((namespace, topic_name), 0)
+            )
+
+            key = (namespace, topic_name, segment_idx)
+            self._remove(key)
+            self._memory[key] = segment
+            self._memory_bytes += _segment_size(segment)
+            self._evict()
+
+            self._condition.notify_all()
+            for loop, future in self._async_waiters.pop(key, []):
+                loop.call_soon_threadsafe(_resolve_waiter, future, segment)
+        self._write_spills()
 
-    def get_segment(self, topic_name: str, segment_idx: int) -> SegmentNode | None:
+    def get_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> SegmentNode | None:
         """Get a particular segment for a topic. None if topic not available or
         segment_idx out of bound
 
         Args:
             topic_name (str): Topic name
             segment_idx (int): Index of the segment
+            namespace (str): Scope of the topic, ex. the bag it comes from
 
         Returns:
             SegmentNode | None: SegmentNode or none if not available
         """
-        if topic_name not in self.topics:
-            return None
+        key = (namespace, topic_name, segment_idx)
+        segment = self._lookup(key)
+        if segment is None:
+            with self._lock:
+                self._stats["misses"] += 1
+        return segment
+
+    def has_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        """Whether a segment is held by the pool, without counting as an access"""
+        key = (namespace, topic_name, segment_idx)
+        with self._lock:
+            return self._holds(key)
+
+    def claim_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        """Claim the production of a segment, so that the processes sharing the
+        pool don't all produce it. False if another process holds the claim, it
+        should wait for the segment instead. Always True for a pool of a single
+        process, its processor coalesces requests itself.
+        """
+        return True
+
+    def release_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> None:
+        """Release the claim of claim_segment, once the segment is produced"""
+
+    def set_segment_count(
+        self, topic_name: str, segment_cnt: int, namespace: str = ""
+    ) -> None:
+        """Set the final number of segments of a topic, known from the catalog
+        before the topic is processed, or once its processing is over. Anyone
+        waiting for a segment past it is woken up with None.
+        """
+        with self._lock:
+            self._segment_cnt[(namespace, topic_name)] = segment_cnt
+            self._condition.notify_all()
+            for key in list(self._async_waiters.keys()):
+                if self._is_out_of_range(key):
+                    for loop, future in self._async_waiters.pop(key):
+                        loop.call_soon_threadsafe(_resolve_waiter, future, None)
+
+    def get_final_segment_count(
+        self, topic_name: str, namespace: str = ""
+    ) -> int | None:
+        """Final number of segments of a topic, None if it isn't known"""
+        with self._lock:
+            return self._segment_cnt.get((namespace, topic_name))
+
+    def wait_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        """Get a segment, blocking until it is produced
+
+        Returns:
+            SegmentNode | None: The segment, None if it is out of range
+
+        Raises:
+            TimeoutError: The segment wasn't produced within `timeout` seconds
+        """
+        key = (namespace, topic_name, segment_idx)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                while not self._is_out_of_range(key) and not self._holds(key):
+                    remaining = (
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                    if remaining is not None and remaining <= 0:
+                        self._stats["misses"] += 1
+                        raise TimeoutError(
+                            f"Segment {segment_idx} of topic {topic_name} not produced"
+                        )
+                    self._condition.wait(remaining)
+                if self._is_out_of_range(key):
+                    return None
+
+            # Read with the lock released, it may come from the disk tier. Gone
+            # again if it was evicted from the disk tier in between.
+            segment = self._lookup(key)
+            if segment is not None:
+                return segment
+
+    async def await_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        """Same as wait_segment without blocking the event loop"""
+        key = (namespace, topic_name, segment_idx)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._is_out_of_range(key):
+                    return None
+                if not self._holds(key):
+                    future = loop.create_future()
+                    self._async_waiters.setdefault(key, []).append((loop, future))
+                    break
+            segment = self._lookup(key)
+            if segment is not None:
+                return segment
+
+        try:
+            segment = await asyncio.wait_for(future, timeout)
+            if segment is not None:
+                with self._lock:
+                    self._stats["hits"] += 1
+            return segment
+        except TimeoutError:
+            with self._lock:
+                self._stats["misses"] += 1
+            raise
+        finally:
+            with self._lock:
+                waiters = self._async_waiters.get(key, [])
+                if (loop, future) in waiters:
+                    waiters.remove((loop, future))
+                    if len(waiters) == 0:
+                        del self._async_waiters[key]
+
+    def _is_out_of_range(self, key: SegmentKey) -> bool:
+        namespace, topic_name, segment_idx = key
+        segment_cnt = self._segment_cnt.get((namespace, topic_name))
+        return segment_idx < 0 or (
+            segment_cnt is not None and segment_idx >= segment_cnt
+        )
+
+    def _holds(self, key: SegmentKey) -> bool:
+        return key in self._memory or key in self._spilling or key in self._disk
+
+    def _lookup(self, key: SegmentKey) -> SegmentNode | None:
+        """Segment from either tier, lock not held. Hits are counted, misses
+        are left to the caller. A segment on disk is read with the lock
+        released, so that a slow disk doesn't block the other topics, then
+        promoted back to memory.
+        """
+        with self._lock:
+            segment = self._lookup_memory(key)
+            on_disk = segment is None and key in self._disk
+        if on_disk:
+            try:
+                segment = self._read_spilled(key)
+            except FileNotFoundError:
+                # Evicted from the disk tier meanwhile
+                return None
+            with self._lock:
+                current = self._lookup_memory(key)
+                if current is not None:
+                    # Added again, or promoted by another reader, meanwhile
+                    segment = current
+                else:
+                    # The disk copy isn't needed anymore
+                    self._remove(key)
+                    self._stats["disk_hits"] += 1
+                    self._stats["hits"] += 1
+                    self._promote(key, segment)
+        self._write_spills()
+        return segment
+
+    def _lookup_memory(self, key: SegmentKey) -> SegmentNode | None:
+        """Segment from memory, or being spilled, lock held"""
+        segment = self._memory.get(key)
+        if segment is not None:
+            self._memory.move_to_end(key)
+            self._stats["hits"] += 1
+            return segment
 
-        if segment_idx >= len(self.topics[topic_name]):
+        spilling = self._spilling.pop(key, None)
+        if spilling is None:
             return None
+        # Evicted but not on disk yet, the write is dropped once it completes
+        segment = spilling[0]
+        self._stats["hits"] += 1
+        self._promote(key, segment)
+        return segment
 
-        return self.topics[topic_name][segment_idx]
+    def _promote(self, key: SegmentKey, segment: SegmentNode) -> None:
+        self._memory[key] = segment
+        self._memory_bytes += _segment_size(segment)
+        self._evict(keep=key)
+
+    def scoped(self, namespace: str) -> "BufferPool":
+        """A view of this pool whose topics all live in `namespace`, so that the
+        processors of several bags can share the pool and its budget.
+        """
+        return _ScopedBufferPool(self, namespace)
+
+    def get_segment_count(self, topic_name: str, namespace: str = "") -> int:
+        """Number of segments of a topic held by the pool, in memory or on disk"""
+        with self._lock:
+            return sum(
+                1
+                for tier in (self._memory, self._spilling, self._disk)
+                for ns, name, _ in tier.keys()
+                if (ns, name) == (namespace, topic_name)
+            )
+
+    def get_stats(self) -> Dict[str, int]:
+        """Counters of the pool, and the bytes currently held by each tier"""
+        with self._lock:
+            return {
+                **self._stats,
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+                "memory_segments": len(self._memory),
+                "disk_segments": len(self._disk),
+            }
+
+    def _remove(self, key: SegmentKey) -> None:
+        segment = self._memory.pop(key, None)
+        if segment is not None:
+            self._memory_bytes -= _segment_size(segment)
+        self._spilling.pop(key, None)
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+            self._get_spill_path(key).unlink(missing_ok=True)
+
+    def _evict(self, keep: SegmentKey | None = None) -> None:
+        """Evict the least recently used segments until the pool fits in its
+        budget, lock held. `keep` is being returned, it stays in memory even if
+        it alone exceeds the budget.
+
+        Segments to spill are only reserved in `_spilling`, where they can
+        still be read, and written to disk by `_write_spills` once the lock is
+        released.
+        """
+        if self._memory_budget is None:
+            return
+
+        while self._memory_bytes > self._memory_budget and len(self._memory) > 0:
+            key = next(iter(self._memory))
+            if key == keep:
+                # Most recently used, only `keep` is left
+                break
+            segment = self._memory.pop(key)
+            self._memory_bytes -= _segment_size(segment)
+            self._stats["evictions"] += 1
+            if self._spill_dir is not None:
+                self._spill_seq += 1
+                path = self._get_spill_path(key)
+                tmp_path = path.with_name(f".{path.name}.{self._spill_seq}.tmp")
+                self._spilling[key] = (segment, tmp_path)
+                self._pending_spills.append((key, segment, tmp_path))
+
+    def _evict_disk(self) -> None:
+        """Evict the least recently spilled segments until the disk tier fits
+        in its budget, lock held
+        """
+        if self._disk_budget is None:
+            return
+        while self._disk_bytes > self._disk_budget and len(self._disk) > 0:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._get_spill_path(key).unlink(missing_ok=True)
+            self._stats["disk_evictions"] += 1
+
+    def _get_spill_path(self, key: SegmentKey) -> Path:
+        assert self._spill_dir is not None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self._spill_dir / f"{digest}.seg"
+
+    def _write_spills(self) -> None:
+        """Write the segments reserved by _evict to the disk tier, lock not
+        held, see encode_segment. Each is written to its own temporary file
+        then published, renamed and accounted for, under the lock, unless it
+        was added again or read back meanwhile.
+        """
+        # Checked without the lock, whoever evicts writes its spills right after
+        if len(self._pending_spills) == 0:
+            return
+        with self._lock:
+            spills, self._pending_spills = self._pending_spills, []
+
+        for idx, (key, segment, tmp_path) in enumerate(spills):
+            try:
+                with open(tmp_path, "wb") as spill_file:
+                    spill_file.write(encode_segment(segment))
+            except OSError:
+                # Drop this segment and the ones not written yet, as evictions
+                # without a disk tier do
+                tmp_path.unlink(missing_ok=True)
+                with self._lock:
+                    for dropped_key, _, dropped_path in spills[idx:]:
+                        if self._is_reserved(dropped_key, dropped_path):
+                            del self._spilling[dropped_key]
+                raise
+
+            with self._lock:
+                published = self._is_reserved(key, tmp_path)
+                if published:
+                    del self._spilling[key]
+                    os.replace(tmp_path, self._get_spill_path(key))
+                    size = _segment_size(segment)
+                    self._disk[key] = size
+                    self._disk_bytes += size
+                    self._stats["spills"] += 1
+                    self._evict_disk()
+            if not published:
+                tmp_path.unlink(missing_ok=True)
+
+    def _is_reserved(self, key: SegmentKey, tmp_path: Path) -> bool:
+        """Whether the spill written to `tmp_path` is still the one of `key`"""
+        spilling = self._spilling.get(key)
+        return spilling is not None and spilling[1] == tmp_path
+
+    def _read_spilled(self, key: SegmentKey) -> SegmentNode:
+        with open(self._get_spill_path(key), "rb") as spill_file:
+            return decode_segment(spill_file.read())
+
+
+class _ScopedBufferPool(BufferPool):
+    """See BufferPool.scoped"""
+
+    def __init__(self, pool: BufferPool, namespace: str) -> None:
+        self._pool = pool
+        self._namespace = namespace
+
+    def add_segment(
+        self,
+        topic_name: str,
+        segment: SegmentNode,
+        segment_idx: int | None = None,
+        namespace: str = "",
+    ):
+        self._pool.add_segment(
+            topic_name, segment, segment_idx, self._namespace + namespace
+        )
+
+    def get_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> SegmentNode | None:
+        return self._pool.get_segment(
+            topic_name, segment_idx, self._namespace + namespace
+        )
+
+    def get_segment_count(self, topic_name: str, namespace: str = "") -> int:
+        return self._pool.get_segment_count(topic_name, self._namespace + namespace)
+
+    def has_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        return self._pool.has_segment(
+            topic_name, segment_idx, self._namespace + namespace
+        )
+
+    def claim_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        return self._pool.claim_segment(
+            topic_name, segment_idx, self._namespace + namespace
+        )
+
+    def release_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> None:
+        self._pool.release_segment(topic_name, segment_idx, self._namespace + namespace)
+
+    def set_segment_count(
+        self, topic_name: str, segment_cnt: int, namespace: str = ""
+    ) -> None:
+        self._pool.set_segment_count(
+            topic_name, segment_cnt, self._namespace + namespace
+        )
+
+    def get_final_segment_count(
+        self, topic_name: str, namespace: str = ""
+    ) -> int | None:
+        return self._pool.get_final_segment_count(
+            topic_name, self._namespace + namespace
+        )
+
+    def wait_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        return self._pool.wait_segment(
+            topic_name, segment_idx, timeout, self._namespace + namespace
+        )
+
+    async def await_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        return await self._pool.await_segment(
+            topic_name, segment_idx, timeout, self._namespace + namespace
+        )
+
+    def scoped(self, namespace: str) -> BufferPool:
+        return _ScopedBufferPool(self._pool, self._namespace + namespace)
+
+    def get_stats(self) -> Dict[str, int]:
+        return self._pool.get_stats()
+
+
+def _run_plan_worker(
+    filename: str, topic_name: str, conn: multiprocessing.connection.Connection
+) -> None:
+    """Entry point of a Processor worker process. Builds the execution plan of a
+    single topic, with its own reader and encoder, and streams every segment it
+    produces back to the parent. Closing the pipe marks the end of the topic.
+    """
+    catalog = Catalog(filename)
+    catalog.set_include_topics([topic_name])
+    plan = next(p for p in catalog.get_execution_plans() if p.topic.name == topic_name)
+
+    try:
+        while (segment := plan.next()) is not None:
+            # Written to the pipe as raw bytes along with its renditions and
+            # encoding, nothing is pickled
+            conn.send_bytes(encode_segment(segment))
+    finally:
+        conn.close()
+
+
+def _get_cache_keys(filename: str, plans: List[ExecutionPlan]) -> Dict[str, List[str]]:
+    """Cache key of every segment of the plans that know their segment count"""
+    fingerprint = bag_fingerprint(filename)
+    cache_keys = {}
+    for plan in plans:
+        head = plan.get_head()
+        if not isinstance(head, SegmentedStage):
+            continue
+        profile = head.get_cache_profile()
+        cache_keys[plan.topic.name] = [
+            SegmentCache.make_key(fingerprint, plan.topic.name, idx, profile)
+            for idx in range(head.get_segment_count())
+        ]
+    return cache_keys
 
 
 class Processor:
     """This class is responsible for populating the buffer pool.
     It maintains a list of execution plans, returned to it by the McapCatalog,
     keeps on calling the next until no more data is available on any topic
+
+    With `workers` > 1 the plans run in parallel on worker processes, each one
+    owning its reader and encoder, as the plans are independent from each other.
+    At most `workers` plans run at a time, segments are streamed back through a
+    pipe per worker and added to the buffer pool by the parent.
+
+    Segments are published to the buffer pool as soon as they are produced,
+    and the pool knows the number of segments of every topic from the start.
+    Consumers can wait for segments with BufferPool.wait_segment while `start`
+    runs, ex. in the thread of `start_in_background`.
+
+    With a `segment_cache` produced segments are also stored in it, and topics
+    whose segments are all cached are loaded from it instead of being
+    processed, their plan never opens the bag.
     """
 
+    # Forking a process that runs encoder or server threads isn't safe
+    MP_START_METHOD = "spawn"
+
     def __init__(
         self,
         filename: str,
         buffer_pool: BufferPool = BufferPool(),
         include_topics: List[str] = [],
+        workers: int = 1,
+        segment_cache: SegmentCache | None = None,
     ) -> None:
         self._filename = filename
         self._buffer_pool = buffer_pool  # dependency injection
+        self._workers = workers
+        self._segment_cache = segment_cache
 
         catalog = Catalog(self._filename)
         catalog.set_include_topics(include_topics)
         self._execution_plans = catalog.get_execution_plans()
+        self._cache_keys: Dict[str, List[str]] = (
+            _get_cache_keys(filename, self._execution_plans)
+            if segment_cache is not None
+            else {}
+        )
+
+        self._progress_lock = threading.Lock()
+        self._produced_cnt = {plan.topic.name: 0 for plan in self._execution_plans}
+
+        for plan in self._execution_plans:
+            head = plan.get_head()
+            if isinstance(head, SegmentedStage):
+                self._buffer_pool.set_segment_count(
+                    plan.topic.name, head.get_segment_count()
+                )
+
+    def get_progress(self) -> Dict[str, Tuple[int, int]]:
+        """Progress of every plan, can be polled while `start` runs
+
+        Returns:
+            Dict[str, Tuple[int, int]]: Topic name to (segments produced, total
+                segments), the total is -1 if the plan doesn't know it upfront
+        """
+        progress = {}
+        with self._progress_lock:
+            for plan in self._execution_plans:
+                head = plan.get_head()
+                total = (
+                    head.get_segment_count() if isinstance(head, SegmentedStage) else -1
+                )
+                progress[plan.topic.name] = (self._produced_cnt[plan.topic.name], total)
+        return progress
+
+    def start_in_background(self) -> threading.Thread:
+        """Run `start` in a daemon thread, segments can be waited for meanwhile"""
+        thread = threading.Thread(target=self.start, daemon=True)
+        thread.start()
+        return thread
 
     def start(self):
-        total_plan_cnt = len(self._execution_plans)
+        plans = [
+            plan
+            for plan in self._execution_plans
+            if not self._load_cached_topic(plan.topic.name)
+        ]
+        if len(plans) == 0:
+            return
+        if self._workers > 1:
+            self._start_parallel(plans)
+            return
+
+        total_plan_cnt = len(plans)
         plan_processed = set()
 
         idx = 0
         while True:
-            curr_plan = self._execution_plans[idx % total_plan_cnt]
+            curr_plan = plans[idx % total_plan_cnt]
             idx += 1
 
             next_segment = curr_plan.next()
             if next_segment is None:
+                if curr_plan.topic.name not in plan_processed:
+                    self._finish_topic(curr_plan.topic.name)
                 plan_processed.add(curr_plan.topic.name)
                 if len(plan_processed) == total_plan_cnt:
                     break  # all topics processed
                 continue
 
-            self._buffer_pool.add_segment(curr_plan.topic.name, next_segment)
+            self._add_segment(curr_plan.topic.name, next_segment)
+
+    def _add_segment(self, topic_name: str, segment: SegmentNode) -> None:
+        with self._progress_lock:
+            segment_idx = self._produced_cnt[topic_name]
+            self._produced_cnt[topic_name] += 1
+        self._buffer_pool.add_segment(topic_name, segment, segment_idx)
+
+        cache_keys = self._cache_keys.get(topic_name, [])
+        if self._segment_cache is not None and segment_idx < len(cache_keys):
+            store_segment(self._segment_cache, cache_keys[segment_idx], segment)
+
+    def _load_cached_topic(self, topic_name: str) -> bool:
+        """Add every segment of a topic from the segment cache, False if any of
+        them isn't cached, the topic must be processed then.
+        """
+        if self._segment_cache is None or topic_name not in self._cache_keys:
+            return False
+        segments = []
+        for key in self._cache_keys[topic_name]:
+            segment = load_segment(self._segment_cache, key)
+            if segment is None:
+                return False
+            segments.append(segment)
+
+        for segment_idx, segment in enumerate(segments):
+            self._buffer_pool.add_segment(topic_name, segment, segment_idx)
+            with self._progress_lock:
+                self._produced_cnt[topic_name] += 1
+        self._finish_topic(topic_name)
+        return True
+
+    def _finish_topic(self, topic_name: str) -> None:
+        """A plan may produce fewer segments than the catalog expected, ex. when
+        its topic starts after the bag, the produced count is the final one.
+        """
+        with self._progress_lock:
+            produced_cnt = self._produced_cnt[topic_name]
+        self._buffer_pool.set_segment_count(topic_name, produced_cnt)
+
+    def _start_parallel(self, plans: List[ExecutionPlan]) -> None:
+        ctx = multiprocessing.get_context(self.MP_START_METHOD)
+        pending = deque(plan.topic.name for plan in plans)
+        running: Dict[
+            multiprocessing.connection.Connection,
+            Tuple[str, multiprocessing.process.BaseProcess],
+        ] = {}
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < self._workers:
+                    topic_name = pending.popleft()
+                    recv_conn, send_conn = ctx.Pipe(duplex=False)
+                    process = ctx.Process(
+                        target=_run_plan_worker,
+                        args=(self._filename, topic_name, send_conn),
+                        daemon=True,
+                    )
+                    process.start()
+                    # Only the worker writes, EOF is seen once it closes its end
+                    send_conn.close()
+                    running[recv_conn] = (topic_name, process)
+
+                for conn in multiprocessing.connection.wait(list(running.keys())):
+                    assert isinstance(conn, multiprocessing.connection.Connection)
+                    topic_name, process = running[conn]
+                    try:
+                        data = conn.recv_bytes()
+                    except EOFError:
+                        del running[conn]
+                        conn.close()
+                        process.join()
+                        if process.exitcode != 0:
+                            raise RuntimeError(
+                                f"Worker for topic {topic_name} exited with code {process.exitcode}"
+                            )
+                        self._finish_topic(topic_name)
+                        continue
+                    self._add_segment(topic_name, decode_segment(data))
+        finally:
+            for conn, (_, process) in running.items():
+                process.terminate()
+                process.join()
+                conn.close()
+
+
+class OnDemandProcessor:
+    """Populates the buffer pool lazily, one segment at a time.
+
+    Unlike Processor, nothing is transcoded up front. The playlist of a topic is
+    generated from the catalog metadata, and segment N is only produced when it
+    is first requested, by seeking the execution plan of its topic to it.
+
+    Concurrent requests for the same segment share a single Future. The
+    segments following the playhead of each client are produced speculatively,
+    see PrefetchScheduler: `prefetch_cnt` segments at 1x, more for a client
+    playing faster. Requests pass a `client_id` to get a playhead of their own.
+    Speculative segments never take the last worker, it is kept for the
+    segments clients wait for, and the ones closest to a playhead go first.
+    A topic has up to `max_workers` execution plans, so the segments of the
+    read ahead window of a played topic are produced in parallel.
+
+    When `renditions` are given every segment holds one video per rendition and
+    a master playlist is available for adaptive bitrate playback. When `mosaic`
+    is set the cameras are served as one grid video, see Catalog.set_mosaic.
+    When `thumbnails` is set the sprite sheets of each camera are served as
+    segments of their own topic, see Catalog.set_thumbnails. With `lod_tiers`
+    LiDAR segments hold a downsampled cloud per tier, see Catalog.set_lod_tiers.
+    With `compression` LiDAR segments are compressed with that codec, see
+    Catalog.set_compression. When `undistort` is set raw cameras are
+    undistorted, see Catalog.set_undistort.
+
+    `aget_segment` is the asyncio flavour of `get_segment`, production still
+    runs on the `max_workers` threads so the event loop is never blocked.
+    Production is cancelled cooperatively once nobody waits for a segment:
+    when every task awaiting it is cancelled, ex. its client disconnected,
+    and for speculative segments when a client seeks away from them.
+
+    With a `segment_cache` a segment missing from the buffer pool is looked up
+    in the cache before being produced, and produced segments are cached.
+    Cached segments are served without the bag being opened.
+
+    When processes share the buffer pool, ex. a SharedBufferPool, a segment is
+    only produced by the process that claims it, see BufferPool.claim_segment.
+    """
+
+    CLAIM_POLL_INTERVAL = 0.05
+
+    def __init__(
+        self,
+        filename: str,
+        buffer_pool: BufferPool | None = None,
+        include_topics: List[str] = [],
+        prefetch_cnt: int = 2,
+        max_workers: int = 2,
+        renditions: List[Rendition] = [],
+        mosaic: bool = False,
+        thumbnails: bool = False,
+        max_prefetch_cnt: int = 16,
+        segment_cache: SegmentCache | None = None,
+        lod_tiers: List[LodTier] = [],
+        compression: str | None = None,
+        undistort: bool = False,
+        remap_cache_dir: str | None = None,
+    ) -> None:
+        self._filename = filename
+        self._segment_cache = segment_cache
+        self._buffer_pool = buffer_pool if buffer_pool is not None else BufferPool()
+        self._scheduler = PrefetchScheduler(prefetch_cnt, max_prefetch_cnt)
+        self._max_speculative_cnt = max(1, max_workers - 1)
+
+        self._catalog_options = dict(
+            include_topics=include_topics,
+            renditions=renditions,
+            mosaic=mosaic,
+            thumbnails=thumbnails,
+            lod_tiers=lod_tiers,
+            compression=compression,
+            undistort=undistort,
+            remap_cache_dir=remap_cache_dir,
+        )
+        self._plans = self._build_plans()
+
+        for topic_name in self._plans:
+            self._buffer_pool.set_segment_count(
+                topic_name, self.get_segment_count(topic_name)
+            )
+        # Computed on first use, see _get_segment_keys
+        self._cache_keys: Dict[str, List[str]] | None = None
+
+        # A plan is stateful, it produces one segment at a time. Each topic has
+        # up to `max_workers` plans so its segments are produced in parallel,
+        # more are built on demand, see _acquire_plan. Idle plans are kept with
+        # the index of the segment they would produce next without a seek.
+        self._idle_plans: Dict[str, List[Tuple[ExecutionPlan, int]]] = {
+            name: [(plan, 0)] for name, plan in self._plans.items()
+        }
+        self._plan_cnt = {name: 1 for name in self._plans}
+        self._plans_changed = threading.Condition()
+
+        # Reentrant, cancelling a future runs its callbacks in the same thread
+        self._lock = threading.RLock()
+        self._in_flight: Dict[Tuple[str, int], Future] = {}
+        # Set to stop producing an in flight segment, see _cancel
+        self._cancel_events: Dict[Tuple[str, int], threading.Event] = {}
+        # Number of requests waiting on each in flight segment
+        self._waiter_cnt: Dict[Tuple[str, int], int] = {}
+        # In flight segments nobody asked for yet
+        self._speculative: Set[Tuple[str, int]] = set()
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._is_shutdown = False
+        # The workers were shut down, requests still coming start new ones
+        self._is_executor_shutdown = False
+
+    def get_topic_names(self) -> List[str]:
+        return list(self._plans.keys())
+
+    def _get_segment_keys(self) -> Dict[str, List[str]]:
+        """Key of every segment, fingerprinting the bag on first use"""
+        with self._lock:
+            if self._cache_keys is None:
+                self._cache_keys = _get_cache_keys(
+                    self._filename, list(self._plans.values())
+                )
+            return self._cache_keys
+
+    def get_segment_key(self, topic_name: str, segment_idx: int) -> str | None:
+        """Content key of a segment, see SegmentCache.make_key. It changes with
+        the bag and with the way the segment is encoded, so a segment can be
+        cached for good under it. None if the segment doesn't exist.
+        """
+        keys = self._get_segment_keys().get(topic_name, [])
+        if segment_idx < 0 or segment_idx >= len(keys):
+            return None
+        return keys[segment_idx]
+
+    def open_cached_payload(
+        self, topic_name: str, segment_idx: int, rendition: str | None = None
+    ) -> Tuple[BinaryIO, int, int] | None:
+        """The segment cache entry of a segment missing from the buffer pool,
+        with the offset and length of a payload in it, so that the payload can
+        be sent from the file without being read. The caller closes the file.
+
+        Returns:
+            Tuple[BinaryIO, int, int] | None: None if the segment isn't cached,
+                is in the buffer pool already, or is compressed (its payloads
+                may have to be decompressed for the client)
+        """
+        if self._segment_cache is None:
+            return None
+        if self._buffer_pool.has_segment(topic_name, segment_idx):
+            return None
+        key = self.get_segment_key(topic_name, segment_idx)
+        if key is None:
+            return None
+        entry_file = self._segment_cache.open(key)
+        if entry_file is None:
+            return None
+        try:
+            offset, length, encoding = read_payload_span(entry_file, rendition)
+        except BaseException:
+            entry_file.close()
+            raise
+        if encoding is not None:
+            entry_file.close()
+            return None
+        return entry_file, offset, length
+
+    def follow(
+        self, topic_name: str, segment_idx: int, client_id: Hashable = None
+    ) -> None:
+        """Move the playhead of a client that was served a segment without
+        requesting it, ex. from open_cached_payload, and prefetch after it
+        """
+        if topic_name not in self._plans:
+            return
+        segment_seconds = self.get_segment_seconds(topic_name, segment_idx)
+        with self._lock:
+            self._scheduler.update(client_id, topic_name, segment_idx, segment_seconds)
+            self._cancel_abandoned_prefetch(topic_name)
+            self._fill_prefetch()
+
+    def _get_content_stage(self, topic_name: str) -> AbstractStage | None:
+        """Stage producing the segments of a topic, under its CompressionStage"""
+        head = self._plans[topic_name].get_head()
+        if isinstance(head, CompressionStage):
+            return head.child_executor
+        return head
+
+    def get_video_stage(self, topic_name: str) -> H264ConvertorStage | None:
+        """Stage encoding the segments of a topic, None if it isn't a video"""
+        if topic_name not in self._plans:
+            return None
+        head = self._get_content_stage(topic_name)
+        if not isinstance(head, H264ConvertorStage):
+            return None
+        return head
+
+    def get_segment_count(self, topic_name: str) -> int:
+        head = self._plans[topic_name].get_head()
+        assert isinstance(head, SegmentedStage)
+        return head.get_segment_count()
+
+    def get_segment_seconds(self, topic_name: str, segment_idx: int) -> float:
+        """Seconds of the recording covered by a segment"""
+        head = self._get_content_stage(topic_name)
+        if isinstance(head, ThumbnailStage):
+            layout = head.layout
+            return layout.thumbnails_per_sheet * layout.interval_ns / 1e9
+        if isinstance(head, PointCloudStage):
+            return head.get_segment_seconds(segment_idx)
+        assert isinstance(head, H264ConvertorStage)
+        return head.layout.get_segment_seconds(segment_idx)
+
+    def get_playlist(
+        self, topic_name: str, segment_uri: Callable[[int], str]
+    ) -> str | None:
+        """m3u8 playlist of a topic, None if the topic isn't a video"""
+        head = self.get_video_stage(topic_name)
+        if head is None:
+            return None
+        return build_media_playlist(head.layout, segment_uri)
+
+    def get_thumbnail_vtt(
+        self, topic_name: str, sheet_uri: Callable[[int], str]
+    ) -> str | None:
+        """WebVTT index of a thumbnail topic, None if it isn't one"""
+        if topic_name not in self._plans:
+            return None
+        head = self._get_content_stage(topic_name)
+        if not isinstance(head, ThumbnailStage):
+            return None
+        return build_thumbnail_vtt(head.layout, sheet_uri)
+
+    def is_point_cloud(self, topic_name: str) -> bool:
+        """Whether the segments of a topic are point cloud segments, see
+        pack_point_clouds
+        """
+        if topic_name not in self._plans:
+            return False
+        return isinstance(self._get_content_stage(topic_name), PointCloudStage)
+
+    def get_lod_tiers(self, topic_name: str) -> List[LodTier]:
+        """Levels of detail of a LiDAR topic, empty if it has none"""
+        head = self._get_content_stage(topic_name)
+        if isinstance(head, PointCloudStage):
+            return head.get_lod_tiers()
+        return []
+
+    def get_renditions(self, topic_name: str) -> List[Rendition]:
+        """Renditions of a topic, empty if it is encoded at a single bitrate"""
+        head = self._get_content_stage(topic_name)
+        if isinstance(head, H264LadderStage):
+            return head.renditions
+        return []
+
+    def get_master_playlist(
+        self, topic_name: str, playlist_uri: Callable[[Rendition], str]
+    ) -> str | None:
+        """Master m3u8 playlist of a topic, None if it has no renditions"""
+        if topic_name not in self._plans:
+            return None
+        renditions = self.get_renditions(topic_name)
+        if len(renditions) == 0:
+            return None
+        return build_master_playlist(renditions, playlist_uri)
+
+    def request_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        client_id: Hashable = None,
+        prefetch: bool = True,
+    ) -> Future | None:
+        """Schedule a segment, None if the topic or segment doesn't exist.
+        Requests that don't `prefetch` neither move a playhead nor start any
+        speculative work, ex. the export of a clip.
+
+        Returns:
+            Future | None: Resolves to the SegmentNode once it is produced
+        """
+        future = self._request(topic_name, segment_idx, client_id, prefetch)
+        if future is not None:
+            future.add_done_callback(
+                lambda _: self._release(topic_name, segment_idx, future)
+            )
+        return future
+
+    def get_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        client_id: Hashable = None,
+        prefetch: bool = True,
+    ) -> SegmentNode | None:
+        """Get a segment, producing it if needed. Blocks until it is available"""
+        future = self.request_segment(topic_name, segment_idx, client_id, prefetch)
+        if future is None:
+            return None
+        return future.result(timeout=timeout)
+
+    async def aget_segment(
+        self, topic_name: str, segment_idx: int, client_id: Hashable = None
+    ) -> SegmentNode | None:
+        """Same as get_segment without blocking the event loop. If the awaiting
+        task is cancelled and no other request waits for the segment, its
+        production is cancelled too.
+        """
+        future = self._request(topic_name, segment_idx, client_id)
+        if future is None:
+            return None
+        try:
+            # Other requests may share the future, it mustn't be cancelled here
+            return await asyncio.shield(asyncio.wrap_future(future))
+        finally:
+            self._release(topic_name, segment_idx, future)
+
+    def shutdown(self, finish_pending: bool = False) -> None:
+        """Stop producing segments. Speculative work that hasn't started yet is
+        dropped unless finish_pending is set.
+        """
+        with self._lock:
+            self._is_shutdown = True
+            self._is_executor_shutdown = True
+            executor = self._executor
+        executor.shutdown(wait=True, cancel_futures=not finish_pending)
+
+    def close(self) -> None:
+        """Retire the processor without waiting, ex. evicted while requests
+        may still hold it. Speculative work stops right away, requests that
+        still come are served, and the workers are shut down once no segment
+        is in flight.
+        """
+        with self._lock:
+            self._is_shutdown = True
+            for key in list(self._speculative):
+                self._cancel(key)
+            self._shutdown_if_idle()
+
+    def _shutdown_if_idle(self) -> None:
+        """Shut down the workers of a closed processor once no segment is in
+        flight. Must be called with the lock held.
+        """
+        if self._is_shutdown and not self._is_executor_shutdown:
+            if len(self._in_flight) == 0:
+                self._executor.shutdown(wait=False)
+                self._is_executor_shutdown = True
+
+    def _request(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        client_id: Hashable,
+        prefetch: bool = True,
+    ) -> Future | None:
+        """Schedule a segment for a client that waits for it, the caller must
+        `_release` the returned future once it stops waiting.
+        """
+        if topic_name not in self._plans:
+            return None
+        if segment_idx < 0 or segment_idx >= self.get_segment_count(topic_name):
+            return None
+
+        segment_seconds = self.get_segment_seconds(topic_name, segment_idx)
+        with self._lock:
+            if prefetch:
+                self._scheduler.update(
+                    client_id, topic_name, segment_idx, segment_seconds
+                )
+                self._cancel_abandoned_prefetch(topic_name)
+            future = self._schedule(topic_name, segment_idx)
+            assert future is not None
+            key = (topic_name, segment_idx)
+            if self._in_flight.get(key) is future:
+                self._waiter_cnt[key] = self._waiter_cnt.get(key, 0) + 1
+                # Not speculative anymore, a client waits for it
+                self._speculative.discard(key)
+            if prefetch:
+                self._fill_prefetch()
+            return future
+
+    def _release(self, topic_name: str, segment_idx: int, future: Future) -> None:
+        """A request stopped waiting for a segment, cancel it if it was the last"""
+        key = (topic_name, segment_idx)
+        with self._lock:
+            if self._in_flight.get(key) is not future:
+                return  # already done or cancelled
+            self._waiter_cnt[key] -= 1
+            if self._waiter_cnt[key] == 0 and not future.done():
+                self._cancel(key)
+                self._shutdown_if_idle()
+
+    def _cancel_abandoned_prefetch(self, topic_name: str) -> None:
+        """A client moved in a topic, stop producing the segments of the topic
+        that were prefetched and are in the window of no client anymore.
+        """
+        for key in list(self._speculative):
+            other_topic_name, other_idx = key
+            if other_topic_name != topic_name:
+                continue
+            if not self._scheduler.is_wanted(other_topic_name, other_idx):
+                self._cancel(key)
+
+    def _fill_prefetch(self) -> None:
+        """Schedule the most urgent segments wanted by the clients, as long as
+        speculative work leaves a worker free. Must be called with the lock held.
+        """
+        if self._is_shutdown:
+            return
+        for topic_name, segment_idx in self._scheduler.get_candidates():
+            if len(self._speculative) >= self._max_speculative_cnt:
+                return
+            key = (topic_name, segment_idx)
+            if segment_idx >= self.get_segment_count(topic_name):
+                continue
+            if key in self._in_flight:
+                continue
+            if self._buffer_pool.has_segment(topic_name, segment_idx):
+                continue
+            self._schedule(topic_name, segment_idx, speculative=True)
+            self._speculative.add(key)
+
+    def _cancel(self, key: Tuple[str, int]) -> None:
+        """Forget an in flight segment and stop producing it. A segment that
+        hasn't started is never started, a running one stops at the next check
+        of its stages. Must be called with the lock held.
+        """
+        future = self._in_flight.pop(key)
+        self._waiter_cnt.pop(key, None)
+        self._speculative.discard(key)
+        self._cancel_events.pop(key).set()
+        future.cancel()
+
+    def _schedule(
+        self, topic_name: str, segment_idx: int, speculative: bool = False
+    ) -> Future | None:
+        """Must be called with the lock held"""
+        if speculative and self._is_shutdown:
+            return None
+
+        segment = self._buffer_pool.get_segment(topic_name, segment_idx)
+        if segment is not None:
+            done: Future = Future()
+            done.set_result(segment)
+            return done
+
+        # Coalesce with the request already producing this segment
+        key = (topic_name, segment_idx)
+        future = self._in_flight.get(key)
+        if future is None:
+            if self._is_executor_shutdown:
+                # A request held the processor when it was closed, serve it
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+                self._is_executor_shutdown = False
+            cancel_event = threading.Event()
+            future = self._executor.submit(
+                self._produce, topic_name, segment_idx, cancel_event
+            )
+            self._in_flight[key] = future
+            self._cancel_events[key] = cancel_event
+        return future
+
+    def _produce(
+        self, topic_name: str, segment_idx: int, cancel_event: threading.Event
+    ) -> SegmentNode | None:
+        key = (topic_name, segment_idx)
+        claimed = False
+        try:
+            segment, claimed = self._claim(topic_name, segment_idx, cancel_event)
+            if claimed:
+                segment = self._buffer_pool.get_segment(topic_name, segment_idx)
+                if segment is None:
+                    segment = self._load_cached(topic_name, segment_idx)
+                if segment is None:
+                    segment = self._run_plan(topic_name, segment_idx, cancel_event)
+                    if segment is not None:
+                        self._buffer_pool.add_segment(topic_name, segment, segment_idx)
+                        self._store_cached(topic_name, segment_idx, segment)
+        finally:
+            if claimed:
+                self._buffer_pool.release_segment(topic_name, segment_idx)
+            with self._lock:
+                # A cancelled segment may already be produced again
+                if self._cancel_events.get(key) is cancel_event:
+                    self._in_flight.pop(key, None)
+                    self._cancel_events.pop(key, None)
+                    self._waiter_cnt.pop(key, None)
+                    self._speculative.discard(key)
+                # A worker is free, keep the read ahead windows full
+                self._fill_prefetch()
+                self._shutdown_if_idle()
+
+        return segment
+
+    def _run_plan(
+        self, topic_name: str, segment_idx: int, cancel_event: threading.Event
+    ) -> SegmentNode | None:
+        """Produce a segment with an idle plan of its topic, None if cancelled"""
+        acquired = self._acquire_plan(topic_name, segment_idx, cancel_event)
+        if acquired is None:
+            return None
+        plan, position = acquired
+        head = plan.get_head()
+        assert isinstance(head, SegmentedStage)
+
+        # Unknown state on failure, the next segment must seek
+        next_position = -1
+        try:
+            if position != segment_idx:
+                head.seek_segment(segment_idx)
+            head.set_cancel_event(cancel_event)
+            try:
+                segment = plan.next()
+            except StageCancelledError:
+                return None
+            finally:
+                head.set_cancel_event(None)
+            next_position = segment_idx + 1
+            return segment
+        finally:
+            with self._plans_changed:
+                self._idle_plans[topic_name].append((plan, next_position))
+                self._plans_changed.notify_all()
+
+    def _acquire_plan(
+        self, topic_name: str, segment_idx: int, cancel_event: threading.Event
+    ) -> Tuple[ExecutionPlan, int] | None:
+        """Take an idle plan of a topic, the one that reaches `segment_idx`
+        without a seek if any. While every plan is busy another one is built,
+        up to `max_workers` plans, past that wait for one to be released.
+
+        Returns:
+            Tuple[ExecutionPlan, int] | None: The plan and the index of the
+                segment it would produce next, None if cancelled while waiting
+        """
+        with self._plans_changed:
+            while not cancel_event.is_set():
+                idle_plans = self._idle_plans[topic_name]
+                for i, (_, position) in enumerate(idle_plans):
+                    if position == segment_idx:
+                        return idle_plans.pop(i)
+                if len(idle_plans) > 0:
+                    return idle_plans.pop()
+                if self._plan_cnt[topic_name] < self._max_workers:
+                    self._plan_cnt[topic_name] += 1
+                    break
+                self._plans_changed.wait(timeout=self.CLAIM_POLL_INTERVAL)
+            else:
+                return None
+
+        # Building a plan doesn't open the bag, its reader opens on first read
+        try:
+            plan = self._build_plans()[topic_name]
+        except BaseException:
+            with self._plans_changed:
+                self._plan_cnt[topic_name] -= 1
+                self._plans_changed.notify_all()
+            raise
+        return plan, 0
+
+    def _build_plans(self) -> Dict[str, ExecutionPlan]:
+        """A new plan per topic, only plans that produce a known number of
+        segments can be seeked.
+        """
+        options = self._catalog_options
+        catalog = Catalog(self._filename)
+        catalog.set_include_topics(options["include_topics"])
+        catalog.set_on_demand(True)
+        catalog.set_renditions(options["renditions"])
+        catalog.set_mosaic(options["mosaic"])
+        catalog.set_thumbnails(options["thumbnails"])
+        catalog.set_lod_tiers(options["lod_tiers"])
+        catalog.set_compression(options["compression"])
+        catalog.set_undistort(options["undistort"], options["remap_cache_dir"])
+        return {
+            plan.topic.name: plan
+            for plan in catalog.get_execution_plans()
+            if isinstance(plan.get_head(), SegmentedStage)
+        }
+
+    def _claim(
+        self, topic_name: str, segment_idx: int, cancel_event: threading.Event
+    ) -> Tuple[SegmentNode | None, bool]:
+        """Claim the production of a segment, see BufferPool.claim_segment.
+        While another process holds the claim, wait for it to add the segment
+        to the pool, claiming again every CLAIM_POLL_INTERVAL seconds in case
+        it gave up.
+
+        Returns:
+            Tuple[SegmentNode | None, bool]: The segment if another process
+                produced it, and whether the claim was taken
+        """
+        while not cancel_event.is_set():
+            if self._buffer_pool.claim_segment(topic_name, segment_idx):
+                return None, True
+            try:
+                segment = self._buffer_pool.wait_segment(
+                    topic_name, segment_idx, timeout=self.CLAIM_POLL_INTERVAL
+                )
+            except TimeoutError:
+                continue
+            return segment, False
+        return None, False
+
+    def _load_cached(self, topic_name: str, segment_idx: int) -> SegmentNode | None:
+        """Add a segment from the segment cache to the buffer pool"""
+        if self._segment_cache is None:
+            return None
+        segment = load_segment(
+            self._segment_cache, self._get_segment_keys()[topic_name][segment_idx]
+        )
+        if segment is None:
+            return None
+        self._buffer_pool.add_segment(topic_name, segment, segment_idx)
+        return segment
+
+    def _store_cached(
+        self, topic_name: str, segment_idx: int, segment: SegmentNode
+    ) -> None:
+        if self._segment_cache is None:
+            return
+        store_segment(
+            self._segment_cache,
+            self._get_segment_keys()[topic_name][segment_idx],
+            segment,
+        )
@@ -0,0 +1,268 @@
+"""
+File responses
+src/server/responses.py
+
+Responses sending parts of a file without reading them into memory. When the
+ASGI server supports the zero copy send extension
+(`http.response.zerocopysend`) the file descriptor is handed to it, and it
+sends the bytes with sendfile. Otherwise a part is read and sent `CHUNK_SIZE`
+bytes at a time, so the memory used by a request doesn't depend on the size
+of what it sends.
+
+FileRangeResponse answers the range requests of RFC 9110 (single, suffix and
+multiple ranges, If-Range) with the same machinery:
+
+```python
+ranges = None
+if is_range_fresh(request.headers.get("if-range"), validators):
+    ranges = parse_byte_ranges(request.headers["range"], file_size)
+return FileRangeResponse(file, ranges, file_size, validators, "video/mp4")
+```
+"""
+
+import os
+import re
+import secrets
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO, Collection, Dict, List, Mapping, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Bytes read per chunk when the server can't send from the file itself
+CHUNK_SIZE = 256 * 1024
+
+ZERO_COPY_SEND_EXTENSION = "http.response.zerocopysend"
+
+# Requests asking for more ranges are answered with the whole file, as RFC
+# 9110 allows, instead of with as many parts
+MAX_RANGE_COUNT = 16
+
+_RANGE_SPEC = re.compile(r"([0-9]*)-([0-9]*)")
+
+# An inclusive range of bytes, as in Content-Range
+ByteRange = Tuple[int, int]
+
+
+def supports_zero_copy_send(scope: Scope) -> bool:
+    return ZERO_COPY_SEND_EXTENSION in scope.get("extensions", {})
+
+
+async def send_file_span(
+    scope: Scope, send: Send, file: BinaryIO, offset: int, length: int
+) -> None:
+    """Send `length` bytes of a file from `offset` as the body of a response
+    whose start was sent, see the module docstring. The body is left open.
+    """
+    if length <= 0:
+        return
+    if supports_zero_copy_send(scope):
+        await send(
+            {
+                "type": ZERO_COPY_SEND_EXTENSION,
+                "file": file,
+                "offset": offset,
+                "count": length,
+                "more_body": True,
+            }
+        )
+        return
+
+    fd = file.fileno()
+    end = offset + length
+    while offset < end:
+        chunk = await run_in_threadpool(
+            os.pread, fd, min(CHUNK_SIZE, end - offset), offset
+        )
+        if len(chunk) == 0:
+            raise EOFError(f"File ended {end - offset} bytes before the span")
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        offset += len(chunk)
+
+
+def resolve_served_path(
+    root: Path, path: str, suffixes: Collection[str] | None = None
+) -> Path | None:
+    """The file at `path`, relative to `root`, None if it isn't a file under
+    `root`, or when `suffixes` are given if its suffix isn't one of them.
+    Symlinks are followed before the check, so neither `..` nor a link can
+    reach a file outside of `root`, or one of another type.
+    """
+    root = root.resolve()
+    resolved = (root / path).resolve()
+    if not resolved.is_relative_to(root) or not resolved.is_file():
+        return None
+    if suffixes is not None and resolved.suffix.lower() not in suffixes:
+        return None
+    return resolved
+
+
+def get_file_validators(stat: os.stat_result) -> Dict[str, str]:
+    """Headers of a file response letting clients revalidate and resume it"""
+    return {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+    }
+
+
+def is_range_fresh(if_range: str | None, validators: Mapping[str, str]) -> bool:
+    """Whether the Range of a request applies, that is whether its If-Range,
+    an ETag or a date, still matches the file. Weak ETags never match.
+    """
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == validators["ETag"]
+    try:
+        return parsedate_to_datetime(if_range) == parsedate_to_datetime(
+            validators["Last-Modified"]
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_byte_ranges(range_header: str, file_size: int) -> List[ByteRange] | None:
+    """Ranges of a Range header within a file, overlapping or adjacent ones
+    merged
+
+    Returns:
+        List[ByteRange] | None: The ranges in order, None if the header should
+            be ignored (not a valid byte range set, or too many ranges)
+
+    Raises:
+        ValueError: No range overlaps the file (416 Range Not Satisfiable)
+    """
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [spec.strip() for spec in range_set.split(",") if spec.strip()]
+    if len(specs) == 0 or len(specs) > MAX_RANGE_COUNT:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = _RANGE_SPEC.fullmatch(spec)
+        if match is None or spec == "-":
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range, the last bytes of the file
+            suffix_length = int(last)
+            if suffix_length > 0 and file_size > 0:
+                ranges.append((max(file_size - suffix_length, 0), file_size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else file_size - 1
+        if last and end < start:
+            return None
+        if start < file_size:
+            ranges.append((start, min(end, file_size - 1)))
+
+    if len(ranges) == 0:
+        raise ValueError(f"No range of '{range_header}' in {file_size} bytes")
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FileSpanResponse(Response):
+    """Sends `length` bytes of an open file from `offset`, see send_file_span.
+    The file is closed once sent.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        offset: int,
+        length: int,
+        status_code: int = 200,
+        headers: Mapping[str, str] | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        self.file = file
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self._set_body([(offset, length)])
+
+    def _set_body(self, parts: List[bytes | Tuple[int, int]]) -> None:
+        """Parts of the body, bytes or (offset, length) spans of the file"""
+        self._parts = parts
+        length = sum(len(p) if isinstance(p, bytes) else p[1] for p in parts)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            if scope["method"].upper() != "HEAD":
+                for part in self._parts:
+                    if isinstance(part, bytes):
+                        await send(
+                            {
+                                "type": "http.response.body",
+                                "body": part,
+                                "more_body": True,
+                            }
+                        )
+                    else:
+                        await send_file_span(scope, send, self.file, *part)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.file.close()
+
+
+class FileRangeResponse(FileSpanResponse):
+    """Sends an open file of `file_size` bytes whole (200) when `ranges` is
+    None, and otherwise its ranges (206), see parse_byte_ranges. Several
+    ranges are sent as a multipart/byteranges body. The file is closed once
+    sent.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        ranges: List[ByteRange] | None,
+        file_size: int,
+        headers: Mapping[str, str] | None = None,
+        media_type: str = "application/octet-stream",
+    ) -> None:
+        if ranges is None:
+            super().__init__(file, 0, file_size, 200, headers, media_type)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            super().__init__(file, start, end - start + 1, 206, headers, media_type)
+            self.headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+            return
+
+        boundary = secrets.token_hex(16)
+        super().__init__(
+            file, 0, 0, 206, headers, f"multipart/byteranges; boundary={boundary}"
+        )
+        parts: List[bytes | Tuple[int, int]] = []
+        for start, end in ranges:
+            part_headers = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+            )
+            parts += [part_headers.encode(), (start, end - start + 1), b"\r\n"]
+        parts.append(f"--{boundary}--\r\n".encode())
+        self._set_body(parts)
@@ -0,0 +1,212 @@
+"""
+Persistent transcode cache
+src/server/segment_cache.py
+
+Encoded segments outlive the server: they are stored on disk under a content
+hash of everything that determines their bytes, i.e the bag, the topic, the
+segment index and the cache profile of the stage producing it (its encoder
+parameters and version, see AbstractStage.get_cache_profile). Restarting the
+server, or reprocessing a bag that didn't change, serves the segments from
+the cache without opening the bag.
+
+The bag is identified by a fingerprint of its size and of its first and last
+bytes rather than by its path, so that a moved bag still hits the cache and
+a rewritten one doesn't.
+
+Entries are written atomically, to a temporary file renamed over the entry,
+so that several processes can share a cache directory. The modification time
+of an entry is its last use, the least recently used entries are deleted once
+the cache exceeds its size cap.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+# Bytes hashed at each end of a bag by bag_fingerprint
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024
+# Fraction of the size cap the cache is trimmed down to once it exceeds it
+TRIM_RATIO = 0.9
+
+_ENTRY_SUFFIX = ".seg"
+
+# Compression dictionaries of the entries, kept out of the size cap
+_DICTIONARY_DIR = "dictionaries"
+
+
+def bag_fingerprint(path: str | Path) -> str:
+    """Identify the content of a bag without reading all of it
+
+    Args:
+        path (str | Path): Bag file, or directory of a bag with several files
+
+    Returns:
+        str: Hex digest of the size, head and tail of every file of the bag
+    """
+    path = Path(path)
+    files = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    )
+
+    digest = hashlib.sha256()
+    for file in files:
+        size = file.stat().st_size
+        digest.update(f"{file.name}:{size}".encode())
+        with open(file, "rb") as bag_file:
+            digest.update(bag_file.read(FINGERPRINT_CHUNK_SIZE))
+            if size > FINGERPRINT_CHUNK_SIZE:
+                bag_file.seek(
+                    max(FINGERPRINT_CHUNK_SIZE, size - FINGERPRINT_CHUNK_SIZE)
+                )
+                digest.update(bag_file.read())
+    return digest.hexdigest()
+
+
+class SegmentCache:
+    """Content addressed store of encoded segments, bounded by `size_cap` bytes.
+
+    Thread and process safe: concurrent writers of the same key write the same
+    bytes, the last rename wins. The size of the cache is tracked by the
+    process from a scan at startup, so a cache shared by several processes may
+    exceed its cap until one of them trims it.
+    """
+
+    def __init__(self, cache_dir: str | Path, size_cap: int | None = None) -> None:
+        self._cache_dir = Path(cache_dir)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._size_cap = size_cap
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._scan())
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "deletions": 0}
+
+    @staticmethod
+    def make_key(
+        fingerprint: str, topic_name: str, segment_idx: int, profile: Dict[str, Any]
+    ) -> str:
+        """Key of a segment, see bag_fingerprint and AbstractStage.get_cache_profile"""
+        content = json.dumps(
+            [fingerprint, topic_name, segment_idx, profile], sort_keys=True
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        """Bytes stored under a key, None on a miss"""
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as entry_file:
+                data = entry_file.read()
+            # Mark it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self._stats["hits"] += 1
+        return data
+
+    def open(self, key: str) -> BinaryIO | None:
+        """Open the entry of a key for reading, None on a miss. The file stays
+        readable once open even if the entry is trimmed meanwhile.
+        """
+        path = self._get_path(key)
+        try:
+            entry_file = open(path, "rb")
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self._stats["hits"] += 1
+        return entry_file
+
+    def has(self, key: str) -> bool:
+        return self._get_path(key).exists()
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._get_path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(
+            f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "wb") as entry_file:
+            entry_file.write(data)
+
+        with self._lock:
+            # The key may already be stored, ex. by a processor racing on it
+            try:
+                replaced_size = path.stat().st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            self._size += len(data) - replaced_size
+            self._stats["stores"] += 1
+            if self._size_cap is not None and self._size > self._size_cap:
+                self._trim()
+
+    def put_dictionary(self, dictionary_id: str, data: bytes) -> None:
+        """Store the compression dictionary some entries were compressed with,
+        see CompressionDictionary, so that they can be decompressed by another
+        process. Dictionaries are never trimmed.
+        """
+        path = self._cache_dir / _DICTIONARY_DIR / dictionary_id
+        if path.exists():
+            return
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(
+            f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "wb") as dictionary_file:
+            dictionary_file.write(data)
+        os.replace(tmp_path, path)
+
+    def get_dictionary(self, dictionary_id: str) -> bytes | None:
+        try:
+            with open(self._cache_dir / _DICTIONARY_DIR / dictionary_id, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "bytes": self._size}
+
+    def _get_path(self, key: str) -> Path:
+        # Spread the entries over 256 directories
+        return self._cache_dir / key[:2] / f"{key}{_ENTRY_SUFFIX}"
+
+    def _scan(self) -> List[Tuple[float, Path, int]]:
+        """(last use, path, size) of every entry"""
+        entries = []
+        for path in self._cache_dir.glob(f"*/*{_ENTRY_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # deleted by another process
+            entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _trim(self) -> None:
+        """Delete the least recently used entries until the cache is back under
+        TRIM_RATIO of its cap. Rescans the directory, other processes may have
+        added or deleted entries. Must be called with the lock held.
+        """
+        assert self._size_cap is not None
+        entries = sorted(self._scan())
+        self._size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._size <= self._size_cap * TRIM_RATIO:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+            self._stats["deletions"] += 1
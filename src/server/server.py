@@ -5,76 +5,238 @@ src/server/server.py
 Run with: uvicorn server:app --reload
 """
 
-from fastapi import FastAPI, HTTPException, Query, status
-from typing import List
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import urlencode
+from fastapi import FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from typing import Any, Dict, List, Set, Tuple
 from datetime import datetime
-from models import Directory, File, Feed, GroundTruth, BoundingBox
+from email.utils import formatdate, parsedate_to_datetime
+from models import Directory, File, Feed, GroundTruth
+
+# The server is run from src/server, make the `src` package importable too
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.server.clip import MP4_MEDIA_TYPE, export_clip  # noqa: E402
+from src.server.executors import DEFAULT_LOD_TIERS, DEFAULT_RENDITIONS  # noqa: E402
+from src.server.executors import DEFAULT_CODEC, Rendition, decompress  # noqa: E402
+from src.server.executors import POINT_CLOUD_MEDIA_TYPE, SegmentNode  # noqa: E402
+from src.server.executors import is_depth_topic  # noqa: E402
+from src.server.mcap_catalog import MOSAIC_TOPIC_NAME, THUMBNAILS_SUFFIX  # noqa: E402
+from src.server.playlist import PLAYLIST_MEDIA_TYPE, VTT_MEDIA_TYPE  # noqa: E402
+from src.server.processor import BufferPool, OnDemandProcessor  # noqa: E402
+from src.server.responses import FileRangeResponse, FileSpanResponse  # noqa: E402
+from src.server.responses import get_file_validators, is_range_fresh  # noqa: E402
+from src.server.responses import parse_byte_ranges  # noqa: E402
+from src.server.responses import resolve_served_path  # noqa: E402
+from src.server.segment_cache import SegmentCache  # noqa: E402
+from src.server.shared_buffer_pool import SharedBufferPool  # noqa: E402
+from src.repository.repository import LogInfo, MosaicRepoException  # noqa: E402
+from src.repository.repository import Repository  # noqa: E402
 
 app = FastAPI(title="Mosaic API", version="1.0.0")
 
-# Mock data store
-MOCK_DIRECTORIES = {
-    "data_20250912": Directory(
-        name="data_20250912",
-        file_count=8,
-        files=[
-            File(
-                name="sensor_data_20250916_162938_0.mcap",
-                size_bytes=123456789,
-                created_at=datetime(2025, 9, 16, 16, 29, 38),
-                thumbnail_url="https://cdn.example.com/thumb1.jpg",
-            ),
-            File(
-                name="sensor_data_20250916_163132_0.mcap",
-                size_bytes=98765432,
-                created_at=datetime(2025, 9, 16, 16, 31, 32),
-                thumbnail_url="https://cdn.example.com/thumb2.jpg",
-            ),
-        ],
+# Root under which the `file` parameter of the streaming endpoints is resolved
+DATA_ROOT = Path(os.environ.get("MOSAIC_DATA_ROOT", "."))
+# Files /video serves, bags and recorded videos. The index of the repository,
+# ground truth and the caches kept next to the bags are not served.
+VIDEO_SUFFIXES = {".mcap", ".mp4", ".m4v", ".mov", ".mkv", ".webm", ".ts"}
+
+# Segments of every opened bag share one pool and its memory budget
+BUFFER_POOL_MEMORY_BUDGET = int(
+    os.environ.get("MOSAIC_BUFFER_POOL_BYTES", 1024 * 1024 * 1024)
+)
+BUFFER_POOL_DISK_BUDGET = int(
+    os.environ.get("MOSAIC_SPILL_BYTES", 16 * 1024 * 1024 * 1024)
+)
+
+
+def _create_buffer_pool() -> BufferPool:
+    """When MOSAIC_SHARED_POOL_PATH is set, the workers of the server all map
+    the pool from that file and share their segments. Otherwise each worker
+    has its own pool, spilling evicted segments to MOSAIC_SPILL_DIR (a
+    temporary directory by default).
+    """
+    shared_pool_path = os.environ.get("MOSAIC_SHARED_POOL_PATH")
+    if shared_pool_path:
+        return SharedBufferPool(shared_pool_path, data_size=BUFFER_POOL_MEMORY_BUDGET)
+
+    spill_dir = os.environ.get("MOSAIC_SPILL_DIR") or tempfile.mkdtemp(
+        prefix="mosaic-spill-"
+    )
+    return BufferPool(
+        memory_budget=BUFFER_POOL_MEMORY_BUDGET,
+        spill_dir=spill_dir,
+        disk_budget=BUFFER_POOL_DISK_BUDGET,
     )
-}
 
-MOCK_FEEDS = {
-    "sensor_data_20250916_162938_0.mcap": [
-        Feed(name="/center_rear/camera_info", enabled=True),
-        Feed(name="/passenger_rear/camera_info", enabled=False),
-    ]
-}
-
-MOCK_GROUNDTRUTH = {
-    "sensor_data_20250916_162938_0.mcap": [
-        GroundTruth(
-            layer_name="Nucleus",
-            enabled=True,
-            boxes=[
-                BoundingBox(
-                    id="b1",
-                    label="Car",
-                    confidence=1.0,
-                    x=325,
-                    y=210,
-                    width=240,
-                    height=180,
-                )
-            ],
-        ),
-        GroundTruth(
-            layer_name="ML Output",
-            enabled=True,
-            boxes=[
-                BoundingBox(
-                    id="b2",
-                    label="Truck",
-                    confidence=0.62,
-                    x=320,
-                    y=205,
-                    width=250,
-                    height=190,
+
+_buffer_pool = _create_buffer_pool()
+
+# Encoded segments persist across restarts in MOSAIC_CACHE_DIR, when it is set
+SEGMENT_CACHE_SIZE_CAP = int(
+    os.environ.get("MOSAIC_CACHE_BYTES", 64 * 1024 * 1024 * 1024)
+)
+_segment_cache = (
+    SegmentCache(os.environ["MOSAIC_CACHE_DIR"], SEGMENT_CACHE_SIZE_CAP)
+    if os.environ.get("MOSAIC_CACHE_DIR")
+    else None
+)
+
+# Undistortion remap tables of the raw cameras persist in MOSAIC_REMAP_CACHE_DIR
+REMAP_CACHE_DIR = os.environ.get("MOSAIC_REMAP_CACHE_DIR") or None
+
+# On demand processors of the opened bags, keyed by (resolved bag path, is
+# mosaic), from the least recently used. Past MAX_OPEN_PROCESSORS the least
+# recently used one is shut down.
+MAX_OPEN_PROCESSORS = int(os.environ.get("MOSAIC_MAX_OPEN_PROCESSORS", 16))
+_processors: OrderedDict[Tuple[str, bool], OnDemandProcessor] = OrderedDict()
+_processors_lock = threading.Lock()
+# Segments each processor produces at once, also the number of execution plans
+# of a topic, so the read ahead window of a played topic is produced in parallel
+PROCESSOR_MAX_WORKERS = int(os.environ.get("MOSAIC_PROCESSOR_WORKERS", 2))
+
+# Seconds between two checks of a client waiting for a segment being produced
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Directories, files, feeds and ground truth are served from the index of the
+# Mosaic repository at DATA_ROOT, rescanned at most every
+# REPOSITORY_SCAN_INTERVAL seconds, see _get_repository
+REPOSITORY_SCAN_INTERVAL = float(os.environ.get("MOSAIC_SCAN_INTERVAL", 5))
+_repository: Repository | None = None
+_repository_scanned_at = 0.0
+_repository_lock = threading.Lock()
+
+# Topic types that can be streamed, the others are disabled feeds
+STREAMABLE_TYPES = {"sensor_msgs/msg/CompressedImage", "sensor_msgs/msg/PointCloud2"}
+
+
+def _get_repository() -> Repository:
+    """The Mosaic repository at DATA_ROOT, scanned when first opened then
+    rescanned once REPOSITORY_SCAN_INTERVAL passed, so that added, rewritten
+    and removed bags show up. Unchanged logs are skipped by the scan. Requests
+    arriving during a rescan are served from the index as it is.
+    """
+    global _repository, _repository_scanned_at
+    with _repository_lock:
+        if _repository is None:
+            try:
+                repository = Repository(cwd=DATA_ROOT.resolve())
+            except MosaicRepoException:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail={
+                        "code": "REPOSITORY_NOT_FOUND",
+                        "message": f"'{DATA_ROOT}' is not in a Mosaic repository",
+                        "details": {"data_root": DATA_ROOT.as_posix()},
+                        "retryable": False,
+                    },
                 )
-            ],
-        ),
+            repository.update_state()
+            _repository = repository
+            _repository_scanned_at = time.monotonic()
+            return repository
+
+        repository = _repository
+        rescan = time.monotonic() - _repository_scanned_at >= REPOSITORY_SCAN_INTERVAL
+        if rescan:
+            # Claimed under the lock, a single request rescans
+            _repository_scanned_at = time.monotonic()
+    if rescan:
+        repository.update_state()
+    return repository
+
+
+def _find_log(repository: Repository, file: str) -> LogInfo | None:
+    """A log by path relative to DATA_ROOT, or by file name"""
+    if "/" in file:
+        return repository.get_log(DATA_ROOT.resolve() / file)
+    return repository.find_log(file)
+
+
+def _file_not_found(file: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={
+            "code": "FILE_NOT_FOUND",
+            "message": f"File '{file}' not found",
+            "details": {"filename": file},
+            "retryable": False,
+        },
+    )
+
+
+def _make_etag(*parts: Any) -> str:
+    """Strong ETag of a response derived from the index state it is built from"""
+    digest = hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def _get_validators(etag: str, updated_ns: int | None) -> Dict[str, str]:
+    """Headers letting a client revalidate its copy of a response"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if updated_ns is not None:
+        headers["Last-Modified"] = formatdate(updated_ns / 1e9, usegmt=True)
+    return headers
+
+
+def _is_not_modified(request: Request, etag: str, updated_ns: int | None) -> bool:
+    """Whether the copy of the client is still fresh. If-None-Match takes
+    precedence over If-Modified-Since, as in RFC 9110.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or updated_ns is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    # Last-Modified has a resolution of a second
+    return updated_ns // 1_000_000_000 <= since.timestamp()
+
+
+def _to_file(log: LogInfo) -> File:
+    # The `file` of the streaming endpoints
+    path = Path(os.path.relpath(log.log_path, DATA_ROOT.resolve())).as_posix()
+    created_ns = log.start_time_ns if log.start_time_ns is not None else log.mtime_ns
+    camera_topics = [
+        topic["name"]
+        for topic in log.get_topics() or []
+        if topic["type"] == "sensor_msgs/msg/CompressedImage"
+        and not is_depth_topic(topic["name"])
     ]
-}
+    thumbnail_url = None
+    if len(camera_topics) > 0:
+        thumbnail_url = "/thumbnails/sheet.jpg?" + urlencode(
+            {"file": path, "topic": camera_topics[0], "index": 0}
+        )
+    return File(
+        name=log.name,
+        path=path,
+        size_bytes=log.size_bytes or 0,
+        created_at=datetime.fromtimestamp((created_ns or 0) / 1e9),
+        thumbnail_url=thumbnail_url,
+    )
 
 
 @app.get("/")
@@ -84,14 +246,27 @@ def root():
 
 
 @app.get("/directory", response_model=Directory)
-def get_directory(name: str = Query(..., description="Directory name")):
+def get_directory(
+    request: Request,
+    response: Response,
+    name: str = Query(..., description="Directory name"),
+    cursor: str | None = Query(None, description="next_cursor of the last page"),
+    limit: int = Query(100, ge=1, le=1000, description="Files per page"),
+):
     """
-    Get directory and files inside.
+    Get directory and a page of the files inside, from the repository index.
+    `name` is relative to the repository root, "." being the root itself.
+    Pass `next_cursor` as `cursor` to get the next page, it is unset on the
+    last page.
+
+    The ETag of a page changes with the files of the directory, send it back
+    in If-None-Match to get a 304 while the listing didn't change.
 
     Error Codes:
-    - 400 INVALID_PARAM: Missing or invalid directory name
+    - 400 INVALID_PARAM: Missing or invalid directory name or cursor
     - 404 DIRECTORY_NOT_FOUND: Directory does not exist
     - 500 SERVER_ERROR: Internal server error
+    - 503 REPOSITORY_NOT_FOUND: The data root isn't a Mosaic repository
     """
     if not name:
         raise HTTPException(
@@ -103,7 +278,28 @@ def get_directory(name: str = Query(..., description="Directory name")):
             },
         )
 
-    if name not in MOCK_DIRECTORIES:
+    repository = _get_repository()
+    after = None
+    if cursor is not None:
+        # The path of the last log of the page, relative to the repository root
+        try:
+            after_path = base64.b64decode(
+                cursor, altchars=b"-_", validate=True
+            ).decode()
+            after = (repository.root_path / after_path).as_posix()
+        except (ValueError, UnicodeDecodeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail={
+                    "code": "INVALID_PARAM",
+                    "message": f"Invalid cursor '{cursor}'",
+                    "details": {"cursor": cursor},
+                    "retryable": False,
+                },
+            )
+
+    file_count, updated_ns = repository.get_directory_state(name)
+    if file_count == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail={
@@ -114,19 +310,43 @@ def get_directory(name: str = Query(..., description="Directory name")):
             },
         )
 
-    return MOCK_DIRECTORIES[name]
+    etag = _make_etag("directory", name, cursor, limit, file_count, updated_ns)
+    headers = _get_validators(etag, updated_ns)
+    if _is_not_modified(request, etag, updated_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # One more log tells whether there is a next page
+    logs = repository.get_directory_logs(name, after, limit + 1)
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        after_path = Path(logs[-1].log_path).relative_to(repository.root_path)
+        next_cursor = base64.urlsafe_b64encode(after_path.as_posix().encode()).decode()
+
+    response.headers.update(headers)
+    return Directory(
+        name=name,
+        files=[_to_file(log) for log in logs],
+        file_count=file_count,
+        next_cursor=next_cursor,
+    )
 
 
 @app.get("/file", response_model=File)
-def get_file(name: str = Query(..., description="File name")):
+def get_file(
+    request: Request,
+    response: Response,
+    name: str = Query(..., description="File name or path"),
+):
     """
-    Get file by name.
+    Get file by name, or by path relative to the data root.
 
     Error Codes:
     - 400 INVALID_PARAM: Missing or invalid file name
     - 404 FILE_NOT_FOUND: File does not exist
     - 403 FORBIDDEN: No access to file
     - 500 SERVER_ERROR: Internal server error
+    - 503 REPOSITORY_NOT_FOUND: The data root isn't a Mosaic repository
     """
     if not name:
         raise HTTPException(
@@ -138,33 +358,35 @@ def get_file(name: str = Query(..., description="File name")):
             },
         )
 
-    # Search for file in all directories
-    for directory in MOCK_DIRECTORIES.values():
-        for file in directory.files:
-            if file.name == name:
-                return file
+    repository = _get_repository()
+    log = _find_log(repository, name)
+    if log is None:
+        raise _file_not_found(name)
 
-    raise HTTPException(
-        status_code=status.HTTP_404_NOT_FOUND,
-        detail={
-            "code": "FILE_NOT_FOUND",
-            "message": f"File '{name}' not found",
-            "details": {"filename": name},
-            "retryable": False,
-        },
-    )
+    etag = _make_etag("file", log.log_path, log.updated_ns)
+    headers = _get_validators(etag, log.updated_ns)
+    if _is_not_modified(request, etag, log.updated_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return _to_file(log)
 
 
 @app.get("/feeds", response_model=List[Feed])
-def get_feeds(file: str = Query(..., description="File name")):
+def get_feeds(
+    request: Request,
+    response: Response,
+    file: str = Query(..., description="File name or path"),
+):
     """
-    Get feeds for a file.
+    Get feeds for a file, i.e its topics as recorded in the metadata of its
+    bag. Feeds that can be streamed are enabled.
 
     Error Codes:
     - 400 INVALID_PARAM: Missing or invalid file parameter
     - 404 FILE_NOT_FOUND: File does not exist
     - 404 FEED_NOT_AVAILABLE: No feeds available for this file
     - 500 SERVER_ERROR: Internal server error
+    - 503 REPOSITORY_NOT_FOUND: The data root isn't a Mosaic repository
     """
     if not file:
         raise HTTPException(
@@ -176,7 +398,12 @@ def get_feeds(file: str = Query(..., description="File name")):
             },
         )
 
-    if file not in MOCK_FEEDS:
+    repository = _get_repository()
+    log = _find_log(repository, file)
+    if log is None:
+        raise _file_not_found(file)
+    topics = log.get_topics()
+    if not topics:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail={
@@ -187,19 +414,33 @@ def get_feeds(file: str = Query(..., description="File name")):
             },
         )
 
-    return MOCK_FEEDS[file]
+    etag = _make_etag("feeds", log.log_path, log.updated_ns)
+    headers = _get_validators(etag, log.updated_ns)
+    if _is_not_modified(request, etag, log.updated_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return [
+        Feed(name=topic["name"], enabled=topic["type"] in STREAMABLE_TYPES)
+        for topic in topics
+    ]
 
 
 @app.get("/groundtruth", response_model=List[GroundTruth])
-def get_groundtruth(file: str = Query(..., description="File name")):
+def get_groundtruth(
+    request: Request,
+    response: Response,
+    file: str = Query(..., description="File name or path"),
+):
     """
-    Get ground truth annotations for a file.
+    Get ground truth annotations for a file, the `layers` of the ground truth
+    file of its log.
 
     Error Codes:
     - 400 INVALID_PARAM: Missing or invalid file parameter
     - 404 FILE_NOT_FOUND: File does not exist
     - 404 GROUNDTRUTH_NOT_FOUND: No ground truth data for this file
     - 500 SERVER_ERROR: Internal server error
+    - 503 REPOSITORY_NOT_FOUND: The data root isn't a Mosaic repository
     """
     if not file:
         raise HTTPException(
@@ -211,7 +452,12 @@ def get_groundtruth(file: str = Query(..., description="File name")):
             },
         )
 
-    if file not in MOCK_GROUNDTRUTH:
+    repository = _get_repository()
+    log = _find_log(repository, file)
+    if log is None:
+        raise _file_not_found(file)
+    gt_path = Path(log.gt_path) if log.gt_path is not None else None
+    if gt_path is None or not gt_path.exists():
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail={
@@ -222,7 +468,626 @@ def get_groundtruth(file: str = Query(..., description="File name")):
             },
         )
 
-    return MOCK_GROUNDTRUTH[file]
+    # The ground truth file may be edited in place, without a new scan
+    stat = gt_path.stat()
+    etag = _make_etag("groundtruth", log.log_path, stat.st_mtime_ns, stat.st_size)
+    headers = _get_validators(etag, stat.st_mtime_ns)
+    if _is_not_modified(request, etag, stat.st_mtime_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    with open(gt_path, "r") as gt_file:
+        layers = json.load(gt_file).get("layers", [])
+    response.headers.update(headers)
+    return [GroundTruth.model_validate(layer) for layer in layers]
+
+
+def _get_processor(file: str, topic: str) -> OnDemandProcessor:
+    """The grid of all cameras, MOSAIC_TOPIC_NAME, has its own processor.
+    `file` must be a file under DATA_ROOT.
+    """
+    bag_path = resolve_served_path(DATA_ROOT, file) if file else None
+    if bag_path is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "code": "FILE_NOT_FOUND",
+                "message": f"File '{file}' not found",
+                "details": {"filename": file},
+                "retryable": False,
+            },
+        )
+
+    key = (bag_path.as_posix(), topic == MOSAIC_TOPIC_NAME)
+    with _processors_lock:
+        if key in _processors:
+            _processors.move_to_end(key)
+            return _processors[key]
+
+    # Opening a bag reads its metadata and builds its plans, done outside of
+    # the lock so that requests for other bags don't wait for it
+    buffer_pool = _buffer_pool.scoped(bag_path.as_posix())
+    if topic == MOSAIC_TOPIC_NAME:
+        processor = OnDemandProcessor(
+            bag_path.as_posix(),
+            buffer_pool,
+            mosaic=True,
+            max_workers=PROCESSOR_MAX_WORKERS,
+            segment_cache=_segment_cache,
+        )
+    else:
+        processor = OnDemandProcessor(
+            bag_path.as_posix(),
+            buffer_pool,
+            max_workers=PROCESSOR_MAX_WORKERS,
+            renditions=DEFAULT_RENDITIONS,
+            thumbnails=True,
+            segment_cache=_segment_cache,
+            lod_tiers=DEFAULT_LOD_TIERS,
+            compression=DEFAULT_CODEC,
+            undistort=True,
+            remap_cache_dir=REMAP_CACHE_DIR,
+        )
+
+    evicted = []
+    with _processors_lock:
+        if key in _processors:
+            # Opened by a concurrent request meanwhile
+            evicted.append(processor)
+            processor = _processors[key]
+            _processors.move_to_end(key)
+        else:
+            _processors[key] = processor
+            while len(_processors) > MAX_OPEN_PROCESSORS:
+                evicted.append(_processors.popitem(last=False)[1])
+
+    # Requests may still hold them, they are served before the workers stop
+    for evicted_processor in evicted:
+        evicted_processor.close()
+    return processor
+
+
+def _get_segment_validators(
+    key: str, rendition: str | None, version: str | None
+) -> Dict[str, str]:
+    """Caching headers of a segment, immutable when requested by the content
+    key it currently has
+    """
+    headers = _get_validators(_make_etag(key, rendition), None)
+    if version == key:
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return headers
+
+
+def _get_accepted_encodings(request: Request) -> Set[str]:
+    """Content codings of the Accept-Encoding header, without the refused ones"""
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        is_refused = False
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    is_refused = float(value) == 0
+                except ValueError:
+                    pass
+        if coding and not is_refused:
+            accepted.add(coding.lower())
+    return accepted
+
+
+def _encoded_response(
+    request: Request, segment: SegmentNode, data: bytes, media_type: str
+) -> Response:
+    """Payload of a segment compressed by a CompressionStage, sent as is when the
+    client accepts its codec and decompressed otherwise. Nothing is compressed
+    per request. Payloads compressed with a dictionary are always decompressed,
+    clients don't have the dictionary.
+    """
+    if segment.encoding is None:
+        return Response(content=data, media_type=media_type)
+
+    headers = {"Vary": "Accept-Encoding"}
+    accepted = _get_accepted_encodings(request)
+    if segment.dictionary_id is None and segment.encoding in accepted:
+        headers["Content-Encoding"] = segment.encoding
+    else:
+        data = decompress(data, segment.encoding, segment.dictionary_id)
+    return Response(content=data, media_type=media_type, headers=headers)
+
+
+async def _get_segment_for_client(
+    request: Request,
+    processor: OnDemandProcessor,
+    topic: str,
+    index: int,
+    client: str | None,
+) -> SegmentNode | None:
+    """Wait for a segment without blocking the event loop. If the client
+    disconnects first, the segment stops being produced unless another client
+    waits for it.
+    """
+    task = asyncio.ensure_future(processor.aget_segment(topic, index, client))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if task in done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            raise HTTPException(
+                status_code=499,
+                detail={
+                    "code": "CLIENT_DISCONNECTED",
+                    "message": f"Client left before segment {index} of topic '{topic}' was ready",
+                    "details": {"topic": topic, "index": index},
+                    "retryable": True,
+                },
+            )
+
+
+def _topic_not_found(file: str, topic: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={
+            "code": "FEED_NOT_AVAILABLE",
+            "message": f"Topic '{topic}' can't be streamed for file '{file}'",
+            "details": {"filename": file, "topic": topic},
+            "retryable": False,
+        },
+    )
+
+
+def _rendition_not_found(file: str, topic: str, rendition: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={
+            "code": "RENDITION_NOT_FOUND",
+            "message": f"Rendition '{rendition}' not available for topic '{topic}'",
+            "details": {"filename": file, "topic": topic, "rendition": rendition},
+            "retryable": False,
+        },
+    )
+
+
+@app.get("/stats/buffer_pool")
+def get_buffer_pool_stats() -> Dict[str, int]:
+    """
+    Get the hit, miss and eviction counters of the segment buffer pool, and
+    the bytes it holds in memory and on disk.
+    """
+    return _buffer_pool.get_stats()
+
+
+@app.get("/stats/segment_cache")
+def get_segment_cache_stats() -> Dict[str, int]:
+    """
+    Get the hit, miss and store counters of the persistent segment cache, and
+    the bytes it holds. Empty when the cache is disabled.
+    """
+    if _segment_cache is None:
+        return {}
+    return _segment_cache.get_stats()
+
+
+def _new_client_id() -> str:
+    """Id of a player, carried by the uris of the playlists served to it so that
+    its playhead can be followed for prefetching
+    """
+    return uuid.uuid4().hex
+
+
+@app.get("/hls/master.m3u8")
+def get_master_playlist(
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Topic name"),
+    client: str | None = Query(None, description="Player id, generated if unset"),
+):
+    """
+    Get the HLS master playlist of a topic, listing one media playlist per
+    rendition so that the player can adapt to its bandwidth.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic can't be streamed
+    """
+    processor = _get_processor(file, topic)
+    client = client or _new_client_id()
+
+    def playlist_uri(rendition: Rendition) -> str:
+        return "playlist.m3u8?" + urlencode(
+            {
+                "file": file,
+                "topic": topic,
+                "rendition": rendition.name,
+                "client": client,
+            }
+        )
+
+    playlist = processor.get_master_playlist(topic, playlist_uri)
+    if playlist is None:
+        raise _topic_not_found(file, topic)
+    return Response(content=playlist, media_type=PLAYLIST_MEDIA_TYPE)
+
+
+@app.get("/hls/playlist.m3u8")
+def get_playlist(
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Topic name"),
+    rendition: str | None = Query(None, description="Rendition name"),
+    client: str | None = Query(None, description="Player id, generated if unset"),
+):
+    """
+    Get the HLS playlist of a topic. The playlist is built from the bag
+    metadata, segments are only transcoded once they are requested. The
+    segments following the ones a player requests are prepared ahead of it.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic can't be streamed
+    - 404 RENDITION_NOT_FOUND: Topic has no such rendition
+    """
+    processor = _get_processor(file, topic)
+    if topic not in processor.get_topic_names():
+        raise _topic_not_found(file, topic)
+
+    params = {"file": file, "topic": topic, "client": client or _new_client_id()}
+    if rendition is not None:
+        if rendition not in [r.name for r in processor.get_renditions(topic)]:
+            raise _rendition_not_found(file, topic, rendition)
+        params["rendition"] = rendition
+
+    def segment_uri(segment_idx: int) -> str:
+        # The content key versions the uri, so that the segment can be cached
+        # for good, see /hls/segment.ts
+        key = processor.get_segment_key(topic, segment_idx)
+        return "segment.ts?" + urlencode(
+            {**params, "index": segment_idx, "v": key or ""}
+        )
+
+    playlist = processor.get_playlist(topic, segment_uri)
+    if playlist is None:
+        raise _topic_not_found(file, topic)
+    return Response(content=playlist, media_type=PLAYLIST_MEDIA_TYPE)
+
+
+@app.get("/hls/segment.ts")
+async def get_segment(
+    request: Request,
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Topic name"),
+    index: int = Query(..., description="Segment index"),
+    rendition: str | None = Query(None, description="Rendition name"),
+    client: str | None = Query(None, description="Player id"),
+    v: str | None = Query(None, description="Content key, from the playlist"),
+):
+    """
+    Get a single mpegts segment, transcoding it on first request. Segments of
+    the segment cache are sent from its files (sendfile when the server
+    supports it).
+
+    Uris of the playlist carry the content key of their segment (`v`), which
+    changes with the bag and the encoding settings: a response to such a uri
+    never changes and is cached as immutable. Other requests revalidate with
+    the ETag. `client` only drives prefetching and should be left out of the
+    cache key of a CDN.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic can't be streamed
+    - 404 SEGMENT_NOT_FOUND: Segment index out of range
+    - 404 RENDITION_NOT_FOUND: Topic has no such rendition
+    - 499 CLIENT_DISCONNECTED: Client left before the segment was ready
+    """
+    processor = await run_in_threadpool(_get_processor, file, topic)
+    if (
+        topic not in processor.get_topic_names()
+        or topic.endswith(THUMBNAILS_SUFFIX)
+        or processor.is_point_cloud(topic)
+    ):
+        raise _topic_not_found(file, topic)
+
+    key = await run_in_threadpool(processor.get_segment_key, topic, index)
+    headers: Dict[str, str] = {}
+    if key is not None:
+        headers = _get_segment_validators(key, rendition, v)
+        if _is_not_modified(request, headers["ETag"], None):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        # Sent from the segment cache entry, without reading it
+        try:
+            cached = await run_in_threadpool(
+                processor.open_cached_payload, topic, index, rendition
+            )
+        except KeyError:
+            raise _rendition_not_found(file, topic, rendition or "")
+        if cached is not None:
+            processor.follow(topic, index, client)
+            entry_file, offset, length = cached
+            return FileSpanResponse(
+                entry_file, offset, length, headers=headers, media_type="video/mp2t"
+            )
+
+    segment = await _get_segment_for_client(request, processor, topic, index, client)
+    if segment is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "code": "SEGMENT_NOT_FOUND",
+                "message": f"Segment {index} of topic '{topic}' not found",
+                "details": {"filename": file, "topic": topic, "index": index},
+                "retryable": False,
+            },
+        )
+
+    data = segment.data
+    if rendition is not None:
+        if rendition not in segment.renditions:
+            raise _rendition_not_found(file, topic, rendition)
+        data = segment.renditions[rendition]
+    return Response(content=data, media_type="video/mp2t", headers=headers)
+
+
+@app.get("/thumbnails/index.vtt")
+def get_thumbnail_index(
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Camera topic name"),
+):
+    """
+    Get the WebVTT index of the timeline thumbnails of a camera. Each cue
+    points to a tile of a sprite sheet served by /thumbnails/sheet.jpg.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic has no thumbnails
+    """
+    processor = _get_processor(file, topic)
+
+    def sheet_uri(sheet_idx: int) -> str:
+        return "sheet.jpg?" + urlencode(
+            {"file": file, "topic": topic, "index": sheet_idx}
+        )
+
+    vtt = processor.get_thumbnail_vtt(topic + THUMBNAILS_SUFFIX, sheet_uri)
+    if vtt is None:
+        raise _topic_not_found(file, topic)
+    return Response(content=vtt, media_type=VTT_MEDIA_TYPE)
+
+
+@app.get("/thumbnails/sheet.jpg")
+async def get_thumbnail_sheet(
+    request: Request,
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Camera topic name"),
+    index: int = Query(..., description="Sprite sheet index"),
+):
+    """
+    Get a JPEG sprite sheet of thumbnails, produced on first request.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic has no thumbnails
+    - 404 SEGMENT_NOT_FOUND: Sheet index out of range
+    - 499 CLIENT_DISCONNECTED: Client left before the sheet was ready
+    """
+    processor = await run_in_threadpool(_get_processor, file, topic)
+    thumbnail_topic = topic + THUMBNAILS_SUFFIX
+    if thumbnail_topic not in processor.get_topic_names():
+        raise _topic_not_found(file, topic)
+
+    sheet = await _get_segment_for_client(
+        request, processor, thumbnail_topic, index, None
+    )
+    if sheet is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "code": "SEGMENT_NOT_FOUND",
+                "message": f"Thumbnail sheet {index} of topic '{topic}' not found",
+                "details": {"filename": file, "topic": topic, "index": index},
+                "retryable": False,
+            },
+        )
+    return Response(content=sheet.data, media_type="image/jpeg")
+
+
+@app.get("/lidar/index.json")
+def get_point_cloud_index(
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="LiDAR topic name"),
+    client: str | None = Query(None, description="Player id, generated if unset"),
+) -> Dict[str, Any]:
+    """
+    Get the segments of a LiDAR topic, their duration and uri, and its levels
+    of detail from the coarsest. Like the HLS playlists it is built from the
+    bag metadata alone, see /lidar/segment.bin for the layout of a segment.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic is not a point cloud
+    """
+    processor = _get_processor(file, topic)
+    if not processor.is_point_cloud(topic):
+        raise _topic_not_found(file, topic)
+
+    params = {"file": file, "topic": topic, "client": client or _new_client_id()}
+    return {
+        "lod": [
+            {"name": tier.name, "voxel_size": tier.voxel_size}
+            for tier in processor.get_lod_tiers(topic)
+        ],
+        "segments": [
+            {
+                "uri": "segment.bin?" + urlencode({**params, "index": idx}),
+                "seconds": processor.get_segment_seconds(topic, idx),
+            }
+            for idx in range(processor.get_segment_count(topic))
+        ],
+    }
+
+
+@app.get("/lidar/segment.bin")
+async def get_point_cloud_segment(
+    request: Request,
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="LiDAR topic name"),
+    index: int = Query(..., description="Segment index"),
+    lod: str | None = Query(None, description="Level of detail, full if unset"),
+    client: str | None = Query(None, description="Player id"),
+):
+    """
+    Get the clouds of a LiDAR topic in a time window, packed on first request
+    with int16 coordinates relative to the segment origin and uint8
+    intensities, see src/server/executors/pointcloud.py. A level of detail
+    gives the clouds downsampled to a point per voxel.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic is not a point cloud
+    - 404 SEGMENT_NOT_FOUND: Segment index out of range
+    - 404 RENDITION_NOT_FOUND: Topic has no such level of detail
+    - 499 CLIENT_DISCONNECTED: Client left before the segment was ready
+    """
+    processor = await run_in_threadpool(_get_processor, file, topic)
+    if not processor.is_point_cloud(topic):
+        raise _topic_not_found(file, topic)
+    if lod is not None and lod not in [t.name for t in processor.get_lod_tiers(topic)]:
+        raise _rendition_not_found(file, topic, lod)
+
+    segment = await _get_segment_for_client(request, processor, topic, index, client)
+    if segment is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "code": "SEGMENT_NOT_FOUND",
+                "message": f"Segment {index} of topic '{topic}' not found",
+                "details": {"filename": file, "topic": topic, "index": index},
+                "retryable": False,
+            },
+        )
+    data = segment.data if lod is None else segment.renditions[lod]
+    return _encoded_response(request, segment, data, POINT_CLOUD_MEDIA_TYPE)
+
+
+@app.get("/video")
+async def get_video(
+    request: Request,
+    file: str = Query(..., description="Path relative to the data root"),
+):
+    """
+    Get a bag or a video of the data root, whole or by byte ranges
+    (Range, including suffix and multiple ranges, and If-Range). The file is
+    sent from disk, never read into memory, see src/server/responses.py.
+
+    Error Codes:
+    - 404 FILE_NOT_FOUND: No such bag or video under the data root, see
+      VIDEO_SUFFIXES
+    - 416 RANGE_NOT_SATISFIABLE: No requested range overlaps the file
+    """
+    path = resolve_served_path(DATA_ROOT, file, VIDEO_SUFFIXES)
+    if path is None:
+        raise _file_not_found(file)
+    try:
+        served_file = await run_in_threadpool(open, path, "rb")
+    except OSError:
+        raise _file_not_found(file)
+
+    try:
+        stat = os.fstat(served_file.fileno())
+        headers = get_file_validators(stat)
+        range_header = request.headers.get("range")
+        ranges = None
+        if range_header is not None and is_range_fresh(
+            request.headers.get("if-range"), headers
+        ):
+            ranges = parse_byte_ranges(range_header, stat.st_size)
+    except ValueError:
+        served_file.close()
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail={
+                "code": "RANGE_NOT_SATISFIABLE",
+                "message": f"Range '{range_header}' is outside of '{file}'",
+                "details": {"filename": file, "size_bytes": stat.st_size},
+                "retryable": False,
+            },
+            headers={"Content-Range": f"bytes */{stat.st_size}"},
+        )
+    except BaseException:
+        served_file.close()
+        raise
+
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    return FileRangeResponse(served_file, ranges, stat.st_size, headers, media_type)
+
+
+@app.get("/clip.mp4")
+async def get_clip(
+    file: str = Query(..., description="File name"),
+    topic: str = Query(..., description="Camera topic name"),
+    start: float = Query(..., description="Start of the clip, in seconds"),
+    end: float = Query(..., description="End of the clip, in seconds"),
+    rendition: str | None = Query(None, description="Rendition name"),
+):
+    """
+    Get the frames of a camera from `start` to `end`, in seconds from the
+    start of the recording, as a MP4. The segments the clip covers are copied
+    as they are, only the frames of the two segments at its edges are encoded
+    again, see src/server/clip.py.
+
+    Error Codes:
+    - 400 INVALID_PARAM: Empty or negative time range
+    - 404 FILE_NOT_FOUND: File does not exist
+    - 404 FEED_NOT_AVAILABLE: Topic isn't a video
+    - 404 RENDITION_NOT_FOUND: Topic has no such rendition
+    - 404 SEGMENT_NOT_FOUND: No frame in the time range
+    """
+    if start < 0 or end <= start:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "code": "INVALID_PARAM",
+                "message": f"Invalid clip range [{start}, {end})",
+                "details": {"start": start, "end": end},
+                "retryable": False,
+            },
+        )
+
+    processor = await run_in_threadpool(_get_processor, file, topic)
+    if processor.get_video_stage(topic) is None:
+        raise _topic_not_found(file, topic)
+    if rendition is not None and rendition not in [
+        r.name for r in processor.get_renditions(topic)
+    ]:
+        raise _rendition_not_found(file, topic, rendition)
+
+    output = io.BytesIO()
+    try:
+        await run_in_threadpool(
+            export_clip,
+            processor,
+            topic,
+            int(start * 1e9),
+            int(end * 1e9),
+            output,
+            rendition,
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "code": "SEGMENT_NOT_FOUND",
+                "message": f"No frame of topic '{topic}' in [{start}, {end})",
+                "details": {"filename": file, "topic": topic},
+                "retryable": False,
+            },
+        )
+
+    filename = f"{Path(file).stem}_{start:g}-{end:g}.mp4"
+    return Response(
+        content=output.getvalue(),
+        media_type=MP4_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 if __name__ == "__main__":
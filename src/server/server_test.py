@@ -5,12 +5,22 @@ src/server/server_test.py
 Run with: pytest server_test.py -v
 """
 
+import base64
+import json
+import shutil
 import pytest
+from pathlib import Path
 from fastapi.testclient import TestClient
+import server
 from server import app
+from src.repository.repository import Repository
 
 client = TestClient(app)
 
+TEST_DATA_ROOT = Path(__file__).resolve().parents[2] / "tests" / "data"
+TEST_BAG = "synthetic_images_1760323041/synthetic_images_1760323041_0.mcap"
+TEST_TOPIC = "/mytopic/image/compressed"
+
 
 class TestHealth:
     """Test health endpoint."""
@@ -21,16 +31,127 @@ class TestHealth:
         assert response.json()["status"] == "ok"
 
 
+TEST_DIRECTORY = "data_20250912"
+TEST_LOG = "sensor_data_20250916_162938_0.mcap"
+TEST_GROUNDTRUTH = {
+    "layers": [
+        {
+            "layer_name": "Nucleus",
+            "enabled": True,
+            "boxes": [
+                {
+                    "id": "b1",
+                    "label": "Car",
+                    "confidence": 1.0,
+                    "x": 325,
+                    "y": 210,
+                    "width": 240,
+                    "height": 180,
+                }
+            ],
+        }
+    ]
+}
+
+
+@pytest.fixture(scope="module")
+def repository_root(tmp_path_factory):
+    """A repository with two bags in TEST_DIRECTORY, and ground truth for
+    TEST_LOG
+    """
+    root = tmp_path_factory.mktemp("repository")
+    Repository(cwd=root, create=True)
+    for bag in ["sensor_data_20250916_162938", "sensor_data_20250916_161600"]:
+        shutil.copytree(TEST_DATA_ROOT / bag, root / TEST_DIRECTORY / bag)
+
+    gt_path = root / TEST_DIRECTORY / "sensor_data_20250916_162938" / "gt.json"
+    log_path = gt_path.parent / TEST_LOG
+    with open(gt_path, "w") as gt_file:
+        json.dump({"log_path": log_path.as_posix(), **TEST_GROUNDTRUTH}, gt_file)
+    return root
+
+
+@pytest.fixture
+def repository(repository_root, monkeypatch):
+    monkeypatch.setattr(server, "DATA_ROOT", repository_root)
+    monkeypatch.setattr(server, "_repository", None)
+    return repository_root
+
+
+@pytest.mark.usefixtures("repository")
 class TestDirectory:
     """Test directory endpoints."""
 
     def test_get_directory_success(self):
-        response = client.get("/directory?name=data_20250912")
+        response = client.get(f"/directory?name={TEST_DIRECTORY}")
         assert response.status_code == 200
         data = response.json()
-        assert data["name"] == "data_20250912"
+        assert data["name"] == TEST_DIRECTORY
         assert "files" in data
-        assert data["file_count"] == 8
+        assert data["file_count"] == 2
+        assert data["next_cursor"] is None
+        assert data["files"][0]["name"] == "sensor_data_20250916_161600_0.mcap"
+        assert data["files"][0]["path"].startswith(TEST_DIRECTORY)
+
+    def test_get_directory_pages(self):
+        response = client.get(f"/directory?name={TEST_DIRECTORY}&limit=1")
+        data = response.json()
+        assert len(data["files"]) == 1
+        assert data["file_count"] == 2
+
+        cursor = data["next_cursor"]
+        response = client.get(
+            f"/directory?name={TEST_DIRECTORY}&limit=1&cursor={cursor}"
+        )
+        data = response.json()
+        assert [file["name"] for file in data["files"]] == [TEST_LOG]
+        assert data["next_cursor"] is None
+
+    def test_get_directory_not_modified(self):
+        response = client.get(f"/directory?name={TEST_DIRECTORY}")
+        etag = response.headers["etag"]
+        assert "last-modified" in response.headers
+
+        response = client.get(
+            f"/directory?name={TEST_DIRECTORY}", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+        # Another page is another listing
+        response = client.get(
+            f"/directory?name={TEST_DIRECTORY}&limit=1",
+            headers={"If-None-Match": etag},
+        )
+        assert response.status_code == 200
+
+    def test_get_directory_cursor_relative(self, repository):
+        response = client.get(f"/directory?name={TEST_DIRECTORY}&limit=1")
+        cursor = base64.urlsafe_b64decode(response.json()["next_cursor"]).decode()
+        assert cursor.startswith(f"{TEST_DIRECTORY}/")
+        assert repository.as_posix() not in cursor
+
+    def test_get_directory_rescanned(self, repository, monkeypatch):
+        monkeypatch.setattr(server, "REPOSITORY_SCAN_INTERVAL", 0)
+        response = client.get("/directory?name=later")
+        assert response.status_code == 404
+
+        # Added and removed bags show up without restarting the server
+        bag = "sensor_data_20250916_161600"
+        shutil.copytree(TEST_DATA_ROOT / bag, repository / "later" / bag)
+        try:
+            response = client.get("/directory?name=later")
+            assert response.status_code == 200
+            assert response.json()["file_count"] == 1
+        finally:
+            shutil.rmtree(repository / "later")
+        response = client.get("/directory?name=later")
+        assert response.status_code == 404
+
+    def test_get_directory_invalid_cursor(self):
+        response = client.get(f"/directory?name={TEST_DIRECTORY}&cursor=%%%")
+        assert response.status_code == 400
+        assert response.json()["detail"]["code"] == "INVALID_PARAM"
 
     def test_get_directory_not_found(self):
         response = client.get("/directory?name=invalid_dir")
@@ -43,16 +164,31 @@ class TestDirectory:
         assert response.status_code == 422
 
 
+@pytest.mark.usefixtures("repository")
 class TestFile:
     """Test file endpoints."""
 
     def test_get_file_success(self):
-        response = client.get("/file?name=sensor_data_20250916_162938_0.mcap")
+        response = client.get(f"/file?name={TEST_LOG}")
         assert response.status_code == 200
         data = response.json()
-        assert data["name"] == "sensor_data_20250916_162938_0.mcap"
+        assert data["name"] == TEST_LOG
         assert "size_bytes" in data
         assert "created_at" in data
+        # Start of the recording
+        assert data["created_at"].startswith("2025-09-16")
+        assert "thumbnails" in data["thumbnail_url"]
+
+        response = client.get(f"/file?name={data['path']}")
+        assert response.json()["name"] == TEST_LOG
+
+    def test_get_file_not_modified(self):
+        response = client.get(f"/file?name={TEST_LOG}")
+        response = client.get(
+            f"/file?name={TEST_LOG}",
+            headers={"If-Modified-Since": response.headers["last-modified"]},
+        )
+        assert response.status_code == 304
 
     def test_get_file_not_found(self):
         response = client.get("/file?name=nonexistent_file.mcap")
@@ -65,43 +201,54 @@ class TestFile:
         assert response.status_code == 422
 
 
+@pytest.mark.usefixtures("repository")
 class TestFeeds:
     """Test feed endpoints."""
 
     def test_get_feeds_success(self):
-        response = client.get("/feeds?file=sensor_data_20250916_162938_0.mcap")
+        response = client.get(f"/feeds?file={TEST_LOG}")
         assert response.status_code == 200
         feeds = response.json()
         assert isinstance(feeds, list)
         assert len(feeds) > 0
         assert feeds[0]["name"] == "/center_rear/camera_info"
-        assert "enabled" in feeds[0]
+        assert not feeds[0]["enabled"]
+        assert feeds[1]["name"] == "/center_rear/image_rect/compressed"
+        assert feeds[1]["enabled"]
+        assert "etag" in response.headers
 
     def test_get_feeds_not_found(self):
         response = client.get("/feeds?file=unknown_file.mcap")
         assert response.status_code == 404
         error = response.json()
-        assert error["detail"]["code"] == "FEED_NOT_AVAILABLE"
+        assert error["detail"]["code"] == "FILE_NOT_FOUND"
 
     def test_get_feeds_missing_param(self):
         response = client.get("/feeds")
         assert response.status_code == 422
 
 
+@pytest.mark.usefixtures("repository")
 class TestGroundTruth:
     """Test ground truth endpoints."""
 
     def test_get_groundtruth_success(self):
-        response = client.get("/groundtruth?file=sensor_data_20250916_162938_0.mcap")
+        response = client.get(f"/groundtruth?file={TEST_LOG}")
         assert response.status_code == 200
         gt_data = response.json()
         assert isinstance(gt_data, list)
         assert len(gt_data) > 0
-        assert gt_data[0]["layer_name"] in ["Nucleus", "ML Output"]
+        assert gt_data[0]["layer_name"] == "Nucleus"
         assert "boxes" in gt_data[0]
 
+        response = client.get(
+            f"/groundtruth?file={TEST_LOG}",
+            headers={"If-None-Match": response.headers["etag"]},
+        )
+        assert response.status_code == 304
+
     def test_get_groundtruth_not_found(self):
-        response = client.get("/groundtruth?file=unknown_file.mcap")
+        response = client.get("/groundtruth?file=sensor_data_20250916_161600_0.mcap")
         assert response.status_code == 404
         error = response.json()
         assert error["detail"]["code"] == "GROUNDTRUTH_NOT_FOUND"
@@ -111,10 +258,205 @@ class TestGroundTruth:
         assert response.status_code == 422
 
 
+class TestStreaming:
+    """Test HLS endpoints."""
+
+    @pytest.fixture(autouse=True)
+    def data_root(self, monkeypatch):
+        monkeypatch.setattr(server, "DATA_ROOT", TEST_DATA_ROOT)
+
+    def test_get_playlist_success(self):
+        response = client.get(f"/hls/playlist.m3u8?file={TEST_BAG}&topic={TEST_TOPIC}")
+        assert response.status_code == 200
+        assert response.text.startswith("#EXTM3U")
+        assert response.text.count("#EXTINF") == 6
+
+    def test_get_segment_success(self):
+        response = client.get(
+            f"/hls/segment.ts?file={TEST_BAG}&topic={TEST_TOPIC}&index=1"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "video/mp2t"
+        assert len(response.content) > 0
+
+    def test_get_segment_cache_headers(self):
+        response = client.get(f"/hls/playlist.m3u8?file={TEST_BAG}&topic={TEST_TOPIC}")
+        uri = next(line for line in response.text.splitlines() if "index=1" in line)
+        assert "v=" in uri
+
+        # Requested with its content key, the segment never changes
+        response = client.get(f"/hls/{uri}")
+        assert response.status_code == 200
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        response = client.get(
+            f"/hls/segment.ts?file={TEST_BAG}&topic={TEST_TOPIC}&index=1",
+            headers={"If-None-Match": etag},
+        )
+        assert response.status_code == 304
+        assert response.headers["cache-control"] == "no-cache"
+
+    def test_get_playlist_client(self):
+        # Segments of a playlist carry the id of its player
+        response = client.get(
+            f"/hls/playlist.m3u8?file={TEST_BAG}&topic={TEST_TOPIC}&client=player1"
+        )
+        assert response.status_code == 200
+        assert response.text.count("client=player1") == 6
+
+        response = client.get(f"/hls/playlist.m3u8?file={TEST_BAG}&topic={TEST_TOPIC}")
+        assert response.text.count("client=") == 6
+
+    def test_get_master_playlist_success(self):
+        response = client.get(f"/hls/master.m3u8?file={TEST_BAG}&topic={TEST_TOPIC}")
+        assert response.status_code == 200
+        assert response.text.count("#EXT-X-STREAM-INF") > 1
+
+    def test_get_segment_rendition(self):
+        response = client.get(
+            f"/hls/segment.ts?file={TEST_BAG}&topic={TEST_TOPIC}&index=0&rendition=360p"
+        )
+        assert response.status_code == 200
+        assert len(response.content) > 0
+
+    def test_get_segment_rendition_not_found(self):
+        response = client.get(
+            f"/hls/segment.ts?file={TEST_BAG}&topic={TEST_TOPIC}&index=0&rendition=8k"
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"]["code"] == "RENDITION_NOT_FOUND"
+
+    def test_get_segment_out_of_range(self):
+        response = client.get(
+            f"/hls/segment.ts?file={TEST_BAG}&topic={TEST_TOPIC}&index=100"
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"]["code"] == "SEGMENT_NOT_FOUND"
+
+    def test_get_thumbnail_index(self):
+        response = client.get(
+            f"/thumbnails/index.vtt?file={TEST_BAG}&topic={TEST_TOPIC}"
+        )
+        assert response.status_code == 200
+        assert response.text.startswith("WEBVTT")
+        assert "#xywh=" in response.text
+
+    def test_get_thumbnail_sheet(self):
+        response = client.get(
+            f"/thumbnails/sheet.jpg?file={TEST_BAG}&topic={TEST_TOPIC}&index=0"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+
+    def test_get_clip(self):
+        response = client.get(
+            f"/clip.mp4?file={TEST_BAG}&topic={TEST_TOPIC}&start=1.5&end=5"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "video/mp4"
+        assert response.content[4:8] == b"ftyp"
+
+    def test_get_clip_invalid_range(self):
+        response = client.get(
+            f"/clip.mp4?file={TEST_BAG}&topic={TEST_TOPIC}&start=5&end=1"
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"]["code"] == "INVALID_PARAM"
+
+    def test_get_playlist_file_not_found(self):
+        response = client.get(
+            f"/hls/playlist.m3u8?file=unknown.mcap&topic={TEST_TOPIC}"
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"]["code"] == "FILE_NOT_FOUND"
+
+    def test_get_playlist_outside_data_root(self):
+        for file in ["../../src/server/server.py", (TEST_DATA_ROOT / "..").resolve()]:
+            response = client.get(f"/hls/playlist.m3u8?file={file}&topic={TEST_TOPIC}")
+            assert response.status_code == 404
+            assert response.json()["detail"]["code"] == "FILE_NOT_FOUND"
+
+    def test_processors_per_bag(self, monkeypatch):
+        monkeypatch.setattr(server, "_processors", server.OrderedDict())
+        monkeypatch.setattr(server, "MAX_OPEN_PROCESSORS", 1)
+        # Every spelling of a bag shares its processor
+        processor = server._get_processor(TEST_BAG, TEST_TOPIC)
+        assert server._get_processor(f"./{TEST_BAG}", TEST_TOPIC) is processor
+
+        # The least recently used processor is shut down past the limit
+        server._get_processor(TEST_BAG, server.MOSAIC_TOPIC_NAME)
+        assert len(server._processors) == 1
+        assert processor._is_shutdown
+
+        # Requests still holding it are served
+        segment = processor.get_segment(TEST_TOPIC, 0, timeout=60, prefetch=False)
+        assert segment is not None
+
+
+class TestVideo:
+    """Test file range endpoint."""
+
+    @pytest.fixture(autouse=True)
+    def data_root(self, monkeypatch):
+        monkeypatch.setattr(server, "DATA_ROOT", TEST_DATA_ROOT)
+
+    def test_get_video(self):
+        content = (TEST_DATA_ROOT / TEST_BAG).read_bytes()
+        response = client.get(f"/video?file={TEST_BAG}")
+        assert response.status_code == 200
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.content == content
+
+    def test_get_video_range(self):
+        content = (TEST_DATA_ROOT / TEST_BAG).read_bytes()
+        response = client.get(
+            f"/video?file={TEST_BAG}", headers={"Range": "bytes=-100"}
+        )
+        assert response.status_code == 206
+        assert response.content == content[-100:]
+
+        # Range of an older version of the file, the whole file is sent
+        response = client.get(
+            f"/video?file={TEST_BAG}",
+            headers={"Range": "bytes=0-9", "If-Range": '"outdated"'},
+        )
+        assert response.status_code == 200
+        assert len(response.content) == len(content)
+
+    def test_get_video_range_not_satisfiable(self):
+        size = (TEST_DATA_ROOT / TEST_BAG).stat().st_size
+        response = client.get(
+            f"/video?file={TEST_BAG}", headers={"Range": f"bytes={size}-"}
+        )
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{size}"
+        assert response.json()["detail"]["code"] == "RANGE_NOT_SATISFIABLE"
+
+    def test_get_video_outside_data_root(self):
+        response = client.get("/video?file=../../src/server/server.py")
+        assert response.status_code == 404
+        assert response.json()["detail"]["code"] == "FILE_NOT_FOUND"
+
+    def test_get_video_not_media(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(server, "DATA_ROOT", tmp_path)
+        (tmp_path / ".mosaic").mkdir()
+        (tmp_path / ".mosaic" / "index.db").write_bytes(b"index")
+        (tmp_path / "ground_truth.json").write_bytes(b"{}")
+        (tmp_path / "video.mp4").write_bytes(b"video")
+
+        # The index, ground truth and caches of the data root are not served
+        for file in [".mosaic/index.db", "ground_truth.json"]:
+            response = client.get(f"/video?file={file}")
+            assert response.status_code == 404
+            assert response.json()["detail"]["code"] == "FILE_NOT_FOUND"
+        assert client.get("/video?file=video.mp4").content == b"video"
+
+
 class TestErrorHandling:
     """Test error responses."""
 
-    def test_error_response_structure(self):
+    def test_error_response_structure(self, repository):
         """Verify error responses follow standard format."""
         response = client.get("/directory?name=invalid")
         assert response.status_code == 404
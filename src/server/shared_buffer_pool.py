@@ -0,0 +1,589 @@
+"""
+Buffer pool shared by several processes
+src/server/shared_buffer_pool.py
+
+The segments live in a memory mapped arena file, so that every uvicorn worker
+opening the same file sees the segments produced by the others without going
+through a pipe or a socket. The arena is laid out as:
+
+    header | topic table | index | data ring
+
+The index is a set associative table: the hash of a segment key picks a bucket
+of `ways` slots, and the segment goes to a free slot of the bucket or replaces
+its oldest one. Buckets are protected by a fixed number of lock stripes.
+
+The data ring is written sequentially, `write_pos` only grows and
+`write_pos % data_size` is the offset of the next segment. A segment is valid
+as long as the ring hasn't wrapped over it, so eviction is FIFO and needs no
+coordination beyond bumping `write_pos`: older segments are implicitly evicted
+by the ones written over them.
+
+Every segment of the ring is preceded by a record header, with its topic and
+its length, so that the allocator can walk the records it is about to write
+over from `tail_pos`. The topic table keeps the number of segments of every
+topic in the arena: a record is counted while it is indexed and the ring
+hasn't wrapped over it. It also keeps the final number of segments of the
+topics, see BufferPool.set_segment_count.
+
+The production of a segment is claimed with a lock on a byte past the end of
+the arena, picked by the hash of the segment key, see claim_segment. Claims
+of a process that dies are released along with its other locks.
+
+Locks are fcntl record locks on bytes of the header, taken together with a
+thread lock as fcntl locks are owned by the process and not by the thread.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+from src.server.executors import SegmentNode
+from src.server.processor import BufferPool, SegmentKey, decode_segment, encode_segment
+
+_MAGIC = b"MOSAICBP"
+_VERSION = 3
+_HEADER_SIZE = 4096
+
+# magic, version, bucket count, ways, data size, topic table size
+_LAYOUT = struct.Struct("<8sIIIQI")
+_LAYOUT_OFFSET = 0
+# write_pos, tail_pos, whether the topic table overflowed, then the counters
+# of STAT_NAMES
+STAT_NAMES = ["hits", "misses", "evictions", "stores", "rejected"]
+_WRITE_POS, _TAIL_POS, _TOPICS_OVERFLOWED = range(3)
+_STATE = struct.Struct("<" + "Q" * (3 + len(STAT_NAMES)))
+_STATE_FIELD = struct.Struct("<Q")
+_STATE_OFFSET = 64
+
+# topic digest, number of segments, final number of segments + 1 (0 if it
+# isn't known). Empty entries have a zero digest
+_TOPIC = struct.Struct("<8sqq")
+# key digest, topic digest, data pos, length. Empty slots have a length of 0
+_SLOT = struct.Struct("<16s8sQQ")
+# topic digest, length including the record header, whether it is counted.
+# Padding up to the end of the ring has a zero topic digest
+_RECORD = struct.Struct("<8sQ?7x")
+_NO_TOPIC = bytes(8)
+
+# Bytes of the header locked by fcntl, the header is never written through them
+_INIT_LOCK_BYTE = 512
+_ALLOC_LOCK_BYTE = 513
+_STRIPE_LOCK_BYTE = 1024
+# Bytes past the end of the arena locked to claim segments, see claim_segment
+_CLAIM_LOCK_CNT = 1 << 20
+
+
+def _key_digest(key: SegmentKey) -> bytes:
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+
+def _topic_digest(namespace: str, topic_name: str) -> bytes:
+    return hashlib.blake2b(
+        repr((namespace, topic_name)).encode(), digest_size=8
+    ).digest()
+
+
+class SharedBufferPool(BufferPool):
+    """BufferPool backed by a memory mapped arena file, see the module docstring.
+
+    Every process creating a SharedBufferPool on the same `path` shares its
+    segments. The first one creates the arena with the given sizes, the others
+    use the sizes found in the file.
+
+    Unlike BufferPool, eviction is FIFO over the data ring rather than LRU, and
+    the index of appended segments (segment_idx None) is only tracked within
+    the process. Waiting for a segment polls the arena every POLL_INTERVAL
+    seconds, as it may be produced by another process.
+
+    The number of segments of a topic, and its final number of segments, are
+    kept in a table of `topic_cnt` entries shared by the topics of every bag.
+    Once more topics than that were ever stored, get_segment_count falls back
+    to scanning the index, and final counts that don't fit are only known
+    within the process.
+
+    Segments are read straight from the mapping but their payloads are copied
+    into the returned segment: the ring may be written over once they are
+    handed out, and a view into it couldn't be checked by its holder.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(
+        self,
+        path: str | Path,
+        data_size: int = 1024 * 1024 * 1024,
+        bucket_cnt: int = 4096,
+        ways: int = 4,
+        stripe_cnt: int = 64,
+        topic_cnt: int = 16384,
+    ) -> None:
+        self._path = Path(path)
+        self._stripe_cnt = stripe_cnt
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        self._thread_locks = [threading.Lock() for _ in range(stripe_cnt)]
+        self._alloc_thread_lock = threading.Lock()
+        self._append_idx: Dict[Tuple[str, str], int] = {}
+        self._segment_cnt: Dict[Tuple[str, str], int] = {}
+        self._append_lock = threading.Lock()
+
+        self._init_arena(data_size, bucket_cnt, ways, topic_cnt)
+        self._mmap = mmap.mmap(self._fd, self._arena_size)
+
+    def _init_arena(
+        self, data_size: int, bucket_cnt: int, ways: int, topic_cnt: int
+    ) -> None:
+        """Create the arena if no other process did, then read its layout"""
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _INIT_LOCK_BYTE)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                table_size = topic_cnt * _TOPIC.size
+                index_size = bucket_cnt * ways * _SLOT.size
+                os.ftruncate(
+                    self._fd, _HEADER_SIZE + table_size + index_size + data_size
+                )
+                header = bytearray(_HEADER_SIZE)
+                _LAYOUT.pack_into(
+                    header,
+                    _LAYOUT_OFFSET,
+                    _MAGIC,
+                    _VERSION,
+                    bucket_cnt,
+                    ways,
+                    data_size,
+                    topic_cnt,
+                )
+                os.pwrite(self._fd, bytes(header), 0)
+
+            magic, version, bucket_cnt, ways, data_size, topic_cnt = _LAYOUT.unpack(
+                os.pread(self._fd, _LAYOUT.size, _LAYOUT_OFFSET)
+            )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _INIT_LOCK_BYTE)
+
+        assert magic == _MAGIC, f"{self._path} isn't a buffer pool arena"
+        assert version == _VERSION
+        self._bucket_cnt = bucket_cnt
+        self._ways = ways
+        self._data_size = data_size
+        self._topic_cnt = topic_cnt
+        self._topics_offset = _HEADER_SIZE
+        self._index_offset = _HEADER_SIZE + topic_cnt * _TOPIC.size
+        self._data_offset = self._index_offset + bucket_cnt * ways * _SLOT.size
+        self._arena_size = self._data_offset + data_size
+
+    def close(self) -> None:
+        self._mmap.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _locked(self, thread_lock: threading.Lock, lock_byte: int) -> Iterator[None]:
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, lock_byte)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_byte)
+
+    def _alloc_locked(self):
+        return self._locked(self._alloc_thread_lock, _ALLOC_LOCK_BYTE)
+
+    def _stripe_locked(self, bucket: int):
+        stripe = bucket % self._stripe_cnt
+        return self._locked(self._thread_locks[stripe], _STRIPE_LOCK_BYTE + stripe)
+
+    def _read_state(self) -> Tuple[int, ...]:
+        return _STATE.unpack_from(self._mmap, _STATE_OFFSET)
+
+    def _read_field(self, field: int) -> int:
+        offset = _STATE_OFFSET + field * _STATE_FIELD.size
+        return _STATE_FIELD.unpack_from(self._mmap, offset)[0]
+
+    def _write_field(self, field: int, value: int) -> None:
+        offset = _STATE_OFFSET + field * _STATE_FIELD.size
+        _STATE_FIELD.pack_into(self._mmap, offset, value)
+
+    def _bump(self, stat_name: str, write_pos: int | None = None) -> None:
+        """Increment a counter, and move write_pos if given. Alloc lock held"""
+        state = list(self._read_state())
+        if write_pos is not None:
+            state[_WRITE_POS] = write_pos
+        state[3 + STAT_NAMES.index(stat_name)] += 1
+        _STATE.pack_into(self._mmap, _STATE_OFFSET, *state)
+
+    def _count(self, stat_name: str) -> None:
+        with self._alloc_locked():
+            self._bump(stat_name)
+
+    def _is_valid(self, data_pos: int) -> bool:
+        """Whether the ring hasn't wrapped over a segment yet. Alloc lock held"""
+        return self._read_field(_WRITE_POS) - data_pos <= self._data_size
+
+    def _find_topic(self, topic_digest: bytes, insert: bool = False) -> int | None:
+        """Offset of the entry of a topic in the topic table, alloc lock held.
+        With `insert` a topic without one takes an empty entry, or the entry of
+        a topic without segments nor final count, None if the table is full.
+        """
+        first = int.from_bytes(topic_digest, "little") % self._topic_cnt
+        free = None
+        for probe in range(self._topic_cnt):
+            entry = (first + probe) % self._topic_cnt
+            offset = self._topics_offset + entry * _TOPIC.size
+            digest, cnt, final_cnt = _TOPIC.unpack_from(self._mmap, offset)
+            if digest == topic_digest:
+                return offset
+            if free is None and cnt == 0 and final_cnt == 0:
+                free = offset
+            if digest == _NO_TOPIC:
+                # End of the probe sequence, the topic has no entry
+                break
+
+        if not insert:
+            return None
+        if free is None:
+            self._write_field(_TOPICS_OVERFLOWED, 1)
+            return None
+        _TOPIC.pack_into(self._mmap, free, topic_digest, 0, 0)
+        return free
+
+    def _set_counted(self, data_pos: int, counted: bool) -> None:
+        """Count the segment of a record in its topic or stop counting it,
+        alloc lock held. Records behind `tail_pos` were uncounted already.
+        """
+        if data_pos < self._read_field(_TAIL_POS):
+            return
+        offset = self._data_offset + data_pos % self._data_size
+        topic_digest, length, is_counted = _RECORD.unpack_from(self._mmap, offset)
+        if is_counted == counted:
+            return
+        topic_offset = self._find_topic(topic_digest, insert=counted)
+        if topic_offset is None:
+            return  # Table full, counts are scanned from now on
+
+        _, cnt, final_cnt = _TOPIC.unpack_from(self._mmap, topic_offset)
+        cnt += 1 if counted else -1
+        _TOPIC.pack_into(self._mmap, topic_offset, topic_digest, cnt, final_cnt)
+        _RECORD.pack_into(self._mmap, offset, topic_digest, length, counted)
+
+    def _uncount_overwritten(self, end: int) -> None:
+        """Walk the records from `tail_pos` that writing the ring up to `end`
+        overwrites, and stop counting them. Alloc lock held
+        """
+        tail_pos = self._read_field(_TAIL_POS)
+        while tail_pos + self._data_size < end:
+            offset = tail_pos % self._data_size
+            remaining = self._data_size - offset
+            if remaining < _RECORD.size:
+                # No room for a record before the end of the ring
+                tail_pos += remaining
+                continue
+            _, length, _ = _RECORD.unpack_from(self._mmap, self._data_offset + offset)
+            self._set_counted(tail_pos, False)
+            if length < _RECORD.size or length > remaining:
+                # Written over by a writer the ring lapped, skip to the next lap
+                length = remaining
+            tail_pos += length
+        self._write_field(_TAIL_POS, tail_pos)
+
+    def _get_slot_offset(self, bucket: int, way: int) -> int:
+        return self._index_offset + (bucket * self._ways + way) * _SLOT.size
+
+    def _find_slot(self, bucket: int, digest: bytes) -> int | None:
+        """Way of the slot holding digest in a bucket. Stripe lock held"""
+        for way in range(self._ways):
+            slot_digest, _, _, length = _SLOT.unpack_from(
+                self._mmap, self._get_slot_offset(bucket, way)
+            )
+            if length > 0 and slot_digest == digest:
+                return way
+        return None
+
+    def _allocate(self, topic_digest: bytes, length: int) -> int | None:
+        """Reserve a record for a segment of `length` bytes in the ring, None if
+        it can't fit. The segment goes right after the record header.
+        """
+        length += _RECORD.size
+        if length > self._data_size:
+            return None
+        with self._alloc_locked():
+            write_pos = self._read_field(_WRITE_POS)
+            # A segment never wraps, skip to the start of the ring instead
+            offset = write_pos % self._data_size
+            padding = (
+                self._data_size - offset if offset + length > self._data_size else 0
+            )
+            self._uncount_overwritten(write_pos + padding + length)
+
+            if padding >= _RECORD.size:
+                _RECORD.pack_into(
+                    self._mmap, self._data_offset + offset, _NO_TOPIC, padding, False
+                )
+            write_pos += padding
+            _RECORD.pack_into(
+                self._mmap,
+                self._data_offset + write_pos % self._data_size,
+                topic_digest,
+                length,
+                False,
+            )
+            self._bump("stores", write_pos + length)
+        return write_pos
+
+    def add_segment(
+        self,
+        topic_name: str,
+        segment: SegmentNode,
+        segment_idx: int | None = None,
+        namespace: str = "",
+    ):
+        with self._append_lock:
+            if segment_idx is None:
+                segment_idx = self._append_idx.get((namespace, topic_name), 0)
+            self._append_idx[(namespace, topic_name)] = max(
+                segment_idx + 1, self._append_idx.get((namespace, topic_name), 0)
+            )
+
+        encoded = encode_segment(segment)
+        topic_digest = _topic_digest(namespace, topic_name)
+        data_pos = self._allocate(topic_digest, len(encoded))
+        if data_pos is None:
+            self._count("rejected")
+            return
+
+        offset = self._data_offset + data_pos % self._data_size + _RECORD.size
+        end = offset + len(encoded)
+        self._mmap[offset:end] = encoded
+
+        digest = _key_digest((namespace, topic_name, segment_idx))
+        bucket = int.from_bytes(digest[:8], "little") % self._bucket_cnt
+        with self._stripe_locked(bucket):
+            way = self._find_slot(bucket, digest)
+            # Record of the segment the slot held, if any
+            replaced_pos = None
+            evicted = False
+            if way is not None:
+                replaced_pos = _SLOT.unpack_from(
+                    self._mmap, self._get_slot_offset(bucket, way)
+                )[2]
+            else:
+                # Free slot, or else the oldest segment of the bucket
+                slots = [
+                    _SLOT.unpack_from(self._mmap, self._get_slot_offset(bucket, w))
+                    for w in range(self._ways)
+                ]
+                way = min(
+                    range(self._ways),
+                    key=lambda w: (slots[w][3] > 0, slots[w][2]),
+                )
+                if slots[way][3] > 0:
+                    replaced_pos = slots[way][2]
+                    evicted = True
+            _SLOT.pack_into(
+                self._mmap,
+                self._get_slot_offset(bucket, way),
+                digest,
+                topic_digest,
+                data_pos,
+                len(encoded),
+            )
+
+            # Within the stripe lock, so that the slot and the counts agree
+            with self._alloc_locked():
+                if replaced_pos is not None:
+                    self._set_counted(replaced_pos, False)
+                self._set_counted(data_pos, True)
+                if evicted:
+                    self._bump("evictions")
+
+    def get_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> SegmentNode | None:
+        digest = _key_digest((namespace, topic_name, segment_idx))
+        bucket = int.from_bytes(digest[:8], "little") % self._bucket_cnt
+        with self._stripe_locked(bucket):
+            way = self._find_slot(bucket, digest)
+            if way is None:
+                self._count("misses")
+                return None
+            _, _, data_pos, length = _SLOT.unpack_from(
+                self._mmap, self._get_slot_offset(bucket, way)
+            )
+
+        with self._alloc_locked():
+            is_valid = self._is_valid(data_pos)
+        if not is_valid:
+            self._count("misses")
+            return None
+
+        # Decoded straight from the shared mapping, the payloads are copied
+        # once into the returned segment, see the class docstring
+        offset = self._data_offset + data_pos % self._data_size + _RECORD.size
+        end = offset + length
+        try:
+            with memoryview(self._mmap) as view:
+                segment = decode_segment(view[offset:end])
+        except Exception:
+            segment = None  # written over while decoding, checked below
+
+        # The ring may have been written over while decoding
+        with self._alloc_locked():
+            is_valid = segment is not None and self._is_valid(data_pos)
+            self._bump("hits" if is_valid else "misses")
+        return segment if is_valid else None
+
+    def has_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        digest = _key_digest((namespace, topic_name, segment_idx))
+        bucket = int.from_bytes(digest[:8], "little") % self._bucket_cnt
+        with self._stripe_locked(bucket):
+            way = self._find_slot(bucket, digest)
+            if way is None:
+                return False
+            _, _, data_pos, _ = _SLOT.unpack_from(
+                self._mmap, self._get_slot_offset(bucket, way)
+            )
+        with self._alloc_locked():
+            return self._is_valid(data_pos)
+
+    def get_segment_count(self, topic_name: str, namespace: str = "") -> int:
+        topic_digest = _topic_digest(namespace, topic_name)
+        with self._alloc_locked():
+            if not self._read_field(_TOPICS_OVERFLOWED):
+                topic_offset = self._find_topic(topic_digest)
+                if topic_offset is None:
+                    return 0
+                return _TOPIC.unpack_from(self._mmap, topic_offset)[1]
+
+        # The topic table was full once, some segments may not be counted
+        cnt = 0
+        for bucket in range(self._bucket_cnt):
+            with self._stripe_locked(bucket):
+                slots = [
+                    _SLOT.unpack_from(self._mmap, self._get_slot_offset(bucket, w))
+                    for w in range(self._ways)
+                ]
+            with self._alloc_locked():
+                cnt += sum(
+                    1
+                    for _, slot_topic, data_pos, length in slots
+                    if length > 0
+                    and slot_topic == topic_digest
+                    and self._is_valid(data_pos)
+                )
+        return cnt
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._alloc_locked():
+            write_pos, _, _, *counters = self._read_state()
+        return {
+            **dict(zip(STAT_NAMES, counters)),
+            "write_pos": write_pos,
+            "data_size": self._data_size,
+        }
+
+    def claim_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> bool:
+        """See BufferPool.claim_segment. Claims are fcntl locks, owned by the
+        process: a claim taken by another thread of the process succeeds, and
+        keys sharing a lock byte can't be claimed at the same time.
+        """
+        lock_byte = self._get_claim_lock_byte((namespace, topic_name, segment_idx))
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, lock_byte)
+        except OSError:
+            return False
+        return True
+
+    def release_segment(
+        self, topic_name: str, segment_idx: int, namespace: str = ""
+    ) -> None:
+        lock_byte = self._get_claim_lock_byte((namespace, topic_name, segment_idx))
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_byte)
+
+    def _get_claim_lock_byte(self, key: SegmentKey) -> int:
+        digest = _key_digest(key)
+        return self._arena_size + int.from_bytes(digest[8:], "little") % (
+            _CLAIM_LOCK_CNT
+        )
+
+    def set_segment_count(
+        self, topic_name: str, segment_cnt: int, namespace: str = ""
+    ) -> None:
+        with self._append_lock:
+            self._segment_cnt[(namespace, topic_name)] = segment_cnt
+        topic_digest = _topic_digest(namespace, topic_name)
+        with self._alloc_locked():
+            topic_offset = self._find_topic(topic_digest, insert=True)
+            if topic_offset is not None:
+                _, cnt, _ = _TOPIC.unpack_from(self._mmap, topic_offset)
+                _TOPIC.pack_into(
+                    self._mmap, topic_offset, topic_digest, cnt, segment_cnt + 1
+                )
+
+    def get_final_segment_count(
+        self, topic_name: str, namespace: str = ""
+    ) -> int | None:
+        """Set by any process sharing the arena"""
+        with self._alloc_locked():
+            topic_offset = self._find_topic(_topic_digest(namespace, topic_name))
+            if topic_offset is not None:
+                final_cnt = _TOPIC.unpack_from(self._mmap, topic_offset)[2]
+                if final_cnt > 0:
+                    return final_cnt - 1
+        # Not in the topic table if it was full
+        with self._append_lock:
+            return self._segment_cnt.get((namespace, topic_name))
+
+    def _is_out_of_range(self, key: SegmentKey) -> bool:
+        namespace, topic_name, segment_idx = key
+        segment_cnt = self.get_final_segment_count(topic_name, namespace)
+        return segment_idx < 0 or (
+            segment_cnt is not None and segment_idx >= segment_cnt
+        )
+
+    def wait_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._is_out_of_range((namespace, topic_name, segment_idx)):
+            segment = self.get_segment(topic_name, segment_idx, namespace)
+            if segment is not None:
+                return segment
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"Segment {segment_idx} of topic {topic_name} not produced"
+                )
+            time.sleep(self.POLL_INTERVAL)
+        return None
+
+    async def await_segment(
+        self,
+        topic_name: str,
+        segment_idx: int,
+        timeout: float | None = None,
+        namespace: str = "",
+    ) -> SegmentNode | None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._is_out_of_range((namespace, topic_name, segment_idx)):
+            segment = self.get_segment(topic_name, segment_idx, namespace)
+            if segment is not None:
+                return segment
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"Segment {segment_idx} of topic {topic_name} not produced"
+                )
+            await asyncio.sleep(self.POLL_INTERVAL)
+        return None
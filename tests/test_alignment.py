@@ -0,0 +1,66 @@
+import shutil
+import numpy as np
+import pytest
+from pathlib import Path
+from src.server.mcap_catalog import (
+    Alignment,
+    Catalog,
+    NO_MATCH,
+    TopicAligner,
+    nearest_indices,
+)
+
+
+@pytest.fixture
+def setup_data(tmp_path):
+    bag_dir = Path(__file__).parent / "data/synthetic_images_1760323041"
+    # Work on a copy, the aligner caches its timestamps next to the bag
+    shutil.copytree(bag_dir, tmp_path / bag_dir.name)
+    mcap_file = tmp_path / bag_dir.name / "synthetic_images_1760323041_0.mcap"
+
+    data = {"mcap_file": str(mcap_file), "topic_name": "/mytopic/image/compressed"}
+    yield data
+
+
+def test_nearest_indices():
+    timestamps = np.array([0, 10, 20, 30], dtype=np.int64)
+    reference = np.array([-5, 4, 6, 16, 29, 100], dtype=np.int64)
+
+    assert nearest_indices(timestamps, reference).tolist() == [0, 0, 1, 2, 3, 3]
+    assert nearest_indices(timestamps, reference, max_skew_ns=4).tolist() == [
+        NO_MATCH,
+        0,
+        1,
+        2,
+        3,
+        NO_MATCH,
+    ]
+    assert nearest_indices(timestamps[:0], reference).tolist() == [NO_MATCH] * 6
+
+
+def test_align_with_itself(setup_data):
+    aligner = TopicAligner(setup_data["mcap_file"])
+    topic_name = setup_data["topic_name"]
+    alignment = aligner.align(topic_name, [topic_name])
+
+    assert len(alignment.reference_timestamps) == 132
+    assert alignment.indices[topic_name].tolist() == list(range(132))
+    assert not np.any(alignment.skews[topic_name])
+
+    # The timestamps are cached next to the bag
+    assert aligner.get_cache_path().exists()
+    cached = TopicAligner(setup_data["mcap_file"]).get_timestamps()
+    assert np.array_equal(cached[topic_name], alignment.reference_timestamps)
+
+
+def test_align_from_catalog(setup_data, tmp_path):
+    catalog = Catalog(setup_data["mcap_file"])
+    alignment = catalog.align(setup_data["topic_name"], max_skew_ns=0)
+
+    # A single topic in the bag, nothing to join
+    assert alignment.indices == {}
+
+    alignment.save(tmp_path / "alignment.npz")
+    loaded = Alignment.load(tmp_path / "alignment.npz")
+    assert loaded.reference_topic == setup_data["topic_name"]
+    assert np.array_equal(loaded.reference_timestamps, alignment.reference_timestamps)
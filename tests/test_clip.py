@@ -0,0 +1,93 @@
+import io
+import av
+import numpy as np
+import pytest
+from src.server.clip import export_clip, get_clip_parts
+from src.server.executors import AbstractStage, H264ConvertorStage
+from src.server.models import Topic
+
+FPS = 30
+FRAME_NS = int(1e9 / FPS)
+
+
+class _FrameSource(AbstractStage):
+    """One decoded frame per pts, its gray level is its index"""
+
+    def __init__(self, frame_cnt: int) -> None:
+        super().__init__()
+        self._frame_cnt = frame_cnt
+        self._idx = 0
+
+    def next(self, topic):
+        if self._idx >= self._frame_cnt:
+            return None
+        frame = np.full((64, 96, 3), self._idx, np.uint8)
+        ts = self._idx * FRAME_NS
+        self._idx += 1
+        return frame, ts
+
+
+class _Processor:
+    """Serves the segments of a H264ConvertorStage like OnDemandProcessor"""
+
+    def __init__(self, duration: int) -> None:
+        self.stage = H264ConvertorStage(duration, 0)
+        self.stage.set_child_executor(_FrameSource(duration // FRAME_NS))
+        topic = Topic(name="/camera", schema_name="/camera")
+        self.segments = []
+        while (segment := self.stage.next(topic)) is not None:
+            self.segments.append(segment)
+        self.requested = []
+
+    def get_video_stage(self, topic_name):
+        return self.stage if topic_name == "/camera" else None
+
+    def get_renditions(self, topic_name):
+        return []
+
+    def get_segment(self, topic_name, segment_idx, prefetch=True):
+        assert not prefetch
+        self.requested.append(segment_idx)
+        return self.segments[segment_idx]
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return _Processor(int(8e9))
+
+
+def _decode(data: bytes):
+    with av.open(io.BytesIO(data)) as container:
+        return [frame.to_ndarray(format="rgb24") for frame in container.decode(video=0)]
+
+
+def test_get_clip_parts(processor):
+    frames_per_segment = processor.stage.layout.frames_per_segment
+    segment_ns = frames_per_segment * FRAME_NS
+    start_ns = frames_per_segment // 2 * FRAME_NS
+    parts = get_clip_parts(processor, "/camera", start_ns, 3 * segment_ns)
+    assert [part.segment_idx for part in parts] == [0, 1, 2]
+    assert [part.is_complete for part in parts] == [False, True, True]
+    assert parts[0].first_frame == frames_per_segment // 2
+
+    assert get_clip_parts(processor, "/camera", int(1e12), int(2e12)) == []
+    with pytest.raises(KeyError):
+        get_clip_parts(processor, "/lidar", 0, int(1e9))
+
+
+def test_export_clip(processor):
+    processor.requested.clear()
+    start_ns, end_ns = 45 * FRAME_NS, 150 * FRAME_NS
+    output = io.BytesIO()
+    frame_cnt = export_clip(processor, "/camera", start_ns, end_ns, output)
+    assert frame_cnt == 105
+    # Only the segments of the clip are produced
+    assert processor.requested == [0, 1, 2]
+
+    frames = _decode(output.getvalue())
+    assert len(frames) == frame_cnt
+    levels = [int(frame[32, 48, 0]) for frame in frames]
+    assert all(abs(level - (45 + idx)) <= 2 for idx, level in enumerate(levels))
+
+    with pytest.raises(ValueError):
+        export_clip(processor, "/camera", int(1e12), int(2e12), io.BytesIO())
@@ -0,0 +1,121 @@
+import threading
+import pytest
+import src.server.executors.compression as compression
+from src.server.executors import (
+    CompressionStage,
+    SegmentedStage,
+    SegmentNode,
+    compress,
+    decompress,
+    get_available_codecs,
+    train_dictionary,
+)
+from src.server.models import Topic
+from src.server.processor import decode_segment, encode_segment
+from src.server.processor import load_segment, store_segment
+from src.server.segment_cache import SegmentCache
+
+PAYLOAD = b"".join(b"point %d intensity %d\n" % (idx, idx % 7) for idx in range(1000))
+
+
+@pytest.mark.parametrize("codec", get_available_codecs())
+def test_compress(codec):
+    compressed = compress(PAYLOAD, codec)
+    assert len(compressed) < len(PAYLOAD) / 2
+    assert decompress(compressed, codec) == PAYLOAD
+
+
+def test_compress_with_dictionary():
+    pytest.importorskip("zstandard")
+    samples = [
+        b"{'label': 'car', 'x': %d, 'y': %d}" % (idx, idx * 3) for idx in range(500)
+    ]
+    dictionary = train_dictionary(samples, size=4096)
+    payload = b"{'label': 'car', 'x': 1000, 'y': 3000}"
+
+    compressed = compress(payload, "zstd", dictionary=dictionary)
+    assert len(compressed) < len(compress(payload, "zstd"))
+    assert decompress(compressed, "zstd", dictionary.id) == payload
+
+
+def test_cached_segment_dictionary(tmp_path, monkeypatch):
+    pytest.importorskip("zstandard")
+    samples = [b"{'x': %d, 'y': %d}" % (idx, idx * 3) for idx in range(500)]
+    dictionary = train_dictionary(samples, size=4096)
+    segment = SegmentNode(
+        compress(PAYLOAD, "zstd", dictionary=dictionary),
+        encoding="zstd",
+        dictionary_id=dictionary.id,
+    )
+    segment_cache = SegmentCache(tmp_path)
+    store_segment(segment_cache, "key", segment)
+
+    # A restarted process finds the dictionary next to the cache
+    monkeypatch.setattr(compression, "_dictionaries", {})
+    loaded = load_segment(segment_cache, "key")
+    assert decompress(loaded.data, "zstd", loaded.dictionary_id) == PAYLOAD
+
+    # Payloads that can't be decompressed anymore are a miss
+    monkeypatch.setattr(compression, "_dictionaries", {})
+    (tmp_path / "dictionaries" / dictionary.id).unlink()
+    assert load_segment(segment_cache, "key") is None
+
+
+class _Segments(SegmentedStage):
+    def __init__(self):
+        super().__init__()
+        self.segment_idx = 0
+
+    def get_segment_count(self):
+        return 2
+
+    def seek_segment(self, segment_idx):
+        self.segment_idx = segment_idx
+
+    def get_last_segment_start_ns(self):
+        return (self.segment_idx - 1) * 1_000_000_000
+
+    def next(self, topic):
+        if self.segment_idx >= 2:
+            return None
+        self.segment_idx += 1
+        return SegmentNode(PAYLOAD, {"coarse": PAYLOAD[:100]})
+
+
+def test_compression_stage():
+    codec = get_available_codecs()[0]
+    stage = CompressionStage(codec)
+    stage.set_child_executor(_Segments())
+    topic = Topic(name="/lidar", schema_name="/lidar")
+
+    # Forwarded to the child
+    assert stage.get_segment_count() == 2
+    stage.seek_segment(1)
+    cancel_event = threading.Event()
+    stage.set_cancel_event(cancel_event)
+    assert stage.child_executor._cancel_event is cancel_event
+
+    segment = stage.next(topic)
+    assert segment.encoding == codec
+    assert decompress(segment.data, codec) == PAYLOAD
+    assert decompress(segment.renditions["coarse"], codec) == PAYLOAD[:100]
+    assert stage.next(topic) is None
+
+    # The codec survives the buffer pool disk tier and the segment cache
+    decoded = decode_segment(encode_segment(segment))
+    assert decoded.encoding == codec
+    assert decoded.data == segment.data
+
+
+def test_compression_stage_next_batch():
+    codec = get_available_codecs()[0]
+    stage = CompressionStage(codec)
+    stage.set_child_executor(_Segments())
+    topic = Topic(name="/lidar", schema_name="/lidar")
+
+    # Segments paired with the start of their window
+    batch = stage.next_batch(topic, 10)
+    assert batch is not None and len(batch) == 2
+    assert list(batch.timestamps) == [0, 1_000_000_000]
+    assert decompress(batch.payloads[1].data, codec) == PAYLOAD
+    assert stage.next_batch(topic, 10) is None
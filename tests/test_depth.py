@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+from sensor_msgs import msg
+from src.server.executors import (
+    DEPTH_HEADER,
+    AbstractStage,
+    DepthStage,
+    decode_compressed_depth,
+    get_depth_lut,
+)
+from src.server.models import Topic
+
+
+def _make_depth_msg(depth, fmt="16UC1; compressedDepth png", quantization=(0, 0)):
+    _, png = cv2.imencode(".png", depth)
+    header = DEPTH_HEADER.pack(0, *quantization)
+    return msg.CompressedImage(format=fmt, data=header + png.tobytes())
+
+
+def test_decode_compressed_depth():
+    depth = np.arange(12, dtype=np.uint16).reshape(3, 4) * 1000
+    decoded, quantization = decode_compressed_depth(_make_depth_msg(depth))
+    assert quantization is None
+    assert decoded.dtype == np.uint16
+    assert np.array_equal(decoded, depth)
+
+    # Without header
+    _, png = cv2.imencode(".png", depth)
+    legacy = msg.CompressedImage(format="16UC1; png", data=png.tobytes())
+    assert np.array_equal(decode_compressed_depth(legacy)[0], depth)
+
+    # Inverse depth quantization of 32FC1
+    quantized = _make_depth_msg(depth, "32FC1; compressedDepth png", (100.0, 5.0))
+    assert decode_compressed_depth(quantized)[1] == (100.0, 5.0)
+
+
+def test_get_depth_lut():
+    lut = get_depth_lut(10.0)
+    assert lut.shape == (65536, 3)
+    assert lut.dtype == np.uint8
+    assert not lut[0].any()  # missing depth
+    assert get_depth_lut(10.0) is lut
+    # Saturates past the max depth
+    assert np.array_equal(lut[10000], lut[65535])
+    assert not np.array_equal(lut[1000], lut[5000])
+
+    # value = a / depth + b, far values come first
+    lut = get_depth_lut(10.0, quantization=(100.0, 5.0))
+    assert not lut[5].any()
+    assert np.array_equal(lut[15], get_depth_lut(10.0)[10000])
+
+
+class _DepthSource(AbstractStage):
+    def next(self, topic):
+        depth = np.full((48, 64), 2000, np.uint16)
+        depth[0] = 0
+        return _make_depth_msg(depth), 42
+
+
+def test_depth_stage():
+    stage = DepthStage(max_depth_m=4.0)
+    stage.set_child_executor(_DepthSource())
+
+    compressed_image, ts = stage.next(Topic(name="/depth", schema_name="/depth"))
+    assert ts == 42
+    image = stage.decode_frame(compressed_image)
+    assert image.shape == (48, 64, 3)
+    assert image.dtype == np.uint8
+    assert not image[0].any()
+    assert np.array_equal(image[1, 0], get_depth_lut(4.0)[2000])
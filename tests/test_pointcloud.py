@@ -0,0 +1,213 @@
+import pytest
+import numpy as np
+from sensor_msgs import msg
+from src.server.executors import (
+    POINT_DTYPE,
+    AbstractStage,
+    LodTier,
+    PointCloudStage,
+    VoxelLodStage,
+    decode_point_cloud,
+    pack_point_clouds,
+    unpack_point_clouds,
+    voxel_downsample,
+)
+from src.server.models import Topic
+from src.repository.pointcloud import read_points, read_points_xyz
+
+
+def _make_cloud(xyz: np.ndarray, intensity: np.ndarray) -> msg.PointCloud2:
+    """A cloud with the padding and extra fields of a real LiDAR driver"""
+    dtype = np.dtype(
+        {
+            "names": ["x", "y", "z", "intensity", "ring"],
+            "formats": ["<f4", "<f4", "<f4", "<f4", "<u2"],
+            "offsets": [0, 4, 8, 16, 20],
+            "itemsize": 32,
+        }
+    )
+    points = np.zeros(len(xyz), dtype)
+    points["x"], points["y"], points["z"] = xyz.T
+    points["intensity"] = intensity
+    fields = [
+        msg.PointField(name=name, offset=offset, datatype=datatype, count=1)
+        for name, offset, datatype in [
+            ("x", 0, msg.PointField.FLOAT32),
+            ("y", 4, msg.PointField.FLOAT32),
+            ("z", 8, msg.PointField.FLOAT32),
+            ("intensity", 16, msg.PointField.FLOAT32),
+            ("ring", 20, msg.PointField.UINT16),
+        ]
+    ]
+    return msg.PointCloud2(
+        height=1,
+        width=len(xyz),
+        fields=fields,
+        is_bigendian=False,
+        point_step=dtype.itemsize,
+        row_step=dtype.itemsize * len(xyz),
+        data=points.tobytes(),
+        is_dense=False,
+    )
+
+
+def _random_xyz(rng: np.random.Generator, point_cnt: int) -> np.ndarray:
+    return rng.uniform(-50, 50, (point_cnt, 3)).astype(np.float32)
+
+
+def test_decode_point_cloud():
+    rng = np.random.default_rng(0)
+    xyz = _random_xyz(rng, 100)
+    xyz[10] = np.nan
+    points = decode_point_cloud(_make_cloud(xyz, np.arange(100)))
+
+    assert len(points) == 99
+    assert np.array_equal(points["x"], np.delete(xyz[:, 0], 10))
+    assert np.array_equal(points["intensity"], np.delete(np.arange(100), 10))
+
+
+def test_pack_point_clouds():
+    rng = np.random.default_rng(0)
+    frames = [
+        (1_000 + idx, decode_point_cloud(_make_cloud(_random_xyz(rng, 1000), 7)))
+        for idx in range(3)
+    ]
+    data = pack_point_clouds(1_000, frames)
+
+    # Several times smaller than the raw clouds
+    assert len(data) * 4 < 3 * 1000 * 32
+
+    start_ns, unpacked = unpack_point_clouds(data)
+    assert start_ns == 1_000
+    assert [frame.timestamp_ns for frame in unpacked] == [1_000, 1_001, 1_002]
+    for (_, points), frame in zip(frames, unpacked):
+        xyz = np.stack([points["x"], points["y"], points["z"]], axis=1)
+        # Quantized to steps of 100m / 65535
+        assert np.abs(frame.xyz - xyz).max() < 0.002
+        assert np.all(frame.intensity == 7)
+
+    assert unpack_point_clouds(pack_point_clouds(0, []))[1] == []
+
+
+@pytest.mark.parametrize("high", [1.0, 255.0, 65535.0])
+def test_pack_point_clouds_intensity_range(high):
+    # Float 0..1, 8-bit and 16-bit drivers all keep 256 distinct levels
+    intensity = np.linspace(0, high, 1000)
+    points = decode_point_cloud(_make_cloud(np.zeros((1000, 3)), intensity))
+    _, unpacked = unpack_point_clouds(pack_point_clouds(0, [(0, points)]))
+
+    assert len(np.unique(unpacked[0].intensity)) == 256
+    assert np.abs(unpacked[0].intensity - intensity).max() <= high / 255 / 2 + 1e-3
+
+
+class _CloudSource(AbstractStage):
+    def __init__(self, messages):
+        super().__init__()
+        self._messages = messages
+        self._position = 0
+
+    def seek(self, timestamp_ns):
+        self._position = next(
+            (idx for idx, (_, ts) in enumerate(self._messages) if ts >= timestamp_ns),
+            len(self._messages),
+        )
+
+    def next(self, topic):
+        if self._position >= len(self._messages):
+            return None
+        self._position += 1
+        return self._messages[self._position - 1]
+
+
+def test_point_cloud_stage():
+    rng = np.random.default_rng(0)
+    # 10Hz for 5s
+    messages = [
+        (_make_cloud(_random_xyz(rng, 10), 1), idx * 100_000_000) for idx in range(50)
+    ]
+    stage = PointCloudStage(5_000_000_000, start_ns=0)
+    stage.set_child_executor(_CloudSource(messages))
+    topic = Topic(name="/lidar", schema_name="/lidar")
+
+    assert stage.get_segment_count() == 3
+    assert stage.get_segment_seconds(2) == 1.0
+    segments = [stage.next(topic) for _ in range(3)]
+    assert stage.next(topic) is None
+    assert [len(unpack_point_clouds(s.data)[1]) for s in segments] == [20, 20, 10]
+
+    stage.seek_segment(1)
+    start_ns, frames = unpack_point_clouds(stage.next(topic).data)
+    assert start_ns == 2_000_000_000
+    assert frames[0].timestamp_ns == 2_000_000_000
+
+    # Batches pair each segment with the start of its window
+    stage.seek_segment(1)
+    batch = stage.next_batch(topic, 10)
+    assert list(batch.timestamps) == [2_000_000_000, 4_000_000_000]
+
+
+def test_read_points():
+    rng = np.random.default_rng(0)
+    xyz = _random_xyz(rng, 100)
+    cloud = _make_cloud(xyz, np.arange(100))
+
+    # A view on the message data, with only the requested fields
+    points = read_points(cloud, ["x", "intensity"])
+    assert points.dtype.names == ("x", "intensity")
+    assert np.shares_memory(points, np.frombuffer(cloud.data, np.uint8))
+    assert np.array_equal(points["intensity"], np.arange(100))
+    assert read_points(cloud)["ring"].dtype == np.uint16
+
+    xyz[[3, 50]] = np.nan
+    assert np.array_equal(
+        read_points_xyz(_make_cloud(xyz, 0)), np.delete(xyz, [3, 50], axis=0)
+    )
+
+
+def test_read_points_padded_rows():
+    rng = np.random.default_rng(0)
+    xyz = _random_xyz(rng, 20)
+    cloud = _make_cloud(xyz, 0)
+    # 2 rows of 10 points, each row followed by 8 bytes of padding
+    data = np.frombuffer(cloud.data, np.uint8).reshape(2, 10 * cloud.point_step)
+    cloud.data = np.pad(data, ((0, 0), (0, 8))).tobytes()
+    cloud.height, cloud.width = 2, 10
+    cloud.row_step = 10 * cloud.point_step + 8
+
+    assert np.array_equal(read_points_xyz(cloud), xyz)
+
+
+def test_voxel_downsample():
+    points = np.zeros(4, POINT_DTYPE)
+    points["x"] = [0.1, 0.3, 1.2, -0.1]
+    points["intensity"] = [10, 20, 30, 40]
+    downsampled = voxel_downsample(points, 1.0)
+
+    # A point per occupied voxel, at the centroid of its points
+    assert np.allclose(np.sort(downsampled["x"]), [-0.1, 0.2, 1.2])
+    assert np.allclose(np.sort(downsampled["intensity"]), [15, 30, 40])
+    assert len(voxel_downsample(points[:0], 1.0)) == 0
+
+
+def test_voxel_lod_stage():
+    rng = np.random.default_rng(0)
+    messages = [
+        (_make_cloud(_random_xyz(rng, 5000), 1), idx * 100_000_000) for idx in range(20)
+    ]
+    lod_stage = VoxelLodStage([LodTier("coarse", 10.0), LodTier("fine", 1.0)])
+    lod_stage.set_child_executor(_CloudSource(messages))
+    stage = PointCloudStage(2_000_000_000, start_ns=0)
+    stage.set_child_executor(lod_stage)
+
+    segment = stage.next(Topic(name="/lidar", schema_name="/lidar"))
+    assert list(segment.renditions.keys()) == ["coarse", "fine"]
+    point_cnts = [
+        len(unpack_point_clouds(data)[1][0].xyz)
+        for data in [segment.renditions["coarse"], segment.renditions["fine"]]
+    ]
+    assert point_cnts[0] <= 1000 < point_cnts[1] < 5000
+    assert len(unpack_point_clouds(segment.data)[1][0].xyz) == 5000
+    assert stage.get_cache_profile()["child"]["tiers"] == [
+        ["coarse", 10.0],
+        ["fine", 1.0],
+    ]
@@ -0,0 +1,44 @@
+from src.server.prefetch import PrefetchScheduler
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_window_follows_playback_speed():
+    clock = FakeClock()
+    scheduler = PrefetchScheduler(prefetch_cnt=2, max_prefetch_cnt=16, clock=clock)
+
+    # 2 sec segments requested every 2 sec, real time
+    for segment_idx in range(4):
+        scheduler.update("player", "/camera", segment_idx, 2.0)
+        clock.now += 2.0
+    playhead = scheduler.get_playhead("player", "/camera")
+    assert scheduler.get_window(playhead) == 2
+    assert scheduler.get_candidates() == [("/camera", 4), ("/camera", 5)]
+
+    # Every 0.5 sec, 4x
+    for segment_idx in range(4, 12):
+        scheduler.update("player", "/camera", segment_idx, 2.0)
+        clock.now += 0.5
+    assert scheduler.get_window(playhead) == 8
+
+
+def test_seek_moves_window():
+    clock = FakeClock()
+    scheduler = PrefetchScheduler(prefetch_cnt=2, client_timeout=10, clock=clock)
+    scheduler.update("first", "/camera", 0, 2.0)
+    scheduler.update("second", "/camera", 50, 2.0)
+    assert scheduler.get_candidates()[:2] == [("/camera", 1), ("/camera", 51)]
+
+    scheduler.update("first", "/camera", 20, 2.0)
+    assert not scheduler.is_wanted("/camera", 1)
+    assert scheduler.is_wanted("/camera", 21)
+
+    # Idle players are forgotten
+    clock.now += 11
+    assert scheduler.get_candidates() == []
@@ -1,7 +1,30 @@
+import asyncio
+import multiprocessing
+import os
+import threading
 import pytest
-from src.server.mcap_catalog import Catalog
-from src.server.executors import McapReaderStage, H264ConvertorStage, AbstractStage
-from src.server.processor import Processor, BufferPool
+import numpy as np
+from src.server.mcap_catalog import Catalog, MOSAIC_TOPIC_NAME
+from src.server.executors import (
+    McapReaderStage,
+    H264ConvertorStage,
+    AbstractStage,
+    SegmentLayout,
+    H264LadderStage,
+    Rendition,
+    MosaicStage,
+    SpriteSheetLayout,
+    ThumbnailStage,
+    SegmentNode,
+)
+from src.server.processor import Processor, BufferPool, OnDemandProcessor
+from src.server.processor import encode_segment, decode_segment, _run_plan_worker
+from src.server.segment_cache import SegmentCache
+from src.server.playlist import (
+    build_media_playlist,
+    build_master_playlist,
+    build_thumbnail_vtt,
+)
 from src.server.models import Topic
 from sensor_msgs import msg
 from pathlib import Path
@@ -48,6 +71,31 @@ def test_run_mcap_read_stage(setup_data):
     assert cnt == 132
 
 
+def test_mcap_read_stage_memory_budget(setup_data):
+    # A budget smaller than a single image must not lose messages
+    stage = McapReaderStage(setup_data["mcap_file"], memory_budget=1, topic_queue_cap=1)
+    topic = Topic(
+        name=setup_data["topic_name"],
+        schema_name="sensor_msgs/msg/CompressedImage",
+        schema_type=msg.CompressedImage,
+    )
+
+    cnt = 0
+    while stage.next(topic) is not None:
+        cnt += 1
+        assert stage.get_queued_bytes() <= 1
+    assert cnt == 132
+    assert stage.get_spilled_count() == 0
+
+    # Looking for another topic spills then drops the never requested one
+    stage = McapReaderStage(setup_data["mcap_file"], memory_budget=1)
+    other = Topic(name="/other", schema_name="", schema_type=msg.CompressedImage)
+    assert stage.next(other) is None
+    assert stage.get_spilled_count() == 0
+    # The bytes spilled by the dropped topic were released with it
+    assert os.fstat(stage._spill_file.fileno()).st_size == 0
+
+
 def test_get_execution_plan(setup_data):
     catalog = Catalog(setup_data["mcap_file"])
     catalog.set_include_topics([setup_data["topic_name"]])
@@ -58,6 +106,20 @@ def test_get_execution_plan(setup_data):
     )
 
 
+def test_execution_plans_share_reader(setup_data):
+    catalog = Catalog(setup_data["mcap_file"])
+    catalog.set_mosaic(True)
+    catalog.set_thumbnails(True)
+    execution_plans = catalog.get_execution_plans()
+
+    mosaic_plan = next(p for p in execution_plans if p.topic.name == MOSAIC_TOPIC_NAME)
+    assert mosaic_plan.plan[-1].executor_class is catalog._get_reader_stage([])
+
+    # Thumbnails seek, so they read on their own
+    thumbnail_plan = next(p for p in execution_plans if p is not mosaic_plan)
+    assert thumbnail_plan.plan[-1].executor_class is not catalog._get_reader_stage([])
+
+
 def test_h264_convertor_stage(setup_data):
     reader_stage = McapReaderStage(setup_data["mcap_file"])
     stage = H264ConvertorStage(int(10954221312 + 1e9))
@@ -76,6 +138,31 @@ def test_h264_convertor_stage(setup_data):
     assert stage.get_total_messages_consumed() == 132
 
 
+def test_next_batch(setup_data):
+    reader_stage = McapReaderStage(setup_data["mcap_file"])
+    topic = Topic(
+        name=setup_data["topic_name"],
+        schema_name="sensor_msgs/msg/CompressedImage",
+        schema_type=msg.CompressedImage,
+    )
+
+    batch = reader_stage.next_batch(topic, 100)
+    assert batch is not None and len(batch) == 100
+    assert batch.timestamps.dtype == np.int64
+    assert np.all(np.diff(batch.timestamps) >= 0)
+
+    batch = reader_stage.next_batch(topic, 100)
+    assert batch is not None and len(batch) == 32
+    assert reader_stage.next_batch(topic, 100) is None
+
+    stage = H264ConvertorStage(int(10954221312 + 1e9))
+    stage.set_child_executor(McapReaderStage(setup_data["mcap_file"]))
+    batch = stage.next_batch(topic, 10)
+    assert batch is not None and len(batch) == 6
+    assert np.all(np.diff(batch.timestamps) == stage.layout.get_segment_offset_ns(1))
+    assert isinstance(batch.payloads[0], SegmentNode)
+
+
 def test_processor_start(setup_data):
     buffer_pool = BufferPool()
     processor = Processor(
@@ -85,3 +172,394 @@ def test_processor_start(setup_data):
 
     assert buffer_pool.get_segment(setup_data["topic_name"], 2) is not None
     assert buffer_pool.get_segment(setup_data["topic_name"], 7) is None
+
+
+def test_processor_start_parallel(setup_data):
+    buffer_pool = BufferPool()
+    processor = Processor(setup_data["mcap_file"], buffer_pool, workers=2)
+    processor.start()
+
+    produced_cnt, segment_cnt = processor.get_progress()[setup_data["topic_name"]]
+    assert produced_cnt == segment_cnt
+    assert buffer_pool.get_segment(setup_data["topic_name"], 2) is not None
+    assert buffer_pool.get_segment(setup_data["topic_name"], 7) is None
+
+
+def test_plan_worker_sends_whole_segment(monkeypatch):
+    segment = SegmentNode(
+        b"high", renditions={"low": b"low"}, encoding="zstd", dictionary_id="abc"
+    )
+
+    class _Plan:
+        topic = Topic(name="/camera", schema_name="", schema_type=None)
+
+        def __init__(self):
+            self._segments = [segment]
+
+        def next(self):
+            return self._segments.pop() if self._segments else None
+
+    class _Catalog:
+        def __init__(self, filename):
+            pass
+
+        def set_include_topics(self, topic_list):
+            pass
+
+        def get_execution_plans(self):
+            return [_Plan()]
+
+    monkeypatch.setattr("src.server.processor.Catalog", _Catalog)
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    _run_plan_worker("bag.mcap", "/camera", send_conn)
+
+    # Renditions and encoding survive the pipe, not only the payload
+    received = decode_segment(recv_conn.recv_bytes())
+    assert received.data == b"high" and received.renditions == {"low": b"low"}
+    assert received.encoding == "zstd" and received.dictionary_id == "abc"
+    with pytest.raises(EOFError):
+        recv_conn.recv_bytes()
+
+
+def test_buffer_pool_eviction(tmp_path):
+    buffer_pool = BufferPool(memory_budget=300, spill_dir=tmp_path)
+    for idx in range(5):
+        buffer_pool.add_segment("/camera", SegmentNode(bytes([idx]) * 100))
+
+    stats = buffer_pool.get_stats()
+    assert stats["memory_bytes"] <= 300
+    assert stats["evictions"] == 2 and stats["spills"] == 2
+
+    # Evicted segments are read back from the disk tier
+    assert buffer_pool.get_segment("/camera", 0).data == bytes([0]) * 100
+    assert buffer_pool.get_segment("/camera", 5) is None
+    stats = buffer_pool.get_stats()
+    assert stats["disk_hits"] == 1 and stats["misses"] == 1
+
+    # Bags sharing the pool don't see each other's topics
+    buffer_pool.scoped("other.mcap").add_segment("/camera", SegmentNode(b"other"))
+    assert buffer_pool.get_segment("/camera", 0).data != b"other"
+    assert buffer_pool.scoped("other.mcap").get_segment("/camera", 0).data == b"other"
+
+
+def test_buffer_pool_promotes_oversized_segment(tmp_path):
+    buffer_pool = BufferPool(memory_budget=100, spill_dir=tmp_path)
+    buffer_pool.add_segment("/camera", SegmentNode(b"a" * 200))
+    assert buffer_pool.get_stats()["disk_segments"] == 1
+
+    # Read back alone over the budget, it stays in memory instead of being lost
+    assert buffer_pool.get_segment("/camera", 0).data == b"a" * 200
+    assert buffer_pool.get_segment("/camera", 0).data == b"a" * 200
+    stats = buffer_pool.get_stats()
+    assert stats["memory_segments"] == 1 and stats["disk_segments"] == 0
+
+
+def test_buffer_pool_spills_without_lock(tmp_path, monkeypatch):
+    writing, release = threading.Event(), threading.Event()
+
+    def slow_encode_segment(segment):
+        # Only the first spill is slow
+        if not writing.is_set():
+            writing.set()
+            release.wait(5)
+        return encode_segment(segment)
+
+    monkeypatch.setattr("src.server.processor.encode_segment", slow_encode_segment)
+    buffer_pool = BufferPool(memory_budget=150, spill_dir=tmp_path)
+    buffer_pool.add_segment("/camera", SegmentNode(b"a" * 100))
+    thread = threading.Thread(
+        target=buffer_pool.add_segment, args=("/camera", SegmentNode(b"b" * 100))
+    )
+    thread.start()
+    assert writing.wait(5)
+
+    # The pool is usable while the evicted segment is written to disk, and the
+    # segment itself is read back from memory
+    buffer_pool.add_segment("/lidar", SegmentNode(b"c" * 10))
+    assert buffer_pool.get_segment_count("/camera") == 2
+    assert buffer_pool.get_segment("/camera", 0).data == b"a" * 100
+    assert not release.is_set()
+    release.set()
+    thread.join()
+
+    # The write of the segment read back is dropped
+    stats = buffer_pool.get_stats()
+    assert stats["spills"] == 1 and stats["disk_segments"] == 1
+    assert len(list(tmp_path.iterdir())) == 1
+    assert buffer_pool.get_segment("/camera", 1).data == b"b" * 100
+
+
+def test_wait_segment_while_processing(setup_data):
+    buffer_pool = BufferPool()
+    topic_name = setup_data["topic_name"]
+    processor = Processor(setup_data["mcap_file"], buffer_pool, [topic_name])
+    thread = processor.start_in_background()
+
+    # Readable as soon as it is produced, not once the whole bag is processed
+    assert buffer_pool.wait_segment(topic_name, 0, timeout=60) is not None
+    assert buffer_pool.wait_segment(topic_name, 7, timeout=60) is None
+    thread.join()
+    assert buffer_pool.get_final_segment_count(topic_name) == 6
+
+
+def test_await_segment():
+    buffer_pool = BufferPool()
+    buffer_pool.set_segment_count("/camera", 2)
+
+    async def run():
+        waiting = asyncio.ensure_future(buffer_pool.await_segment("/camera", 1))
+        await asyncio.sleep(0)
+        buffer_pool.add_segment("/camera", SegmentNode(b"data"), 1)
+        assert (await waiting).data == b"data"
+
+        assert await buffer_pool.await_segment("/camera", 2) is None
+        with pytest.raises(TimeoutError):
+            await buffer_pool.await_segment("/camera", 0, timeout=0.01)
+
+    asyncio.run(run())
+
+
+def test_segment_layout():
+    layout = SegmentLayout(int(10954221312 + 1e9))
+    assert layout.frames_per_segment == 61
+    assert layout.get_segment_count() == 6
+    assert layout.get_frame_count(0) == 61
+    assert 0 < layout.get_frame_count(5) <= 61
+    assert layout.get_frame_count(6) == 0
+
+
+def test_build_media_playlist():
+    layout = SegmentLayout(int(10954221312 + 1e9))
+    playlist = build_media_playlist(layout, lambda idx: f"segment_{idx}.ts")
+
+    assert playlist.startswith("#EXTM3U")
+    assert playlist.count("#EXTINF") == 6
+    assert "segment_5.ts" in playlist
+    assert playlist.strip().endswith("#EXT-X-ENDLIST")
+
+
+def test_on_demand_processor(setup_data):
+    buffer_pool = BufferPool()
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"], buffer_pool, [setup_data["topic_name"]]
+    )
+    topic_name = setup_data["topic_name"]
+    segment_cnt = processor.get_segment_count(topic_name)
+
+    # Nothing is transcoded before it is requested
+    assert buffer_pool.get_segment(topic_name, 0) is None
+
+    # Concurrent requests for the same segment are coalesced
+    first = processor.request_segment(topic_name, segment_cnt - 2)
+    second = processor.request_segment(topic_name, segment_cnt - 2)
+    assert first is second
+    assert first.result(timeout=60) is not None
+
+    # Seeking backwards works too
+    assert processor.get_segment(topic_name, 0, timeout=60) is not None
+    assert processor.get_segment(topic_name, segment_cnt) is None
+    processor.shutdown(finish_pending=True)
+
+    # The neighbour of the last request was produced speculatively
+    assert buffer_pool.get_segment(topic_name, 1) is not None
+
+
+def test_on_demand_processor_async(setup_data):
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"], include_topics=[setup_data["topic_name"]]
+    )
+    topic_name = setup_data["topic_name"]
+
+    async def run():
+        # An abandoned request doesn't leave its segment behind
+        task = asyncio.ensure_future(processor.aget_segment(topic_name, 3))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The plan is still usable afterwards
+        segment = await processor.aget_segment(topic_name, 3)
+        assert segment is not None
+        assert await processor.aget_segment(topic_name, -1) is None
+
+    asyncio.run(run())
+    processor.shutdown()
+
+
+def test_on_demand_processor_close(setup_data):
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"], include_topics=[setup_data["topic_name"]]
+    )
+    topic_name = setup_data["topic_name"]
+    future = processor.request_segment(topic_name, 1, prefetch=False)
+    processor.close()
+
+    # In flight and late requests are still served once closed
+    assert future.result(timeout=60) is not None
+    assert processor.get_segment(topic_name, 3, timeout=60) is not None
+
+
+def test_on_demand_processor_parallel_topic(setup_data):
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"],
+        include_topics=[setup_data["topic_name"]],
+        max_workers=3,
+    )
+    topic_name = setup_data["topic_name"]
+    futures = [
+        processor.request_segment(topic_name, idx, prefetch=False) for idx in range(3)
+    ]
+    segments = [future.result(timeout=60) for future in futures]
+
+    # The segments of a topic were produced by plans of their own
+    assert all(segment is not None and len(segment.data) > 0 for segment in segments)
+    assert 1 < processor._plan_cnt[topic_name] <= 3
+    processor.shutdown()
+
+
+def test_h264_ladder_stage(setup_data):
+    reader_stage = McapReaderStage(setup_data["mcap_file"])
+    renditions = [Rendition("high", 1080, 2_000_000), Rendition("low", 120, 200_000)]
+    stage = H264LadderStage(int(10954221312 + 1e9), renditions=renditions)
+    stage.set_child_executor(reader_stage)
+
+    topic = Topic(
+        name=setup_data["topic_name"],
+        schema_name="sensor_msgs/msg/CompressedImage",
+        schema_type=msg.CompressedImage,
+    )
+
+    segment_cnt = 0
+    while (segment := stage.next(topic)) is not None:
+        segment_cnt += 1
+        assert set(segment.renditions.keys()) == {"high", "low"}
+        assert segment.data == segment.renditions["high"]
+    assert segment_cnt == 6
+    # Every message is decoded once, whatever the number of renditions
+    assert stage.get_total_messages_consumed() == 132
+
+
+def test_rendition_size():
+    rendition = Rendition("720p", 720, 2_800_000)
+    assert rendition.get_size(1920, 1080) == (1280, 720)
+    # Never upscale
+    assert rendition.get_size(640, 480) == (640, 480)
+
+
+def test_build_master_playlist():
+    renditions = [Rendition("720p", 720, 2_800_000), Rendition("360p", 360, 800_000)]
+    playlist = build_master_playlist(renditions, lambda r: f"{r.name}.m3u8")
+
+    assert playlist.count("#EXT-X-STREAM-INF") == 2
+    assert "BANDWIDTH=800000" in playlist
+    assert "360p.m3u8" in playlist
+
+
+def test_mosaic_execution_plan(setup_data):
+    catalog = Catalog(setup_data["mcap_file"])
+    catalog.set_mosaic(True)
+    execution_plans = catalog.get_execution_plans()
+
+    assert [plan.topic.name for plan in execution_plans] == [MOSAIC_TOPIC_NAME]
+    assert isinstance(execution_plans[0].get_head(), MosaicStage)
+
+
+def test_mosaic_stage(setup_data):
+    topic = Topic(
+        name=setup_data["topic_name"],
+        schema_name="sensor_msgs/msg/CompressedImage",
+        schema_type=msg.CompressedImage,
+    )
+    reader_stage = McapReaderStage(setup_data["mcap_file"])
+    # Two tiles on the same topic split its messages, but still make a 2x1 grid
+    stage = MosaicStage(
+        int(10954221312 + 1e9),
+        [topic, topic.model_copy()],
+        tile_width=320,
+        tile_height=180,
+    )
+    stage.set_child_executor(reader_stage)
+    assert stage.get_canvas_size() == (640, 180)
+
+    segment_cnt = 0
+    while stage.next(topic) is not None:
+        segment_cnt += 1
+    assert segment_cnt == 6
+
+
+def test_thumbnail_stage(setup_data):
+    topic = Topic(
+        name=setup_data["topic_name"],
+        schema_name="sensor_msgs/msg/CompressedImage",
+        schema_type=msg.CompressedImage,
+    )
+    layout = SpriteSheetLayout(int(10954221312 + 1e9), cols=4, rows=2)
+    stage = ThumbnailStage(int(10954221312 + 1e9), topic, layout=layout)
+    stage.set_child_executor(McapReaderStage(setup_data["mcap_file"]))
+
+    sheets = []
+    while (sheet := stage.next(topic)) is not None:
+        sheets.append(sheet)
+    # 12 one second thumbnails, 8 per sheet
+    assert len(sheets) == stage.get_segment_count() == 2
+    assert all(sheet.data[:2] == b"\xff\xd8" for sheet in sheets)
+
+
+def test_build_thumbnail_vtt():
+    layout = SpriteSheetLayout(int(12e9), cols=4, rows=2)
+    vtt = build_thumbnail_vtt(layout, lambda idx: f"sheet_{idx}.jpg")
+
+    assert vtt.startswith("WEBVTT")
+    assert vtt.count(" --> ") == 12
+    assert "00:00:09.000 --> 00:00:10.000\nsheet_1.jpg#xywh=160,0,160,90" in vtt
+
+
+def test_processor_segment_cache(setup_data, tmp_path):
+    segment_cache = SegmentCache(tmp_path)
+    topic_name = setup_data["topic_name"]
+    Processor(
+        setup_data["mcap_file"], BufferPool(), [topic_name], 1, segment_cache
+    ).start()
+
+    # Restarted with an empty pool, every segment comes from the cache
+    buffer_pool = BufferPool()
+    processor = Processor(
+        setup_data["mcap_file"], buffer_pool, [topic_name], 1, segment_cache
+    )
+    processor.start()
+    produced_cnt, segment_cnt = processor.get_progress()[topic_name]
+    assert produced_cnt == segment_cnt
+    assert segment_cache.get_stats()["hits"] == segment_cnt
+    assert buffer_pool.get_segment(topic_name, 2) is not None
+
+
+def test_open_cached_payload(setup_data, tmp_path):
+    segment_cache = SegmentCache(tmp_path)
+    topic_name = setup_data["topic_name"]
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"],
+        BufferPool(),
+        [topic_name],
+        prefetch_cnt=0,
+        segment_cache=segment_cache,
+    )
+    assert processor.open_cached_payload(topic_name, 0) is None
+    segment = processor.get_segment(topic_name, 0)
+    # Held by the buffer pool, served from memory
+    assert processor.open_cached_payload(topic_name, 0) is None
+
+    processor = OnDemandProcessor(
+        setup_data["mcap_file"],
+        BufferPool(),
+        [topic_name],
+        prefetch_cnt=0,
+        segment_cache=segment_cache,
+    )
+    key = processor.get_segment_key(topic_name, 0)
+    assert key is not None
+    assert processor.get_segment_key(topic_name, 1000) is None
+    entry_file, offset, length = processor.open_cached_payload(topic_name, 0)
+    with entry_file:
+        entry_file.seek(offset)
+        assert entry_file.read(length) == segment.data
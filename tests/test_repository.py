@@ -95,3 +95,70 @@ class RepositoryTestCase(TestCase):
                 ("/abc/logs/2025_09_22/2025_09_22.mcap", None),
             ],
         )
+
+    def test_directory_logs(self):
+        metadata = {
+            "rosbag2_bagfile_information": {
+                "duration": {"nanoseconds": 10},
+                "starting_time": {"nanoseconds_since_epoch": 1758040178687887576},
+                "topics_with_message_count": [
+                    {
+                        "topic_metadata": {
+                            "name": "/front/image_rect/compressed",
+                            "type": "sensor_msgs/msg/CompressedImage",
+                        },
+                        "message_count": 3,
+                    }
+                ],
+            }
+        }
+        for name in ["b", "a", "c"]:
+            d = Path(f"/abc/logs/day1/{name}")
+            d.mkdir(parents=True)
+            (d / f"{name}_0.mcap").write_bytes(b"mcap")
+            with open(d / "metadata.yaml", "w") as metadata_file:
+                json.dump(metadata, metadata_file)  # JSON is YAML
+        # A log without rosbag2 metadata is its own bag
+        Path("/abc/logs/loose.mcap").touch()
+
+        os.chdir("/abc/logs")
+        repo = Repository(cwd=Path.cwd(), create=True)
+        repo.update_state()
+
+        count, updated_ns = repo.get_directory_state("day1")
+        self.assertEqual(count, 3)
+        first_page = repo.get_directory_logs("day1", limit=2)
+        self.assertEqual([lg.name for lg in first_page], ["a_0.mcap", "b_0.mcap"])
+        next_page = repo.get_directory_logs("day1", after=first_page[-1].log_path)
+        self.assertEqual([lg.name for lg in next_page], ["c_0.mcap"])
+        self.assertEqual(repo.get_directory_state(".")[0], 1)
+
+        log = repo.find_log("b_0.mcap")
+        self.assertEqual(log.log_path, "/abc/logs/day1/b/b_0.mcap")
+        self.assertEqual(log.size_bytes, 4)
+        self.assertEqual(log.start_time_ns, 1758040178687887576)
+        self.assertEqual(
+            log.get_topics(),
+            [
+                {
+                    "name": "/front/image_rect/compressed",
+                    "type": "sensor_msgs/msg/CompressedImage",
+                }
+            ],
+        )
+
+        # Nothing changed, the listing stays the same
+        repo.update_state()
+        self.assertEqual(repo.get_directory_state("day1"), (count, updated_ns))
+
+        # A rewritten log changes the listing
+        Path("/abc/logs/day1/b/b_0.mcap").write_bytes(b"mcap2")
+        repo.update_state()
+        self.assertEqual(repo.find_log("b_0.mcap").size_bytes, 5)
+        self.assertGreater(repo.get_directory_state("day1")[1], updated_ns)
+
+        # So does a removed one
+        Path("/abc/logs/day1/c/c_0.mcap").unlink()
+        repo.update_state()
+        self.assertIsNone(repo.find_log("c_0.mcap"))
+        self.assertEqual(repo.get_directory_state("day1")[0], 2)
@@ -0,0 +1,175 @@
+import asyncio
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from src.server import responses
+from src.server.responses import (
+    ZERO_COPY_SEND_EXTENSION,
+    FileRangeResponse,
+    FileSpanResponse,
+    get_file_validators,
+    is_range_fresh,
+    parse_byte_ranges,
+    resolve_served_path,
+)
+
+
+def _make_client(path):
+    def endpoint(request):
+        return FileSpanResponse(open(path, "rb"), 10, 1000, media_type="video/mp2t")
+
+    return TestClient(Starlette(routes=[Route("/", endpoint, methods=["GET", "HEAD"])]))
+
+
+def test_file_span_response(tmp_path, monkeypatch):
+    path = tmp_path / "entry"
+    path.write_bytes(bytes(range(256)) * 8)
+    # Read in several chunks
+    monkeypatch.setattr(responses, "CHUNK_SIZE", 64)
+
+    client = _make_client(path)
+    response = client.get("/")
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "1000"
+    assert response.headers["content-type"] == "video/mp2t"
+    assert response.content == path.read_bytes()[10:1010]
+
+    response = client.head("/")
+    assert response.headers["content-length"] == "1000"
+    assert response.content == b""
+
+
+def test_file_span_response_zero_copy(tmp_path):
+    path = tmp_path / "entry"
+    path.write_bytes(b"x" * 2000)
+    entry_file = open(path, "rb")
+    messages = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "extensions": {ZERO_COPY_SEND_EXTENSION: {}},
+    }
+    response = FileSpanResponse(entry_file, 10, 1000)
+    asyncio.run(response(scope, receive, send))
+
+    # The server sends the file itself, which is closed once sent
+    assert messages[1]["type"] == ZERO_COPY_SEND_EXTENSION
+    assert messages[1]["file"] is entry_file
+    assert (messages[1]["offset"], messages[1]["count"]) == (10, 1000)
+    assert messages[2] == {
+        "type": "http.response.body",
+        "body": b"",
+        "more_body": False,
+    }
+    assert entry_file.closed
+
+
+def test_parse_byte_ranges():
+    assert parse_byte_ranges("bytes=0-99", 1000) == [(0, 99)]
+    assert parse_byte_ranges("bytes=900-", 1000) == [(900, 999)]
+    assert parse_byte_ranges("bytes=-100", 1000) == [(900, 999)]
+    assert parse_byte_ranges("bytes=-5000", 1000) == [(0, 999)]
+    assert parse_byte_ranges("bytes=990-5000", 1000) == [(990, 999)]
+    # Sorted, overlapping and adjacent ranges merged
+    assert parse_byte_ranges("bytes=500-599, 0-9,5-19,20-29", 1000) == [
+        (0, 29),
+        (500, 599),
+    ]
+    # Ranges past the end are dropped, a request of only those is refused
+    assert parse_byte_ranges("bytes=0-9,2000-", 1000) == [(0, 9)]
+    with pytest.raises(ValueError):
+        parse_byte_ranges("bytes=2000-3000", 1000)
+    with pytest.raises(ValueError):
+        parse_byte_ranges("bytes=-0", 1000)
+
+    # Invalid headers are ignored
+    for header in ["items=0-9", "bytes=", "bytes=-", "bytes=9-0", "bytes=a-9"]:
+        assert parse_byte_ranges(header, 1000) is None
+    assert parse_byte_ranges("bytes=" + ",".join(["0-1"] * 100), 1000) is None
+
+
+def test_is_range_fresh(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"x" * 10)
+    validators = get_file_validators(path.stat())
+
+    assert is_range_fresh(None, validators)
+    assert is_range_fresh(validators["ETag"], validators)
+    assert is_range_fresh(validators["Last-Modified"], validators)
+    assert not is_range_fresh('"other"', validators)
+    assert not is_range_fresh("W/" + validators["ETag"], validators)
+    assert not is_range_fresh("Mon, 01 Jan 2024 00:00:00 GMT", validators)
+    assert not is_range_fresh("yesterday", validators)
+
+
+def test_resolve_served_path(tmp_path):
+    root = tmp_path / "root"
+    (root / "logs").mkdir(parents=True)
+    (root / "logs" / "video.mp4").write_bytes(b"x")
+    (tmp_path / "secret").write_bytes(b"x")
+    (root / "link").symlink_to(tmp_path / "secret")
+
+    assert resolve_served_path(root, "logs/video.mp4") == root / "logs/video.mp4"
+    assert resolve_served_path(root, "logs/../logs/video.mp4") is not None
+    assert resolve_served_path(root, "../secret") is None
+    assert resolve_served_path(root, str(tmp_path / "secret")) is None
+    assert resolve_served_path(root, "link") is None
+    assert resolve_served_path(root, "logs") is None
+    assert resolve_served_path(root, "missing.mp4") is None
+
+
+def test_resolve_served_path_suffixes(tmp_path):
+    (tmp_path / ".mosaic").mkdir()
+    (tmp_path / ".mosaic" / "index.db").write_bytes(b"x")
+    (tmp_path / "bag.timestamps.npz").write_bytes(b"x")
+    (tmp_path / "video.MP4").write_bytes(b"x")
+    (tmp_path / "link.mp4").symlink_to(tmp_path / "bag.timestamps.npz")
+
+    suffixes = {".mcap", ".mp4"}
+    assert resolve_served_path(tmp_path, "video.MP4", suffixes) is not None
+    assert resolve_served_path(tmp_path, ".mosaic/index.db", suffixes) is None
+    assert resolve_served_path(tmp_path, "bag.timestamps.npz", suffixes) is None
+    # The suffix checked is the one of the file a link points to
+    assert resolve_served_path(tmp_path, "link.mp4", suffixes) is None
+
+
+def test_file_range_response(tmp_path):
+    path = tmp_path / "video.mp4"
+    content = bytes(range(256)) * 4
+    path.write_bytes(content)
+
+    def endpoint(request):
+        ranges = None
+        if "range" in request.headers:
+            ranges = parse_byte_ranges(request.headers["range"], len(content))
+        return FileRangeResponse(open(path, "rb"), ranges, len(content))
+
+    client = TestClient(Starlette(routes=[Route("/", endpoint)]))
+    response = client.get("/")
+    assert response.status_code == 200
+    assert response.content == content
+
+    response = client.get("/", headers={"Range": "bytes=-24"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 1000-1023/1024"
+    assert response.content == content[-24:]
+
+    response = client.get("/", headers={"Range": "bytes=0-9,100-109"})
+    assert response.status_code == 206
+    media_type, _, boundary = response.headers["content-type"].partition("=")
+    assert media_type == "multipart/byteranges; boundary"
+    assert int(response.headers["content-length"]) == len(response.content)
+    parts = response.content.split(f"--{boundary}".encode())
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert len(parts) == 4
+    head, _, body = parts[2].partition(b"\r\n\r\n")
+    assert b"Content-Range: bytes 100-109/1024" in head
+    assert body == content[100:110] + b"\r\n"
@@ -0,0 +1,90 @@
+import os
+import pytest
+from src.server.executors import SegmentNode
+from src.server.processor import encode_segment, read_payload_span
+from src.server.segment_cache import SegmentCache, bag_fingerprint
+
+
+def test_put_get(tmp_path):
+    segment_cache = SegmentCache(tmp_path)
+    key = SegmentCache.make_key("bag", "/camera", 0, {"bitrate": 2_000_000})
+    assert segment_cache.get(key) is None
+
+    segment_cache.put(key, b"segment")
+    assert segment_cache.get(key) == b"segment"
+    assert segment_cache.get_stats()["hits"] == 1
+    assert segment_cache.get_stats()["misses"] == 1
+
+    # Another process opening the cache sees the entry and its size
+    assert SegmentCache(tmp_path).get_size() == len(b"segment")
+
+
+def test_put_existing_key(tmp_path):
+    segment_cache = SegmentCache(tmp_path)
+    key = SegmentCache.make_key("bag", "/camera", 0, {})
+    segment_cache.put(key, b"x" * 100)
+    segment_cache.put(key, b"x" * 60)
+
+    # The replaced entry no longer counts
+    assert segment_cache.get_size() == 60
+    assert segment_cache.get_size() == SegmentCache(tmp_path).get_size()
+
+
+def test_key_changes_with_profile():
+    key = SegmentCache.make_key("bag", "/camera", 0, {"bitrate": 2_000_000})
+    assert key == SegmentCache.make_key("bag", "/camera", 0, {"bitrate": 2_000_000})
+    assert key != SegmentCache.make_key("bag", "/camera", 0, {"bitrate": 1_000_000})
+    assert key != SegmentCache.make_key("bag", "/camera", 1, {"bitrate": 2_000_000})
+    assert key != SegmentCache.make_key("other", "/camera", 0, {"bitrate": 2_000_000})
+
+
+def test_size_cap(tmp_path):
+    segment_cache = SegmentCache(tmp_path, size_cap=20_000)
+    keys = [SegmentCache.make_key("bag", "/camera", idx, {}) for idx in range(11)]
+    for idx, key in enumerate(keys[:10]):
+        segment_cache.put(key, b"x" * 2000)
+        # Distinct last uses, the first entry is the least recently used
+        os.utime(segment_cache._get_path(key), (idx, idx))
+    segment_cache.get(keys[0])
+
+    # Over the cap, the least recently used entries are deleted
+    segment_cache.put(keys[10], b"x" * 2000)
+    assert segment_cache.get_size() <= 20_000
+    assert segment_cache.get(keys[0]) is not None
+    assert segment_cache.get(keys[1]) is None
+    assert segment_cache.get(keys[10]) is not None
+
+
+def test_bag_fingerprint(tmp_path):
+    bag = tmp_path / "bag.mcap"
+    bag.write_bytes(b"a" * 3_000_000)
+    fingerprint = bag_fingerprint(bag)
+
+    bag.rename(tmp_path / "moved.mcap")
+    (tmp_path / "bag.mcap").write_bytes(b"a" * 2_999_999 + b"b")
+    assert bag_fingerprint(tmp_path / "bag.mcap") != fingerprint
+
+
+def test_open_payload_span(tmp_path):
+    segment_cache = SegmentCache(tmp_path)
+    key = SegmentCache.make_key("bag", "/camera", 0, {})
+    assert segment_cache.open(key) is None
+
+    segment = SegmentNode(data=b"segment", renditions={"360p": b"small"})
+    segment_cache.put(key, encode_segment(segment))
+    with segment_cache.open(key) as entry_file:
+        offset, length, encoding = read_payload_span(entry_file, "360p")
+        assert encoding is None
+        entry_file.seek(offset)
+        assert entry_file.read(length) == b"small"
+
+        entry_file.seek(0)
+        offset, length, _ = read_payload_span(entry_file)
+        entry_file.seek(offset)
+        assert entry_file.read(length) == b"segment"
+
+        entry_file.seek(0)
+        with pytest.raises(KeyError):
+            read_payload_span(entry_file, "8k")
+    assert segment_cache.get_stats()["hits"] == 1
+    assert segment_cache.get_stats()["misses"] == 1
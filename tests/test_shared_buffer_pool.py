@@ -0,0 +1,103 @@
+import multiprocessing
+from src.server.executors import SegmentNode
+from src.server.shared_buffer_pool import SharedBufferPool
+
+
+def _produce(path, worker_idx):
+    buffer_pool = SharedBufferPool(path)
+    for idx in range(worker_idx, 40, 4):
+        buffer_pool.add_segment("/camera", SegmentNode(bytes([idx]) * 1000), idx)
+    buffer_pool.close()
+
+
+def _claim(path):
+    buffer_pool = SharedBufferPool(path)
+    claimed = buffer_pool.claim_segment("/camera", 0)
+    buffer_pool.set_segment_count("/camera", 3)
+    buffer_pool.close()
+    # Exits with 1 if the claim was taken
+    raise SystemExit(int(claimed))
+
+
+def test_claim_across_processes(tmp_path):
+    path = tmp_path / "arena"
+    buffer_pool = SharedBufferPool(path, data_size=1024 * 1024, bucket_cnt=64)
+    ctx = multiprocessing.get_context("spawn")
+
+    def claimed_by_other_process():
+        worker = ctx.Process(target=_claim, args=(path,))
+        worker.start()
+        worker.join()
+        return worker.exitcode == 1
+
+    assert buffer_pool.claim_segment("/camera", 0)
+    assert not claimed_by_other_process()
+    buffer_pool.release_segment("/camera", 0)
+    assert claimed_by_other_process()
+
+    # The final count set by the other process is known here too
+    assert buffer_pool.get_final_segment_count("/camera") == 3
+    assert buffer_pool.wait_segment("/camera", 3) is None
+
+
+def test_segments_shared_across_processes(tmp_path):
+    path = tmp_path / "arena"
+    buffer_pool = SharedBufferPool(path, data_size=1024 * 1024, bucket_cnt=64)
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_produce, args=(path, idx)) for idx in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    for idx in range(40):
+        assert buffer_pool.get_segment("/camera", idx).data == bytes([idx]) * 1000
+    assert buffer_pool.get_segment_count("/camera") == 40
+    assert buffer_pool.get_stats()["hits"] == 40
+
+
+def test_ring_eviction(tmp_path):
+    buffer_pool = SharedBufferPool(tmp_path / "arena", data_size=10_000)
+    renditions = {"360p": b"low"}
+    for idx in range(20):
+        buffer_pool.add_segment("/camera", SegmentNode(b"x" * 1000, renditions), idx)
+
+    # Only the last segments still fit in the ring
+    assert buffer_pool.get_segment("/camera", 0) is None
+    segment = buffer_pool.get_segment("/camera", 19)
+    assert segment.data == b"x" * 1000
+    assert segment.renditions == renditions
+
+    # Too large for the ring altogether
+    buffer_pool.add_segment("/camera", SegmentNode(b"x" * 20_000), 20)
+    assert buffer_pool.get_segment("/camera", 20) is None
+    assert buffer_pool.get_stats()["rejected"] == 1
+
+
+def test_segment_count(tmp_path):
+    buffer_pool = SharedBufferPool(tmp_path / "arena", data_size=10_000)
+    for idx in range(20):
+        buffer_pool.add_segment("/camera", SegmentNode(b"x" * 1000), idx)
+    buffer_pool.add_segment("/lidar", SegmentNode(b"y" * 100), 0)
+    # Added again, counted once
+    buffer_pool.add_segment("/camera", SegmentNode(b"z" * 1000), 19)
+
+    # Segments the ring wrapped over aren't counted anymore
+    held = [idx for idx in range(20) if buffer_pool.has_segment("/camera", idx)]
+    assert 0 < len(held) < 20
+    assert buffer_pool.get_segment_count("/camera") == len(held)
+    assert buffer_pool.get_segment_count("/lidar") == 1
+    assert buffer_pool.get_segment_count("/radar") == 0
+
+
+def test_segment_count_topic_table_full(tmp_path):
+    buffer_pool = SharedBufferPool(tmp_path / "arena", data_size=10_000, topic_cnt=1)
+    buffer_pool.add_segment("/camera", SegmentNode(b"x" * 100), 0)
+    buffer_pool.add_segment("/lidar", SegmentNode(b"y" * 100), 0)
+    buffer_pool.add_segment("/lidar", SegmentNode(b"y" * 100), 1)
+
+    # Scanned from the index instead
+    assert buffer_pool.get_segment_count("/camera") == 1
+    assert buffer_pool.get_segment_count("/lidar") == 2
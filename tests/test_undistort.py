@@ -0,0 +1,138 @@
+import cv2
+import numpy as np
+from sensor_msgs import msg
+import src.server.executors.undistort as undistort
+from src.server.executors import (
+    AbstractStage,
+    H264ConvertorStage,
+    UndistortStage,
+    compute_remap_tables,
+    get_remap_tables,
+)
+from src.server.models import Topic
+
+
+def _make_camera_info(width=640, height=480, distortion_model="plumb_bob"):
+    k = [400.0, 0.0, width / 2, 0.0, 400.0, height / 2, 0.0, 0.0, 1.0]
+    return msg.CameraInfo(
+        width=width,
+        height=height,
+        distortion_model=distortion_model,
+        d=[-0.3, 0.1, 0.0, 0.0, 0.0],
+        k=k,
+        r=[1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0],
+        p=k[:3] + [0.0] + k[3:6] + [0.0] + k[6:] + [0.0],
+    )
+
+
+def _make_image(width=640, height=480):
+    image = np.zeros((height, width, 3), np.uint8)
+    image[::40] = 255
+    image[:, ::40] = 255
+    return image
+
+
+def test_compute_remap_tables():
+    camera_info = _make_camera_info()
+    image = _make_image()
+    map1, map2 = compute_remap_tables(camera_info, 640, 480)
+
+    expected = cv2.undistort(
+        image,
+        np.array(camera_info.k).reshape(3, 3),
+        np.array(camera_info.d),
+    )
+    undistorted = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+    assert np.mean(np.abs(undistorted.astype(int) - expected)) < 2
+
+    # Half the calibrated resolution
+    assert compute_remap_tables(camera_info, 320, 240)[0].shape[:2] == (240, 320)
+
+    # Not calibrated
+    camera_info.k = [0.0] * 9
+    assert compute_remap_tables(camera_info, 640, 480) is None
+
+
+def test_get_remap_tables_cached(tmp_path, monkeypatch):
+    camera_info = _make_camera_info(distortion_model="equidistant")
+    tables = get_remap_tables(camera_info, 640, 480, tmp_path)
+    assert get_remap_tables(camera_info, 640, 480, tmp_path) is tables
+
+    # A restarted process loads them from disk instead of computing them
+    undistort._remap_tables.clear()
+    monkeypatch.setattr(undistort, "compute_remap_tables", None)
+    loaded = get_remap_tables(camera_info, 640, 480, tmp_path)
+    assert np.array_equal(loaded[0], tables[0])
+    assert np.array_equal(loaded[1], tables[1])
+
+
+def test_get_remap_tables_corrupt_cache(tmp_path):
+    camera_info = _make_camera_info()
+    tables = get_remap_tables(camera_info, 320, 240, tmp_path)
+    (path,) = tmp_path.glob("*.npz")
+
+    # A truncated cache is recomputed and overwritten
+    path.write_bytes(path.read_bytes()[:100])
+    undistort._remap_tables.clear()
+    recomputed = get_remap_tables(camera_info, 320, 240, tmp_path)
+    assert np.array_equal(recomputed[0], tables[0])
+    with np.load(path) as cached:
+        assert np.array_equal(cached["map1"], tables[0])
+
+
+def test_compute_remap_tables_fisheye_short_distortion():
+    # Fisheye calibrations with fewer than k1..k4 pad the missing ones with 0
+    camera_info = _make_camera_info(distortion_model="equidistant")
+    camera_info.d = [0.1, 0.01]
+    padded = _make_camera_info(distortion_model="equidistant")
+    padded.d = [0.1, 0.01, 0.0, 0.0]
+
+    map1, _ = compute_remap_tables(camera_info, 640, 480)
+    assert np.array_equal(map1, compute_remap_tables(padded, 640, 480)[0])
+
+
+class _ImageSource(AbstractStage):
+    """120 images a second for a second"""
+
+    def __init__(self):
+        super().__init__()
+        self._idx = 0
+
+    def next(self, topic):
+        if self._idx >= 120:
+            return None
+        _, jpeg = cv2.imencode(".jpg", _make_image())
+        ts = self._idx * 1_000_000_000 // 120
+        self._idx += 1
+        return msg.CompressedImage(format="jpeg", data=jpeg.tobytes()), ts
+
+
+def test_undistort_stage(tmp_path):
+    stage = UndistortStage("unused.mcap", "/camera/camera_info", tmp_path)
+    stage.set_child_executor(_ImageSource())
+    stage.get_camera_info = _make_camera_info
+
+    # Messages are handed through, only the kept ones are decoded
+    compressed_image, ts = stage.next(Topic(name="/camera", schema_name="/camera"))
+    assert ts == 0
+    assert isinstance(compressed_image, msg.CompressedImage)
+    image = stage.decode_frame(compressed_image)
+    assert image.shape == (480, 640, 3)
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_undistort_decodes_kept_frames(tmp_path):
+    stage = UndistortStage("unused.mcap", "/camera/camera_info", tmp_path)
+    stage.set_child_executor(_ImageSource())
+    stage.get_camera_info = _make_camera_info
+    decoded = []
+    decode_frame = stage.decode_frame
+    stage.decode_frame = lambda data: decoded.append(data) or decode_frame(data)
+
+    video_stage = H264ConvertorStage(1_000_000_000, start_ns=0)
+    video_stage.set_child_executor(stage)
+    assert video_stage.next(Topic(name="/camera", schema_name="/camera")) is not None
+    assert video_stage.get_total_messages_consumed() == 120
+    # The first message, and the last one of each frame slot the messages
+    # round to (the 30 of the segment and the start of the next one)
+    assert len(decoded) == 32